@@ -0,0 +1,114 @@
+"""
+Memory allocated per guest call, measured with tracemalloc
+
+A guest function recurses to a given depth and then calls a host probe
+which snapshots traced memory. The difference between two depths divided
+by the number of extra levels is what every active guest call holds.
+
+Usage: python -m benchmarks.allocations [--baseline GIT_REVISION]
+"""
+import io
+import gc
+import time
+import typing
+import argparse
+import builtins
+import tracemalloc
+
+import vm
+import vm_runner
+from benchmarks.dispatch import load_baseline
+
+RECURSION = r"""
+def descend(n, payload):
+    if n == 0:
+        return probe()
+    return descend(n - 1, payload)
+
+descend(DEPTH, None)
+"""
+
+CALLS = r"""
+def add(x, y):
+    return x + y
+
+i = 0
+while i < 20000:
+    add(i, i)
+    i += 1
+"""
+
+SHALLOW = 20
+DEEP = 120
+
+
+def traced_at_depth(machine_class: type, depth: int) -> typing.Tuple[int, int]:
+    """
+    Run the recursion case and snapshot memory at the deepest call
+    :param machine_class: virtual machine class to measure
+    :param depth: guest recursion depth
+    :return: (traced blocks, traced bytes)
+    """
+    measured = []
+
+    def probe():
+        snapshot = tracemalloc.take_snapshot()
+        statistics = snapshot.statistics('filename')
+        measured.append((sum(stat.count for stat in statistics), sum(stat.size for stat in statistics)))
+
+    code = compile(RECURSION.replace('DEPTH', str(depth)), '<allocations>', 'exec')
+    builtins.probe = probe
+    gc.collect()
+    tracemalloc.start()
+    try:
+        machine_class().run(code)
+    finally:
+        tracemalloc.stop()
+        del builtins.probe
+    return measured[0]
+
+
+def per_call(machine_class: type) -> typing.Tuple[float, float]:
+    """
+    :param machine_class: virtual machine class to measure
+    :return: (blocks, bytes) held by one active guest call
+    """
+    shallow_blocks, shallow_bytes = traced_at_depth(machine_class, SHALLOW)
+    deep_blocks, deep_bytes = traced_at_depth(machine_class, DEEP)
+    levels = DEEP - SHALLOW
+    return (deep_blocks - shallow_blocks) / levels, (deep_bytes - shallow_bytes) / levels
+
+
+def call_time(machine_class: type) -> float:
+    """
+    :param machine_class: virtual machine class to measure
+    :return: best time in microseconds of one short guest call
+    """
+    code = compile(CALLS, '<calls>', 'exec')
+    best = float('inf')
+    for _ in range(5):
+        start = time.perf_counter()
+        with vm_runner.redirected(out=io.StringIO(), err=io.StringIO()):
+            machine_class().run(code)
+        best = min(best, time.perf_counter() - start)
+    return best / 20000 * 1e6
+
+
+def report(title: str, machine_class: type) -> None:
+    blocks, size = per_call(machine_class)
+    print("{}: {:.1f} blocks, {:.0f} bytes per active call; {:.2f} us per call".format(
+        title, blocks, size, call_time(machine_class)))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--baseline', help='git revision of vm.py to compare against')
+    args = parser.parse_args()
+
+    if args.baseline:
+        report("before ({})".format(args.baseline), load_baseline(args.baseline).VirtualMachine)
+    report("after", vm.VirtualMachine)
+
+
+if __name__ == '__main__':
+    main()
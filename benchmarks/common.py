@@ -0,0 +1,21 @@
+"""
+Helpers shared by the benchmarks
+"""
+import io
+import types
+
+import vm
+import vm_runner
+import vm_profiler
+
+
+def count_instructions(code: types.CodeType) -> int:
+    """
+    Run code once under profiler
+    :param code: compiled program
+    :return: number of executed instructions
+    """
+    profiler = vm_profiler.Profiler()
+    with vm_runner.redirected(out=io.StringIO(), err=io.StringIO()):
+        vm.VirtualMachine(profiler=profiler).run(code)
+    return sum(item['count'] for item in profiler.opcode_stats())
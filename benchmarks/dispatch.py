@@ -0,0 +1,96 @@
+"""
+Instruction dispatch throughput on the cases.py corpus
+
+Usage: python -m benchmarks.dispatch [--repeat N] [--baseline GIT_REVISION]
+"""
+import io
+import os
+import time
+import types
+import typing
+import argparse
+import tempfile
+import subprocess
+import importlib.util
+
+import vm
+import vm_runner
+from cases import TEST_CASES
+from benchmarks.common import count_instructions
+
+
+def load_baseline(revision: str) -> types.ModuleType:
+    """
+    Import vm.py as it was at given git revision
+    :param revision: any git revision name
+    :return: imported module
+    """
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    source = subprocess.check_output(['git', 'show', '{}:vm.py'.format(revision)], cwd=root)
+    path = os.path.join(tempfile.mkdtemp(), 'vm_baseline.py')
+    with open(path, 'wb') as f:
+        f.write(source)
+    spec = importlib.util.spec_from_file_location('vm_baseline', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def collect_corpus(machine_classes: typing.List[type]) -> typing.List[typing.Tuple[str, types.CodeType, int]]:
+    """
+    Compile cases which every given virtual machine runs without errors
+    :param machine_classes: virtual machine classes to be compared
+    :return: list of (name, code, executed instructions)
+    """
+    corpus = []
+    for case in TEST_CASES:
+        code = vm_runner.compile_code(case.text_code)
+        try:
+            instructions = count_instructions(code)
+            with vm_runner.redirected(out=io.StringIO(), err=io.StringIO()):
+                for machine_class in machine_classes:
+                    machine_class().run(code)
+        except BaseException:
+            continue
+        corpus.append((case.name, code, instructions))
+    return corpus
+
+
+def measure(machine_class: type, corpus: typing.List[typing.Tuple[str, types.CodeType, int]], repeat: int) -> float:
+    """
+    Time repeated runs of the whole corpus
+    :param machine_class: virtual machine class to benchmark
+    :param corpus: compiled cases
+    :param repeat: number of passes over the corpus
+    :return: executed instructions per second
+    """
+    total = sum(instructions for _, _, instructions in corpus) * repeat
+    with vm_runner.redirected(out=io.StringIO(), err=io.StringIO()):
+        start = time.perf_counter()
+        for _ in range(repeat):
+            for _, code, _ in corpus:
+                machine_class().run(code)
+        elapsed = time.perf_counter() - start
+    return total / elapsed
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--repeat', type=int, default=200, help='passes over the corpus')
+    parser.add_argument('--baseline', help='git revision of vm.py to compare against')
+    args = parser.parse_args()
+
+    baseline = load_baseline(args.baseline) if args.baseline else None
+    os.chdir(tempfile.mkdtemp())
+    corpus = collect_corpus([baseline.VirtualMachine] if baseline else [])
+    print("Cases: {}, instructions per pass: {}".format(
+        len(corpus), sum(instructions for _, _, instructions in corpus)))
+
+    if baseline:
+        print("before ({}): {:,.0f} instructions/sec".format(
+            args.baseline, measure(baseline.VirtualMachine, corpus, args.repeat)))
+    print("after: {:,.0f} instructions/sec".format(measure(vm.VirtualMachine, corpus, args.repeat)))
+
+
+if __name__ == '__main__':
+    main()
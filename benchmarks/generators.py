@@ -0,0 +1,113 @@
+"""
+Peak memory of a guest generator pipeline against the same computation
+materializing every stage into a list, measured with tracemalloc
+
+Generator frames are suspended instead of run to completion, so the
+pipeline holds one frame per stage whatever the number of items while
+the list version holds every intermediate result.
+
+Usage: python -m benchmarks.generators [--sizes N ...] [--stages N ...]
+"""
+import io
+import gc
+import time
+import typing
+import argparse
+import tracemalloc
+
+import vm
+import vm_runner
+
+PIPELINE = r"""
+def numbers(n):
+    i = 0
+    while i < n:
+        yield i
+        i += 1
+
+def scale(xs):
+    for x in xs:
+        yield x * 3 + 1
+
+def odd(xs):
+    for x in xs:
+        if x % 2:
+            yield x
+
+items = numbers(SIZE)
+for _ in range(STAGES):
+    items = scale(items)
+print(sum(odd(items)))
+"""
+
+LISTS = r"""
+def numbers(n):
+    result = []
+    i = 0
+    while i < n:
+        result.append(i)
+        i += 1
+    return result
+
+def scale(xs):
+    return [x * 3 + 1 for x in xs]
+
+def odd(xs):
+    return [x for x in xs if x % 2]
+
+items = numbers(SIZE)
+for _ in range(STAGES):
+    items = scale(items)
+print(sum(odd(items)))
+"""
+
+
+def measure(source: str, size: int, stages: int) -> typing.Tuple[int, float, str]:
+    """
+    Run guest code once in a fresh virtual machine
+    :param source: PIPELINE or LISTS
+    :param size: number of items
+    :param stages: number of scale stages
+    :return: (peak traced bytes, wall time, output)
+    """
+    code = compile(source.replace('SIZE', str(size)).replace('STAGES', str(stages)), '<generators>', 'exec')
+    stdout = io.StringIO()
+    gc.collect()
+    tracemalloc.start()
+    try:
+        with vm_runner.redirected(out=stdout, err=io.StringIO()):
+            start = time.perf_counter()
+            vm.VirtualMachine().run(code)
+            elapsed = time.perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak, elapsed, stdout.getvalue()
+
+
+def compare(size: int, stages: int) -> None:
+    pipeline_peak, pipeline_time, pipeline_output = measure(PIPELINE, size, stages)
+    lists_peak, lists_time, lists_output = measure(LISTS, size, stages)
+    line = "{:>10}{:>8}{:>16,}{:>16,}{:>15.3f}{:>10.3f}".format(
+        size, stages, pipeline_peak, lists_peak, pipeline_time, lists_time)
+    if pipeline_output != lists_output:
+        line += "  OUTPUT MISMATCH"
+    print(line)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--sizes', type=int, nargs='*', default=[1000, 10000, 100000], help='numbers of items')
+    parser.add_argument('--stages', type=int, nargs='*', default=[1, 4, 16], help='numbers of scale stages')
+    args = parser.parse_args()
+
+    print("{:>10}{:>8}{:>16}{:>16}{:>15}{:>10}".format(
+        'items', 'stages', 'generators, B', 'lists, B', 'generators, s', 'lists, s'))
+    for size in args.sizes:
+        compare(size, args.stages[0])
+    for stages in args.stages[1:]:
+        compare(args.sizes[-1], stages)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+"""
+Virtual machines created per second, new against taken from a
+vm_runner.MachinePool, and end-to-end runs per second of the cases.py
+programs in a new machine per run against pooled machines
+
+Usage: python -m benchmarks.pool [--seconds X]
+"""
+import os
+import time
+import typing
+import tempfile
+import argparse
+
+import vm
+import vm_runner
+from cases import TEST_CASES
+
+
+def rate(function: typing.Callable[[], None], seconds: float) -> float:
+    """
+    :param function: operation to repeat
+    :param seconds: minimum time to repeat it for
+    :return: calls per second
+    """
+    calls = 0
+    start = time.perf_counter()
+    while True:
+        for _ in range(100):
+            function()
+        calls += 100
+        elapsed = time.perf_counter() - start
+        if elapsed >= seconds:
+            return calls / elapsed
+
+
+def measure(seconds: float) -> None:
+    """
+    Print the rates of new and pooled machines and runs
+    :param seconds: time to measure every rate for
+    """
+    pool = vm_runner.MachinePool()
+    # Load all programs once so that both ways run with warm code caches;
+    # the ones ending with KeyboardInterrupt or SystemExit are left out
+    codes = []
+    for case in TEST_CASES:
+        code = vm_runner.compile_code(case.text_code)
+        try:
+            vm_runner.execute_vm(code)
+        except BaseException:
+            continue
+        codes.append(code)
+
+    def new_machine() -> None:
+        vm.VirtualMachine()
+
+    def pooled_machine() -> None:
+        pool.release(pool.acquire())
+
+    def new_runs() -> None:
+        for code in codes:
+            vm_runner.execute_vm(code)
+
+    def pooled_runs() -> None:
+        for code in codes:
+            with pool.machine() as machine:
+                vm_runner.execute_vm(code, machine)
+
+    print("{:<20}{:>14}{:>14}{:>10}".format('', 'new, 1/s', 'pooled, 1/s', 'speedup'))
+    for title, new, pooled, multiplier in [('machines', new_machine, pooled_machine, 1),
+                                           ('runs', new_runs, pooled_runs, len(codes))]:
+        new_rate = rate(new, seconds) * multiplier
+        pooled_rate = rate(pooled, seconds) * multiplier
+        print("{:<20}{:>14,.0f}{:>14,.0f}{:>9.2f}x".format(title, new_rate, pooled_rate, pooled_rate / new_rate))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--seconds', type=float, default=2.0, help='time to measure every rate for')
+    args = parser.parse_args()
+
+    # Programs write files in the current directory
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as directory:
+        os.chdir(directory)
+        try:
+            measure(args.seconds)
+        finally:
+            os.chdir(cwd)
+
+
+if __name__ == '__main__':
+    main()
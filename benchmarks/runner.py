@@ -0,0 +1,118 @@
+"""
+Run benchmark workloads in the virtual machine and natively
+
+Usage: python -m benchmarks.runner [--scale X] [--repeat N] [--only NAME ...]
+                                   [--output results.json] [--compare old.json]
+"""
+import io
+import os
+import sys
+import json
+import time
+import types
+import typing
+import argparse
+import datetime
+import subprocess
+
+import vm
+import vm_runner
+from benchmarks.common import count_instructions
+from benchmarks.workloads import WORKLOADS, Workload
+
+
+def best_time(function: typing.Callable[[types.CodeType], None], code: types.CodeType,
+              repeat: int) -> typing.Tuple[float, str]:
+    """
+    :param function: executor of code
+    :param code: compiled workload
+    :param repeat: number of runs
+    :return: best wall time and output of the last run
+    """
+    best = float('inf')
+    output = ''
+    for _ in range(repeat):
+        stdout = io.StringIO()
+        with vm_runner.redirected(out=stdout, err=io.StringIO()):
+            start = time.perf_counter()
+            function(code)
+            elapsed = time.perf_counter() - start
+        best = min(best, elapsed)
+        output = stdout.getvalue()
+    return best, output
+
+
+def run_workload(workload: Workload, scale: float, repeat: int) -> typing.Dict[str, typing.Any]:
+    code = compile(workload.source(scale), '<{}>'.format(workload.name), 'exec')
+    native_time, native_output = best_time(lambda c: exec(c, {}), code, repeat)
+    vm_time, vm_output = best_time(lambda c: vm.VirtualMachine().run(c), code, repeat)
+    instructions = count_instructions(code)
+    return {
+        'name': workload.name,
+        'vm_time': vm_time,
+        'native_time': native_time,
+        'instructions': instructions,
+        'instructions_per_sec': instructions / vm_time,
+        'slowdown': vm_time / native_time,
+        'output_matches': vm_output == native_output,
+    }
+
+
+def git_revision() -> typing.Optional[str]:
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=root,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_results(results: typing.List[typing.Dict[str, typing.Any]],
+                  baseline: typing.Optional[typing.Dict[str, typing.Any]] = None) -> None:
+    previous = {item['name']: item for item in baseline['results']} if baseline else {}
+    header = "{:<16}{:>10}{:>10}{:>14}{:>14}{:>10}".format(
+        'workload', 'vm, s', 'native, s', 'instructions', 'instr/sec', 'slowdown')
+    if previous:
+        header += "{:>10}".format('speedup')
+    print(header)
+    for item in results:
+        line = "{name:<16}{vm_time:>10.3f}{native_time:>10.4f}{instructions:>14}" \
+               "{instructions_per_sec:>14,.0f}{slowdown:>9.0f}x".format(**item)
+        if item['name'] in previous:
+            line += "{:>9.2f}x".format(previous[item['name']]['vm_time'] / item['vm_time'])
+        if not item['output_matches']:
+            line += "  OUTPUT MISMATCH"
+        print(line)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--scale', type=float, default=1.0, help='multiplier of workload sizes')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per workload, best time is taken')
+    parser.add_argument('--only', nargs='*', help='names of workloads to run')
+    parser.add_argument('--output', help='path of JSON file to save results to')
+    parser.add_argument('--compare', help='path of JSON results of an earlier run')
+    args = parser.parse_args()
+
+    workloads = [workload for workload in WORKLOADS if not args.only or workload.name in args.only]
+    results = [run_workload(workload, args.scale, args.repeat) for workload in workloads]
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print_results(results, baseline)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({
+                'python': sys.version,
+                'revision': git_revision(),
+                'date': datetime.datetime.now().isoformat(),
+                'scale': args.scale,
+                'results': results,
+            }, f, indent=4)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+"""
+Frequencies of consecutive instruction pairs and triples, used to pick
+superinstructions. Static counts come from Scorer over the cases.py corpus
+and the workloads; dynamic counts weight every run by how often it was
+executed by the virtual machine on the workloads.
+Arithmetic opcodes are grouped by their handler (BINARY_OP, INPLACE_OP, UNARY_OP)
+
+Usage: python -m benchmarks.sequences [--length N ...] [--limit N] [--scale X]
+"""
+import io
+import argparse
+import typing
+from collections import Counter
+
+import vm
+import vm_runner
+import vm_profiler
+from vm_scorer import Scorer
+from cases import TEST_CASES
+from benchmarks.workloads import WORKLOADS
+
+Sequence = typing.Tuple[str, ...]
+
+
+def group(sequence: Sequence) -> Sequence:
+    return tuple(vm.instruction_group(opname) for opname in sequence)
+
+
+def static_counts(sources: typing.List[str], length: int) -> Counter:
+    """
+    :param sources: text code of guest programs
+    :param length: number of instructions in a run
+    :return: occurrences of every run in compiled code
+    """
+    scorer = Scorer([])
+    counts = Counter()
+    for text_code in sources:
+        for sequence, count in scorer.get_sequences(text_code, length).items():
+            counts[group(sequence)] += count
+    return counts
+
+
+def dynamic_counts(sources: typing.List[str], length: int) -> Counter:
+    """
+    Run sources under profiler with superinstructions off and counted by the
+    opcodes programs were loaded with. A run is weighted
+    by the smallest execution count of its instructions, which is exact for
+    straight-line code and an upper bound across jump targets
+    :param sources: text code of guest programs
+    :param length: number of instructions in a run
+    :return: executions of every run
+    """
+    cache = vm.code_cache
+    superinstructions, cache.superinstructions = cache.superinstructions, False
+    cache.clear()
+    profiler = vm_profiler.Profiler()
+    try:
+        for text_code in sources:
+            with vm_runner.redirected(out=io.StringIO(), err=io.StringIO()):
+                vm.VirtualMachine(profiler=profiler).run(compile(text_code, '<sequences>', 'exec'))
+    finally:
+        cache.superinstructions = superinstructions
+        cache.clear()
+
+    counts = Counter()
+    for stats in profiler.programs.values():
+        opnames = [vm.instruction_group(vm.OPNAMES[opcode]) for opcode in stats.program.generic_opcodes]
+        for start in range(len(opnames) - length + 1):
+            weight = min(stats.counts[start:start + length])
+            if weight:
+                counts[tuple(opnames[start:start + length])] += weight
+    return counts
+
+
+def print_counts(title: str, counts: Counter, limit: int) -> None:
+    total = sum(counts.values())
+    print(title)
+    for sequence, count in counts.most_common(limit):
+        print("\t{:<60}{:>12}{:>8.1%}".format(' '.join(sequence), count, count / total))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--length', type=int, nargs='*', default=[2, 3], help='run lengths to count')
+    parser.add_argument('--limit', type=int, default=15, help='rows in each table')
+    parser.add_argument('--scale', type=float, default=0.2, help='multiplier of workload sizes')
+    args = parser.parse_args()
+
+    workloads = [workload.source(args.scale) for workload in WORKLOADS]
+    corpus = [case.text_code for case in TEST_CASES] + workloads
+    for length in args.length:
+        print_counts("Static, length {}:".format(length), static_counts(corpus, length), args.limit)
+        print_counts("Dynamic, length {}:".format(length), dynamic_counts(workloads, length), args.limit)
+
+
+if __name__ == '__main__':
+    main()
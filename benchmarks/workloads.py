@@ -0,0 +1,198 @@
+"""
+Guest programs long enough to measure; every workload prints a checksum
+so that virtual machine output can be compared with native execution.
+Sizes are {n} placeholders scaled by the runner
+"""
+
+
+class Workload:
+    def __init__(self, name: str, text_code: str, size: int):
+        self.name = name
+        self.text_code = text_code
+        self.size = size
+
+    def source(self, scale: float = 1.0) -> str:
+        return self.text_code.replace('{n}', str(max(1, int(self.size * scale))))
+
+
+WORKLOADS = [
+    Workload(
+        name="nbody",
+        size=300,
+        text_code=r"""
+def make_bodies():
+    bodies = []
+    for i in range(5):
+        position = [float(i), float(i * 2 - 3), float(1 - i)]
+        velocity = [0.01 * i, -0.02 * i, 0.005]
+        bodies.append((position, velocity, 1.0 + i * 0.1))
+    return bodies
+
+def make_pairs(bodies):
+    pairs = []
+    for i in range(len(bodies)):
+        for j in range(i + 1, len(bodies)):
+            pairs.append((bodies[i], bodies[j]))
+    return pairs
+
+def advance(bodies, pairs, dt, steps):
+    for step in range(steps):
+        for ((r1, v1, m1), (r2, v2, m2)) in pairs:
+            dx = r1[0] - r2[0]
+            dy = r1[1] - r2[1]
+            dz = r1[2] - r2[2]
+            distance = (dx * dx + dy * dy + dz * dz) ** -1.5
+            mag = dt * distance
+            b1 = m1 * mag
+            b2 = m2 * mag
+            v1[0] -= dx * b2
+            v1[1] -= dy * b2
+            v1[2] -= dz * b2
+            v2[0] += dx * b1
+            v2[1] += dy * b1
+            v2[2] += dz * b1
+        for (r, v, m) in bodies:
+            r[0] += dt * v[0]
+            r[1] += dt * v[1]
+            r[2] += dt * v[2]
+
+def energy(bodies, pairs):
+    e = 0.0
+    for ((r1, v1, m1), (r2, v2, m2)) in pairs:
+        dx = r1[0] - r2[0]
+        dy = r1[1] - r2[1]
+        dz = r1[2] - r2[2]
+        e -= (m1 * m2) / ((dx * dx + dy * dy + dz * dz) ** 0.5)
+    for (r, v, m) in bodies:
+        e += m * (v[0] * v[0] + v[1] * v[1] + v[2] * v[2]) / 2.0
+    return e
+
+bodies = make_bodies()
+pairs = make_pairs(bodies)
+advance(bodies, pairs, 0.01, {n})
+print(round(energy(bodies, pairs), 6))
+"""),
+    Workload(
+        name="fib",
+        size=20,
+        text_code=r"""
+def fib(n):
+    if n < 2:
+        return n
+    return fib(n - 1) + fib(n - 2)
+
+print(fib({n}))
+"""),
+    Workload(
+        name="dict_str",
+        size=20000,
+        text_code=r"""
+def churn(n):
+    counts = {}
+    words = []
+    for i in range(n):
+        key = 'k' + str(i % 97)
+        counts[key] = counts.get(key, 0) + 1
+        words.append(key.upper())
+        if len(words) > 50:
+            text = ' '.join(words)
+            counts[text[:5]] = len(text)
+            words = []
+    return counts
+
+counts = churn({n})
+print(len(counts), sorted(counts.items())[:3])
+"""),
+    Workload(
+        name="closures",
+        size=10000,
+        text_code=r"""
+def make_adder(k):
+    def add(x):
+        return x + k
+    return add
+
+def compose(f, g):
+    def composed(x):
+        return f(g(x))
+    return composed
+
+def make_counter():
+    count = 0
+    def increment(step):
+        nonlocal count
+        count += step
+        return count
+    return increment
+
+counter = make_counter()
+pipeline = compose(make_adder(3), compose(make_adder(-1), make_adder(2)))
+total = 0
+for i in range({n}):
+    total += pipeline(i)
+    counter(i % 7)
+print(total, counter(0))
+"""),
+    Workload(
+        name="methods",
+        size=5000,
+        text_code=r"""
+class Shape:
+    def __init__(self, name):
+        self.name = name
+
+    def area(self):
+        return 0
+
+    def describe(self):
+        return self.name + ':' + str(self.area())
+
+class Rect(Shape):
+    def __init__(self, width, height):
+        super().__init__('rect')
+        self.width = width
+        self.height = height
+
+    def area(self):
+        return self.width * self.height
+
+class Square(Rect):
+    def __init__(self, side):
+        super().__init__(side, side)
+        self.name = 'square'
+
+class Circle(Shape):
+    def __init__(self, radius):
+        Shape.__init__(self, 'circle')
+        self.radius = radius
+
+    def area(self):
+        return 3 * self.radius * self.radius
+
+shapes = [Rect(2, 3), Square(4), Circle(5), Shape('point')]
+total = 0
+length = 0
+for i in range({n}):
+    shape = shapes[i % 4]
+    total += shape.area()
+    length += len(shape.describe())
+print(total, length)
+"""),
+    Workload(
+        name="comprehensions",
+        size=300,
+        text_code=r"""
+def run(n):
+    checksum = 0
+    for i in range(n):
+        squares = [x * x for x in range(50)]
+        evens = [x for x in squares if x % 2 == 0]
+        index = {x: x % 7 for x in evens}
+        residues = {value for value in index.values()}
+        pairs = [(a, b) for a in range(5) for b in range(a)]
+        checksum += len(evens) + sum(index.values()) + len(residues) + len(pairs)
+    return checksum
+
+print(run({n}))
+"""),
+]
@@ -0,0 +1,9 @@
+import os
+import atexit
+import shutil
+import tempfile
+
+# Keep the compile cache of vm_runner out of the user cache directory
+if 'VM_COMPILE_CACHE' not in os.environ:
+    os.environ['VM_COMPILE_CACHE'] = tempfile.mkdtemp(prefix='vm-compile-')
+    atexit.register(shutil.rmtree, os.environ['VM_COMPILE_CACHE'], True)
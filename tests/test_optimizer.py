@@ -0,0 +1,66 @@
+import dis
+import time
+import operator
+import unittest
+
+import vm
+import vm_optimizer
+
+LOAD_CONST = dis.opmap['LOAD_CONST']
+RETURN_VALUE = dis.opmap['RETURN_VALUE']
+
+
+def binary(opname: str, function, left, right):
+    return [[LOAD_CONST, left, 1], [LOAD_CONST, right, 1], [dis.opmap[opname], function, 1],
+            [RETURN_VALUE, None, 1]]
+
+
+class FoldConstantsTest(unittest.TestCase):
+    def assertFolded(self, entries, value):
+        entries = vm_optimizer.optimize(entries)
+        self.assertEqual([entry[:2] for entry in entries], [[LOAD_CONST, value], [RETURN_VALUE, None]])
+
+    def assertNotFolded(self, entries):
+        started = time.perf_counter()
+        optimized = vm_optimizer.optimize([list(entry) for entry in entries])
+        self.assertLess(time.perf_counter() - started, 0.05)
+        self.assertEqual([entry[0] for entry in optimized], [entry[0] for entry in entries])
+
+    def test_small_results_are_folded(self):
+        self.assertFolded(binary('BINARY_POWER', operator.pow, 2, 10), 1024)
+        self.assertFolded(binary('BINARY_MULTIPLY', operator.mul, 'ab', 3), 'ababab')
+        self.assertFolded(binary('BINARY_MULTIPLY', operator.mul, 3, (1,)), (1, 1, 1))
+        self.assertFolded(binary('BINARY_LSHIFT', operator.lshift, 1, 100), 1 << 100)
+        self.assertFolded(binary('BINARY_ADD', operator.add, 'a', 'b'), 'ab')
+
+    def test_large_results_are_not_computed(self):
+        self.assertNotFolded(binary('BINARY_POWER', operator.pow, 7, 10 ** 6))
+        self.assertNotFolded(binary('BINARY_MULTIPLY', operator.mul, 'x', 10 ** 8))
+        self.assertNotFolded(binary('BINARY_MULTIPLY', operator.mul, 10 ** 8, b'x'))
+        self.assertNotFolded(binary('BINARY_MULTIPLY', operator.mul, (1, 2), 10 ** 7))
+        self.assertNotFolded(binary('BINARY_MULTIPLY', operator.mul, 1 << 100, 1 << 100))
+        self.assertNotFolded(binary('BINARY_LSHIFT', operator.lshift, 1, 10 ** 7))
+        self.assertNotFolded(binary('BINARY_MODULO', operator.mod, '%0100000000d', 1))
+
+
+class ReportTest(unittest.TestCase):
+    def report(self, source: str, optimize: bool = True) -> dict:
+        program = vm.Program(compile(source, '<test>', 'exec'), optimize=optimize, superinstructions=True)
+        item, = vm_optimizer.report([program])
+        return {name: item[name] for name in ('original', 'optimized', 'eliminated')}
+
+    def test_block_setups_are_not_counted(self):
+        # The three jumps back to the loop head are unreachable once the jump
+        # of the if is threaded; SETUP_LOOP and POP_BLOCK go but not by the pass
+        source = 'while x:\n    if y:\n        break\n    else:\n        continue\n'
+        self.assertEqual(self.report(source), {'original': 12, 'optimized': 9, 'eliminated': 3})
+        self.assertEqual(self.report('try:\n    x = 1\nfinally:\n    y = 2\n')['eliminated'], 0)
+        self.assertEqual(self.report(source, optimize=False)['eliminated'], 0)
+
+    def test_extended_arguments_are_not_counted(self):
+        source = 'x = [%s]\n' % ', '.join(map(str, range(300)))
+        self.assertEqual(self.report(source), {'original': 304, 'optimized': 304, 'eliminated': 0})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,59 @@
+import io
+import unittest
+
+import vm
+import vm_runner
+import vm_profiler
+
+SOURCE = """
+def f(n):
+    total = 0
+    for i in range(n):
+        if i < n // 2:
+            total = total + i * 2
+        else:
+            total += 1.5
+    return total
+print(f(100), [x * x for x in range(10)])
+"""
+
+
+class ProfilerTest(unittest.TestCase):
+    def profile(self, **options) -> vm_profiler.Profiler:
+        cache = vm.code_cache
+        saved = {name: getattr(cache, name) for name in options}
+        for name, value in options.items():
+            setattr(cache, name, value)
+        cache.clear()
+        profiler = vm_profiler.Profiler()
+        try:
+            with vm_runner.redirected(out=io.StringIO(), err=io.StringIO()):
+                vm.VirtualMachine(profiler=profiler).run(compile(SOURCE, '<test>', 'exec'))
+        finally:
+            for name, value in saved.items():
+                setattr(cache, name, value)
+            cache.clear()
+        return profiler
+
+    def test_counts_do_not_depend_on_fusion_and_specialization(self):
+        plain = self.profile(superinstructions=False, adaptive=False)
+        for options in [{'superinstructions': True, 'adaptive': True}, {'superinstructions': False, 'adaptive': True},
+                        {'superinstructions': True, 'adaptive': False}]:
+            profiler = self.profile(**options)
+            self.assertEqual(sum(item['count'] for item in profiler.opcode_stats()),
+                             sum(item['count'] for item in plain.opcode_stats()), options)
+            self.assertEqual({(item['filename'], item['line'], item['count']) for item in profiler.line_stats()},
+                             {(item['filename'], item['line'], item['count']) for item in plain.line_stats()},
+                             options)
+            self.assertEqual(sorted((item['function'], item['instructions']) for item in profiler.function_stats()),
+                             sorted((item['function'], item['instructions']) for item in plain.function_stats()),
+                             options)
+
+    def test_opcodes_are_reported_as_loaded(self):
+        opnames = {item['opname'] for item in self.profile(superinstructions=True, adaptive=True).opcode_stats()}
+        self.assertIn('FOR_ITER__STORE_FAST', opnames)
+        self.assertFalse([opname for opname in opnames if opname.startswith('ADAPTIVE_') or opname.endswith('_INT')])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,246 @@
+import io
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import vm
+import vm_runner
+
+
+class CompileCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory, True)
+
+    def disk_bytes(self) -> int:
+        return sum(os.path.getsize(os.path.join(self.directory, name)) for name in os.listdir(self.directory))
+
+    def test_tests_use_temporary_directory(self):
+        self.assertEqual(vm_runner.compile_cache.directory, os.environ['VM_COMPILE_CACHE'])
+
+    def test_rewritten_key_is_counted_once(self):
+        cache = vm_runner.CompileCache(self.directory)
+        source = 'x = 1\n'
+        code = compile(source, '<stdin>', 'exec')
+        cache.put(source, code)
+        cache.put('y = 2\n', compile('y = 2\n', '<stdin>', 'exec'))
+        for _ in range(10):
+            cache.put(source, code)
+        self.assertEqual(cache._disk_bytes, self.disk_bytes())
+        # A rewrite with different data replaces the old size
+        cache.put(source, compile(source * 20, '<stdin>', 'exec'))
+        self.assertEqual(cache._disk_bytes, self.disk_bytes())
+
+    def test_rewrites_do_not_prune(self):
+        source = 'x = 1\n'
+        code = compile(source, '<stdin>', 'exec')
+        cache = vm_runner.CompileCache(self.directory)
+        cache.put(source, code)
+        cache.put('y = 2\n', compile('y = 2\n', '<stdin>', 'exec'))
+        cache.max_bytes = self.disk_bytes() + 1
+        for _ in range(100):
+            cache.put(source, code)
+        self.assertEqual(len(os.listdir(self.directory)), 2)
+
+    def test_failed_write_leaves_no_temporary_file(self):
+        cache = vm_runner.CompileCache(self.directory)
+        source = 'x = 1\n'
+        code = compile(source, '<stdin>', 'exec')
+        with mock.patch('os.replace', side_effect=OSError):
+            cache.put(source, code)
+        with mock.patch('os.replace', side_effect=KeyboardInterrupt), self.assertRaises(KeyboardInterrupt):
+            cache.put(source, code)
+        self.assertEqual(os.listdir(self.directory), [])
+        # The code is still kept in memory
+        self.assertIs(cache.get(source), code)
+
+
+class OutputCaptureTest(unittest.TestCase):
+    def test_truncation_keeps_whole_characters(self):
+        for spill_bytes in [None, 0]:
+            for limit in range(12):
+                capture = vm_runner.OutputCapture(max_bytes=limit, spill_bytes=spill_bytes)
+                capture.write('a')
+                capture.write('\u044f\u20ac\U0001f600')
+                capture.write('\u044f')
+                value = capture.getvalue()
+                text = value if isinstance(value, str) else value[:].decode('utf-8')
+                self.assertTrue(capture.truncated)
+                self.assertEqual(capture.size, len(text.encode('utf-8')))
+                self.assertLessEqual(capture.size, limit)
+                self.assertTrue(('a\u044f\u20ac\U0001f600\u044f').startswith(text))
+                capture.close()
+
+    def test_spilled_output_at_limit(self):
+        capture = vm_runner.OutputCapture(max_bytes=10, spill_bytes=4)
+        print('\u044f' * 8, file=capture)
+        value = capture.getvalue()
+        self.assertNotIsInstance(value, str)
+        self.assertEqual(value[:].decode('utf-8'), '\u044f' * 5)
+        self.assertEqual(capture.size, 10)
+        capture.close()
+
+    def test_spilled_output_is_returned_as_text(self):
+        code = compile("import sys\nprint('\u044f' * 100)\nprint('x', file=sys.stderr)", '<test>', 'exec')
+        out, err = vm_runner.OutputCapture(spill_bytes=16), vm_runner.OutputCapture(spill_bytes=0)
+        self.assertEqual(vm_runner.execute_vm(code, out=out, err=err), ('\u044f' * 100 + '\n', 'x\n', None))
+        self.assertNotIsInstance(out.getvalue(), str)
+        out.close()
+        err.close()
+
+
+class MachinePoolTest(unittest.TestCase):
+    def run_in(self, machine: vm.VirtualMachine, source: str, **names):
+        global_names = dict(vm.MAIN_NAMESPACE)
+        global_names.update(names)
+        return vm_runner.execute_vm(compile(source, '<test>', 'exec'), machine, global_names)
+
+    def assertReset(self, machine: vm.VirtualMachine) -> None:
+        self.assertEqual(machine.frames, [])
+        self.assertIsNone(machine.frame)
+        self.assertIsNone(machine.callee)
+        self.assertIsNone(machine.returned_value)
+        self.assertIsNone(machine.last_exception)
+        self.assertEqual(machine.cached_names, {})
+        self.assertFalse(machine.names_exposed)
+        self.assertIsNone(machine.deadline)
+        self.assertIsNone(machine.stdout)
+        self.assertIsNone(machine.stderr)
+
+    def test_released_machine_is_reset_and_reused(self):
+        pool = vm_runner.MachinePool(size=1, time_limit=10)
+        with pool.machine() as machine:
+            out, _, exc = self.run_in(machine, """
+import sys
+try:
+    raise KeyError('x')
+except KeyError:
+    print(sys.exc_info()[0].__name__, 'sys' in globals())
+    1 / 0
+""")
+        self.assertEqual(out, 'KeyError True\n')
+        self.assertIsInstance(exc, ZeroDivisionError)
+        self.assertReset(machine)
+        with pool.machine() as again:
+            self.assertIs(again, machine)
+            out, _, exc = self.run_in(again, 'import sys\nprint(sys.exc_info())')
+        self.assertEqual((out, exc), ('(None, None, None)\n', None))
+
+    def test_names_do_not_leak_between_runs(self):
+        pool = vm_runner.MachinePool(size=1)
+        program = vm.load_program(compile("""
+for i in range(100):
+    total = x + i
+print(total)
+""", '<test>', 'exec'))
+        results = []
+        for names in [{'x': 1}, {}, {'x': 2}]:
+            with pool.machine() as machine:
+                results.append(vm_runner.execute_vm(program, machine, dict(vm.MAIN_NAMESPACE, **names)))
+        self.assertEqual([out for out, _, _ in results], ['100\n', '', '101\n'])
+        self.assertIsInstance(results[1][2], NameError)
+
+    def test_streams_rebound_by_guest_are_restored(self):
+        stdout = io.StringIO()
+        pool = vm_runner.MachinePool(size=1, stdout=stdout)
+        source = compile("""
+import io
+import sys
+print('before')
+sys.stdout = sys.stderr = io.StringIO()
+""", '<test>', 'exec')
+        with pool.machine() as machine:
+            machine.run_program(vm.load_program(source), dict(vm.MAIN_NAMESPACE))
+        self.assertIs(machine.stdout, stdout)
+        self.assertIsNone(machine.stderr)
+        with pool.machine() as machine:
+            machine.run_program(vm.load_program(compile("print('after')", '<test>', 'exec')))
+        self.assertEqual(stdout.getvalue(), 'before\nafter\n')
+
+    def test_idle_machines_are_capped(self):
+        pool = vm_runner.MachinePool(size=2)
+        machines = [pool.acquire() for _ in range(3)]
+        self.assertEqual(len(set(map(id, machines))), 3)
+        for machine in machines:
+            pool.release(machine)
+        self.assertEqual(len(pool._idle), 2)
+
+
+class ExecuteBatchTest(unittest.TestCase):
+    def test_results_of_every_job(self):
+        jobs = [('print(%d)' % i, 'job%d' % i) for i in range(8)]
+        jobs.append(('1 / 0', 'fails'))
+        jobs.append((compile('import sys\nprint(2, file=sys.stderr)', '<test>', 'exec'), 'code'))
+        for workers in [1, 2]:
+            results = {result.name: result for result in vm_runner.execute_batch(jobs, workers)}
+            self.assertEqual(sorted(results), sorted(name for _, name in jobs))
+            for i in range(8):
+                self.assertEqual(results['job%d' % i], ('job%d' % i, '%d\n' % i, '', None))
+            self.assertEqual(results['fails'].out, '')
+            self.assertEqual(results['fails'].exception, 'ZeroDivisionError: division by zero')
+            self.assertTrue(results['fails'].err.startswith('Traceback'))
+            self.assertEqual(results['code'], ('code', '', '2\n', None))
+
+    def test_jobs_do_not_share_globals(self):
+        jobs = [('x = 1\nprint(x)', 'first'), ('print(x)', 'second')]
+        results = list(vm_runner.execute_batch(jobs, workers=1))
+        self.assertEqual([(result.name, result.out, result.exception) for result in results],
+                         [('first', '1\n', None), ('second', '', "NameError: name 'x' is not defined")])
+
+
+class ExecuteManyTest(unittest.TestCase):
+    SOURCE = """
+if flag:
+    kept = x
+total = 0
+for i in range(x):
+    total += i
+print(total, kept)
+"""
+
+    def expected(self, count: int) -> list:
+        """
+        :return: name, output and exception summary of each result
+        """
+        results = []
+        for x in range(count):
+            if x % 3:
+                results.append((x, '%d %d\n' % (x * (x - 1) // 2, x), None))
+            else:
+                results.append((x, '', "NameError: name 'kept' is not defined"))
+        return results
+
+    def inputs(self, count: int):
+        return ({'x': x, 'flag': x % 3 != 0} for x in range(count))
+
+    def assertResults(self, results: list, count: int) -> None:
+        self.assertEqual([(result.name, result.out, result.exception) for result in results],
+                         self.expected(count))
+        for result in results:
+            self.assertEqual(bool(result.err), result.exception is not None, result.name)
+
+    def test_in_process(self):
+        self.assertResults(list(vm_runner.execute_many(self.SOURCE, self.inputs(50))), 50)
+
+    def test_with_workers(self):
+        code = compile(self.SOURCE, '<test>', 'exec')
+        for workers, chunksize in [(1, 16), (2, 1), (3, 7)]:
+            results = list(vm_runner.execute_many(code, self.inputs(50), workers, chunksize))
+            self.assertResults(results, 50)
+
+    def test_inputs_are_consumed_lazily(self):
+        taken = []
+        def inputs():
+            for x in range(1, 5):
+                taken.append(x)
+                yield {'x': x, 'flag': True}
+        results = vm_runner.execute_many(self.SOURCE, inputs())
+        self.assertEqual(next(results).out, '0 1\n')
+        self.assertEqual(taken, [1])
+        self.assertEqual([result.name for result in results], [1, 2, 3])
+
+
+if __name__ == '__main__':
+    unittest.main()
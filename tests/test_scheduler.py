@@ -0,0 +1,64 @@
+import io
+import asyncio
+import unittest
+
+import vm
+import vm_scheduler
+
+
+def compiled(source: str):
+    return compile(source, '<test>', 'exec')
+
+
+class SchedulerTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.scheduler = vm_scheduler.Scheduler(quantum=5, loop=self.loop)
+
+    def tearDown(self):
+        self.loop.close()
+
+    def run_all(self, tasks):
+        self.loop.run_until_complete(asyncio.wait([task.future for task in tasks], loop=self.loop))
+
+    def test_base_exception_settles_only_its_task(self):
+        failing = self.scheduler.submit(compiled("for i in range(20):\n    pass\nraise KeyboardInterrupt"))
+        sibling = self.scheduler.submit(compiled("total = 0\nfor i in range(100):\n    total += i"))
+        self.run_all([failing, sibling])
+        self.assertIsInstance(failing.future.exception(), KeyboardInterrupt)
+        self.assertEqual(sibling.result()['total'], 4950)
+
+    def test_generator_exit_does_not_stop_scheduling(self):
+        tasks = [self.scheduler.submit(compiled("raise GeneratorExit")),
+                 self.scheduler.submit(compiled("x = sum(range(10))"))]
+        self.run_all(tasks)
+        self.assertIsInstance(tasks[0].future.exception(), GeneratorExit)
+        self.assertEqual(tasks[1].result()['x'], 45)
+
+    def test_output_matches_serial_run(self):
+        source = compiled("def f(n):\n    return n if n < 2 else f(n - 1) + f(n - 2)\nprint(f(12))")
+        machines = [vm.VirtualMachine(stdout=io.StringIO()) for _ in range(10)]
+        self.run_all([self.scheduler.submit(source, 1 + number % 3, machine)
+                      for number, machine in enumerate(machines)])
+        self.assertEqual({machine.stdout.getvalue() for machine in machines}, {'144\n'})
+
+    def test_cancel_runs_finally(self):
+        machine = vm.VirtualMachine(stdout=io.StringIO())
+        task = self.scheduler.submit(compiled("try:\n    while True:\n        pass\nfinally:\n    print('cleanup')"),
+                                     machine=machine)
+
+        async def cancel_later():
+            for _ in range(3):
+                await asyncio.sleep(0, loop=self.loop)
+            task.cancel()
+            for _ in range(3):
+                await asyncio.sleep(0, loop=self.loop)
+
+        self.loop.run_until_complete(cancel_later())
+        self.assertTrue(task.future.cancelled())
+        self.assertEqual(machine.stdout.getvalue(), 'cleanup\n')
+        self.assertEqual(len(self.scheduler), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,41 @@
+import unittest
+
+import vm_scorer
+from cases import TEST_CASES
+
+
+def totals(scorer: vm_scorer.Scorer):
+    return (scorer.get_total_stats(), scorer.get_levels_stats(), scorer.get_levels_coverage(),
+            scorer.get_operations_coverage(), scorer.total_score())
+
+
+class ScorerTest(unittest.TestCase):
+    def test_incremental_totals_match_batch(self):
+        tests = [case.text_code for case in TEST_CASES]
+        scorer = vm_scorer.Scorer(tests)
+        for test in tests[::3]:
+            scorer.remove_test(test)
+        for test in tests[::6]:
+            scorer.add_test(test)
+        kept = [test for i, test in enumerate(tests) if i % 3 or not i % 6]
+        self.assertEqual(totals(scorer), totals(vm_scorer.Scorer(kept)))
+
+    def test_total_score_is_exact(self):
+        # 175 / 77 * 77 is not 175.0 in floating point
+        scorer = vm_scorer.Scorer(['x = 1'] * 77)
+        self.assertEqual(scorer.total_score(), vm_scorer.LEVEL_SCORES[1])
+        scorer = vm_scorer.Scorer([case.text_code for case in TEST_CASES])
+        levels = scorer.get_levels_stats()
+        self.assertEqual(scorer.total_score(),
+                         sum(score for level, score in vm_scorer.LEVEL_SCORES.items() if levels[level]))
+
+    def test_remove_missing_test(self):
+        scorer = vm_scorer.Scorer(['x = 1'])
+        scorer.remove_test('x = 1')
+        self.assertEqual(scorer.total_score(), 0)
+        with self.assertRaises(KeyError):
+            scorer.remove_test('x = 1')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,650 @@
+import io
+import sys
+import threading
+import time
+import weakref
+import unittest
+
+import vm
+import vm_runner
+
+
+def run_native(source: str):
+    stdout = io.StringIO()
+    exc = None
+    with vm_runner.redirected(out=stdout, err=io.StringIO()):
+        try:
+            exec(compile(source, '<test>', 'exec'), {'__name__': '__main__'})
+        except Exception as e:
+            exc = e
+    return stdout.getvalue(), exc
+
+
+def run_vm(source: str, **options):
+    """
+    :param options: CodeCache settings to load every program of source with
+    """
+    cache = vm.code_cache
+    saved = {name: getattr(cache, name) for name in options}
+    for name, value in options.items():
+        setattr(cache, name, value)
+    cache.clear()
+    try:
+        out, _, exc = vm_runner.execute_vm(compile(source, '<test>', 'exec'))
+    finally:
+        for name, value in saved.items():
+            setattr(cache, name, value)
+        cache.clear()
+    return out, exc
+
+
+class ParityTest(unittest.TestCase):
+    """
+    Output and exception type of the virtual machine match CPython, with
+    every loader option on and off
+    """
+    OPTIONS = [
+        {'optimize': True, 'superinstructions': True, 'adaptive': True},
+        {'optimize': False, 'superinstructions': True, 'adaptive': True},
+        {'optimize': True, 'superinstructions': False, 'adaptive': True},
+        {'optimize': True, 'superinstructions': False, 'adaptive': False},
+    ]
+
+    def assertParity(self, source: str) -> None:
+        expected_out, expected_exc = run_native(source)
+        for options in self.OPTIONS:
+            out, exc = run_vm(source, **options)
+            self.assertEqual(out, expected_out, options)
+            self.assertEqual(type(exc), type(expected_exc), options)
+
+
+class ExceptionTableTest(ParityTest):
+    def test_store_before_try_is_not_fused_into_it(self):
+        self.assertParity("""
+def f():
+    y = 1
+    try:
+        z = w
+    except UnboundLocalError:
+        print('caught')
+    w = 2
+f()
+""")
+
+    def test_load_in_handler_is_not_fused_with_try_body(self):
+        self.assertParity("""
+def f(x):
+    try:
+        y = x + 1
+    except TypeError:
+        y = x
+        print('handler', y)
+    return y
+print(f(1), f('a'))
+""")
+
+
+class BindingTest(ParityTest):
+    def test_varargs_name_is_not_a_keyword(self):
+        self.assertParity("""
+def f(*args, **kw):
+    return args, kw
+print(f(args=1), f(1, kw=2))
+""")
+
+    def test_missing_argument_messages(self):
+        self.assertParity("""
+def one(a): pass
+def two(a, b, c=1): pass
+def three(a, b, c, d=1): pass
+def kwonly(a, *, b, c, d=1): pass
+def kwonly_three(*, b, c, d): pass
+calls = [lambda: one(), lambda: two(), lambda: two(c=2), lambda: two(1), lambda: three(),
+         lambda: three(b=1), lambda: kwonly(1), lambda: kwonly(1, b=2), lambda: kwonly(),
+         lambda: kwonly_three(c=1)]
+for call in calls:
+    try:
+        call()
+    except TypeError as e:
+        print(e)
+""")
+
+    def test_defaults_after_keywords(self):
+        self.assertParity("""
+def f(a, b=2, *args, c, d=4, **kw):
+    return a, b, args, c, d, kw
+print(f(1, c=3), f(1, 2, 3, c=5, e=6), f(b=1, a=0, c=2))
+""")
+
+
+class GeneratorFinalizerTest(ParityTest):
+    def test_abandoned_generator_runs_finally(self):
+        self.assertParity("""
+def g():
+    try:
+        yield 1
+        yield 2
+    finally:
+        print('cleanup')
+for x in g():
+    break
+print('after')
+""")
+
+    def test_abandoned_generator_returns_from_handler(self):
+        self.assertParity("""
+import gc
+def g():
+    try:
+        yield 1
+    except GeneratorExit:
+        print('exit')
+        return
+it = g()
+next(it)
+del it
+print('after del')
+it = g()
+next(it)
+cycle = [it, None]
+cycle[1] = cycle
+del it, cycle
+gc.collect()
+print('after collect')
+""")
+
+    def test_generator_dropped_after_run(self):
+        source = """
+def g():
+    try:
+        yield 1
+    except GeneratorExit:
+        print('exit')
+        return
+it = g()
+next(it)
+"""
+        stdout = io.StringIO()
+        machine = vm.VirtualMachine(stdout=stdout)
+        namespace = {'__name__': '__main__'}
+        machine.run_program(vm.load_program(compile(source, '<test>', 'exec')), namespace)
+        self.assertIsNone(machine.frame)
+        namespace.clear()
+        self.assertEqual(stdout.getvalue(), 'exit\n')
+
+    def test_abandoned_generator_exits_with_block(self):
+        self.assertParity("""
+class CM:
+    def __enter__(self):
+        print('enter')
+    def __exit__(self, *args):
+        print('exit', args[0])
+def g():
+    with CM():
+        yield 1
+        yield 2
+for x in g():
+    break
+print('after')
+""")
+
+    def test_finalizer_keeps_return_value_of_dropping_frame(self):
+        self.assertParity("""
+def g():
+    try:
+        yield 1
+    finally:
+        print('cleanup')
+def f():
+    it = g()
+    next(it)
+    return 5
+print(f())
+""")
+
+
+class NameCacheTest(ParityTest):
+    def test_write_through_module_locals(self):
+        self.assertParity("""
+x = 1
+def f():
+    return x
+f()
+locals()['x'] = 2
+print(f())
+""")
+
+    def test_write_through_kept_globals(self):
+        self.assertParity("""
+x = 1
+names = globals()
+def f():
+    return x
+print(f())
+names['x'] = 2
+print(f())
+names.update(x=3)
+y = 0
+print(f(), x)
+del names['x']
+try:
+    f()
+except NameError:
+    print('deleted')
+""")
+
+    def test_globals_and_vars_are_guest_namespaces(self):
+        self.assertParity("""
+print(globals()['__name__'], vars()['__name__'], 'x' in globals())
+class C:
+    a = 1
+    vars()['b'] = 2
+    print(b)
+print(vars(C)['a'], C.b)
+""")
+
+    def test_deleted_global_is_finalized(self):
+        self.assertParity("""
+class R:
+    def __del__(self):
+        print('freed')
+def f():
+    print(type(r).__name__)
+r = R()
+r
+f()
+del r
+print('after del')
+r = R()
+f()
+r = None
+print('after rebinding')
+""")
+
+    def test_globals_are_not_kept_after_run(self):
+        code = compile('class R: pass\nr = R()\nr\ndef f(): return r\nf()', '<test>', 'exec')
+        machine = vm.VirtualMachine()
+        namespace = {'__name__': '__main__'}
+        machine.run_program(vm.load_program(code), namespace)
+        instance = weakref.ref(namespace['r'])
+        namespace.clear()
+        self.assertIsNone(instance())
+
+
+class AdaptiveTest(ParityTest):
+    def setUp(self):
+        self.saved = vm.code_cache.superinstructions, vm.code_cache.adaptive
+        vm.code_cache.adaptive = True
+        self.addCleanup(self.restore)
+
+    def restore(self):
+        vm.code_cache.superinstructions, vm.code_cache.adaptive = self.saved
+        vm.code_cache.clear()
+
+    def run_function(self, source: str, calls: str, superinstructions: bool = True) -> vm.Program:
+        """
+        Define function f with source, run calls and return the program of f
+        """
+        vm.code_cache.superinstructions = superinstructions
+        vm.code_cache.clear()
+        code = compile(source + calls, '<test>', 'exec')
+        vm_runner.execute_vm(code)
+        function_code = next(constant for constant in code.co_consts if hasattr(constant, 'co_code'))
+        return vm.load_program(function_code)
+
+    def assertInstalled(self, program: vm.Program, opname: str) -> None:
+        self.assertIn(opname, [vm.OPNAMES[opcode] for opcode in program.opcodes])
+
+    def test_fused_arithmetic_is_specialized(self):
+        for source, name in [('def f(x, y):\n    return x * 2\n', 'LOAD_FAST__LOAD_CONST__BINARY_MULTIPLY'),
+                             ('def f(x, y):\n    return x + y\n', 'LOAD_FAST__LOAD_FAST__BINARY_ADD'),
+                             ('def f(x, y):\n    return (x, y)[0] - 1\n', 'LOAD_CONST__BINARY_SUBTRACT')]:
+            program = self.run_function(source, 'for i in range(20):\n    f(i, i)\n')
+            self.assertInstalled(program, name + '_INT')
+            # A float deoptimizes it
+            program = self.run_function(source, 'for i in range(20):\n    f(i, i)\nf(0.5, 0.5)\n')
+            self.assertInstalled(program, 'ADAPTIVE_{}__BINARY_OP'.format(name[:name.rindex('__')]))
+            self.assertNotIn(name + '_INT', [vm.OPNAMES[opcode] for opcode in program.opcodes])
+
+    def test_deoptimized_arithmetic_is_specialized_again(self):
+        program = self.run_function('def f(x, y):\n    return x + y\n',
+                                    'for i in range(20):\n    f(i, i)\nfor i in range(100):\n    f(0.5, 0.5)\n')
+        self.assertInstalled(program, 'LOAD_FAST__LOAD_FAST__BINARY_ADD_FLOAT')
+
+    def test_compare_is_specialized_without_superinstructions(self):
+        source = 'def f(x, y):\n    return x < y\n'
+        program = self.run_function(source, 'for i in range(20):\n    f(i, 3)\n', superinstructions=False)
+        self.assertInstalled(program, 'COMPARE_LT_INT')
+        program = self.run_function(source, 'for i in range(20):\n    f(i, 3)\nf("a", "b")\n',
+                                    superinstructions=False)
+        self.assertInstalled(program, 'ADAPTIVE_COMPARE_OP')
+        self.assertNotIn('COMPARE_LT_INT', [vm.OPNAMES[opcode] for opcode in program.opcodes])
+
+    def test_results_after_type_changes(self):
+        self.assertParity("""
+def f(x, y):
+    return x * 2 + y, x - 1.0 * y, x < y, x == y, (x, y)[0] * 3
+for values in [(1, 2)] * 20 + [(1.5, 2.5)] * 100 + [(3, 4), ('a', 'b'), (True, 2), (2 ** 70, 1)] * 30:
+    print(f(*values))
+""")
+
+
+class AttributeCacheTest(ParityTest):
+    """
+    Attribute caches warmed up in a loop see class attributes changed half way
+    """
+    def test_method_replaced_after_warm_up(self):
+        self.assertParity("""
+class C:
+    def f(self):
+        return 1
+def g(self):
+    return 2
+c = C()
+total = 0
+for i in range(100):
+    if i == 50:
+        C.f = g
+    if i == 75:
+        setattr(C, 'f', lambda self: 3)
+    total += c.f()
+print(total)
+""")
+
+    def test_method_of_base_class(self):
+        self.assertParity("""
+class B:
+    def f(self):
+        return 1
+class C(B):
+    pass
+c = C()
+total = 0
+for i in range(100):
+    if i == 30:
+        B.f = lambda self: 2
+    if i == 60:
+        C.f = lambda self: 3
+    if i == 80:
+        del C.f
+    if i == 90:
+        delattr(B, 'f')
+    try:
+        total += c.f()
+    except AttributeError:
+        total += 100
+print(total)
+""")
+
+    def test_class_attribute_and_instance_shadowing(self):
+        self.assertParity("""
+class C:
+    x = 1
+    def f(self):
+        return 1
+c = C()
+total = 0
+for i in range(100):
+    if i == 20:
+        C.x = 5
+    if i == 40:
+        c.x = 7
+        c.f = lambda: 10
+    if i == 60:
+        del c.x
+        del c.f
+    if i == 80:
+        C.x = C.f
+    total += c.f() + (c.x if isinstance(c.x, int) else c.x())
+print(total)
+""")
+
+    def test_bases_and_class_assignment(self):
+        self.assertParity("""
+class A:
+    def f(self):
+        return 1
+class B:
+    def f(self):
+        return 2
+class C(A):
+    pass
+class D(B):
+    def f(self):
+        return 4
+c = C()
+total = 0
+for i in range(100):
+    if i == 40:
+        C.__bases__ = (B,)
+    if i == 70:
+        c.__class__ = D
+    total += c.f()
+print(total)
+""")
+
+    def test_class_with_metaclass(self):
+        self.assertParity("""
+class M(type):
+    def __setattr__(cls, name, value):
+        super().__setattr__(name, value)
+class C(metaclass=M):
+    def f(self):
+        return 1
+c = C()
+total = 0
+for i in range(100):
+    if i == 50:
+        C.f = lambda self: 4
+    total += c.f() + C.f(c)
+print(total)
+""")
+
+
+class LimitsTest(unittest.TestCase):
+    LOOP = """
+def spin():
+    while True:
+        pass
+def f():
+    try:
+        spin()
+    except BaseException:
+        print('caught')
+    finally:
+        print('finally')
+f()
+"""
+
+    def run_limited(self, machine: vm.VirtualMachine, code) -> vm.BudgetExceeded:
+        with self.assertRaises(vm.BudgetExceeded) as raised:
+            machine.run_program(vm.load_program(code), {'__name__': '__main__'})
+        return raised.exception
+
+    def test_instruction_budget(self):
+        machine = vm.VirtualMachine(stdout=io.StringIO(), instruction_budget=1000)
+        error = self.run_limited(machine, compile(self.LOOP, '<test>', 'exec'))
+        self.assertEqual((error.resource, error.limit), ('instructions', 1000))
+        self.assertGreater(error.used, 1000)
+
+    def test_time_limit(self):
+        machine = vm.VirtualMachine(stdout=io.StringIO(), time_limit=0.05)
+        started = time.perf_counter()
+        error = self.run_limited(machine, compile(self.LOOP, '<test>', 'exec'))
+        self.assertLess(time.perf_counter() - started, 1)
+        self.assertEqual((error.resource, error.limit), ('time', 0.05))
+        self.assertGreaterEqual(error.used, 0.05)
+
+    def test_guest_does_not_see_the_error(self):
+        stdout = io.StringIO()
+        machine = vm.VirtualMachine(stdout=stdout, instruction_budget=1000)
+        self.run_limited(machine, compile(self.LOOP, '<test>', 'exec'))
+        self.run_limited(machine, compile("""
+def g():
+    try:
+        yield 1
+        while True:
+            pass
+    finally:
+        print('finally')
+try:
+    for x in g():
+        pass
+except BaseException:
+    print('caught')
+""", '<test>', 'exec'))
+        self.assertEqual(stdout.getvalue(), '')
+
+    def test_machine_is_reused_after_error(self):
+        stdout = io.StringIO()
+        machine = vm.VirtualMachine(stdout=stdout, instruction_budget=1000)
+        code = compile(self.LOOP, '<test>', 'exec')
+        self.run_limited(machine, code)
+        self.assertEqual(machine.frames, [])
+        self.assertIsNone(machine.frame)
+        # Frames left by the error are released like returning ones
+        for function_code in code.co_consts[0:3:2]:
+            self.assertEqual(len(vm.load_program(function_code).free_frames), 1, function_code.co_name)
+        machine.run_program(vm.load_program(compile('print(sum(range(10)))', '<test>', 'exec')),
+                            {'__name__': '__main__'})
+        self.assertEqual(stdout.getvalue(), '45\n')
+
+
+class RecursionLimitTest(unittest.TestCase):
+    DOWN = """
+def down(n):
+    return 0 if n == 0 else 1 + down(n - 1)
+"""
+
+    def run_limited(self, recursion_limit: int, source: str, **names) -> vm.VirtualMachine:
+        machine = vm.VirtualMachine(stdout=io.StringIO(), recursion_limit=recursion_limit)
+        global_names = dict(vm.MAIN_NAMESPACE)
+        global_names.update(names)
+        machine.run_program(vm.load_program(compile(self.DOWN + source, '<test>', 'exec')), global_names)
+        return machine
+
+    def test_limit_counts_active_frames(self):
+        # The module frame and depth + 1 frames of down()
+        machine = self.run_limited(50, 'print(down(depth))', depth=48)
+        self.assertEqual(machine.stdout.getvalue(), '48\n')
+        with self.assertRaises(RecursionError):
+            self.run_limited(50, 'print(down(depth))', depth=49)
+
+    def test_guest_catches_the_error(self):
+        machine = self.run_limited(50, """
+try:
+    down(100)
+except RecursionError as e:
+    print('caught', e)
+print(down(40))
+""")
+        self.assertEqual(machine.stdout.getvalue(), 'caught maximum recursion depth exceeded\n40\n')
+        self.assertEqual(machine.frames, [])
+
+    def test_guest_calls_do_not_use_the_host_stack(self):
+        depth = sys.getrecursionlimit() * 10
+        machine = self.run_limited(depth + 2, 'print(down(depth))', depth=depth)
+        self.assertEqual(machine.stdout.getvalue(), '%d\n' % depth)
+
+    def test_machine_is_reused_after_error(self):
+        machine = vm.VirtualMachine(stdout=io.StringIO(), recursion_limit=50)
+        program = vm.load_program(compile(self.DOWN + 'print(down(depth))', '<test>', 'exec'))
+        with self.assertRaises(RecursionError):
+            machine.run_program(program, dict(vm.MAIN_NAMESPACE, depth=100))
+        self.assertEqual(machine.frames, [])
+        self.assertIsNone(machine.frame)
+        machine.run_program(program, dict(vm.MAIN_NAMESPACE, depth=48))
+        self.assertEqual(machine.stdout.getvalue(), '48\n')
+
+
+class OutputStreamsTest(unittest.TestCase):
+    STREAMS = """
+import sys
+print('print', name)
+print('error', name, file=sys.stderr)
+sys.stdout.write('write %s\\n' % name)
+sys.stderr.write('write error %s\\n' % name)
+"""
+
+    def run_machine(self, machine: vm.VirtualMachine, source: str, **names) -> None:
+        global_names = dict(vm.MAIN_NAMESPACE)
+        global_names.update(names)
+        machine.run_program(vm.load_program(compile(source, '<test>', 'exec')), global_names)
+
+    def test_streams_of_each_machine(self):
+        process_out, process_err = io.StringIO(), io.StringIO()
+        machines = [vm.VirtualMachine(stdout=io.StringIO(), stderr=io.StringIO()) for _ in range(2)]
+        with vm_runner.redirected(out=process_out, err=process_err):
+            for name, machine in zip('ab', machines):
+                self.run_machine(machine, self.STREAMS, name=name)
+        for name, machine in zip('ab', machines):
+            self.assertEqual(machine.stdout.getvalue(), 'print %s\nwrite %s\n' % (name, name))
+            self.assertEqual(machine.stderr.getvalue(), 'error %s\nwrite error %s\n' % (name, name))
+        self.assertEqual((process_out.getvalue(), process_err.getvalue()), ('', ''))
+
+    def test_streams_of_concurrent_machines(self):
+        source = """
+for i in range(200):
+    print(name, i)
+"""
+        machines = [vm.VirtualMachine(stdout=io.StringIO()) for _ in range(4)]
+        threads = [threading.Thread(target=self.run_machine, args=(machine, source), kwargs={'name': str(index)})
+                   for index, machine in enumerate(machines)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for index, machine in enumerate(machines):
+            self.assertEqual(machine.stdout.getvalue(), ''.join('%d %d\n' % (index, i) for i in range(200)))
+
+    def test_default_streams_are_process_streams(self):
+        process_out, process_err = io.StringIO(), io.StringIO()
+        with vm_runner.redirected(out=process_out, err=process_err):
+            self.run_machine(vm.VirtualMachine(), self.STREAMS, name='a')
+        self.assertEqual(process_out.getvalue(), 'print a\nwrite a\n')
+        self.assertEqual(process_err.getvalue(), 'error a\nwrite error a\n')
+
+    def test_guest_rebinds_only_its_machine(self):
+        stdout = io.StringIO()
+        machine = vm.VirtualMachine(stdout=stdout)
+        self.run_machine(machine, """
+import io
+import sys
+saved = sys.stdout
+sys.stdout = buffer = io.StringIO()
+print('hidden')
+sys.stdout = saved
+print('captured', repr(buffer.getvalue()))
+""")
+        self.assertIs(machine.stdout, stdout)
+        self.assertEqual(stdout.getvalue(), "captured 'hidden\\n'\n")
+        self.assertIsNot(sys.stdout, stdout)
+
+    def test_guest_sys_falls_back_to_sys(self):
+        machine = vm.VirtualMachine(stdout=io.StringIO())
+        self.run_machine(machine, """
+import sys
+print(sys.maxsize, sys.exc_info())
+try:
+    1 / 0
+except ZeroDivisionError:
+    print(sys.exc_info()[0].__name__)
+""")
+        self.assertEqual(machine.stdout.getvalue(), '%d (None, None, None)\nZeroDivisionError\n' % sys.maxsize)
+
+
+class CodeCacheTest(unittest.TestCase):
+    def test_equal_code_objects_get_own_programs(self):
+        first = compile('x = 1\ny = 2', 'first.py', 'exec')
+        same_layout = compile('x = 1\ny = 2', 'second.py', 'exec')
+        one_line = compile('x = 1; y = 2', 'first.py', 'exec')
+        self.assertEqual(first, same_layout)
+        self.assertEqual(first, one_line)
+        programs = [vm.load_program(code) for code in (first, same_layout, one_line)]
+        self.assertEqual([program.code.co_filename for program in programs], ['first.py', 'second.py', 'first.py'])
+        self.assertEqual([max(program.lines) for program in programs], [2, 2, 1])
+        self.assertIs(vm.load_program(first), programs[0])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -3,7 +3,15 @@ import dis
 import operator
 import builtins
 import collections
+import collections.abc
+import itertools
+import array
+import threading
 import sys
+import os
+import time
+
+import vm_optimizer
 
 
 def make_cell():
@@ -11,92 +19,1194 @@ def make_cell():
     return function.__closure__[0]
 
 
-Block = collections.namedtuple('Block', 'type, start, end, stack_height')
+class Block:
+    """
+    Loop, try or with statement covering an instruction, see build_blocks.
+    start is the index of its SETUP_* instruction, end the one of its handler
+    """
+    __slots__ = ('type', 'start', 'end', 'stack_height', 'parent')
+
+    def __init__(self, type, start, end, stack_height, parent=None):
+        self.type = type
+        self.start = start
+        self.end = end
+        self.stack_height = stack_height
+        self.parent = parent
+
+    def __repr__(self):
+        return 'Block(%r, %r, %r, %r)' % (self.type, self.start, self.end, self.stack_height)
+
+
+class ExceptHandler:
+    """
+    Exception being handled by a frame, pushed on its block_stack when an
+    except or finally handler starting at index start is entered
+    """
+    __slots__ = ('start', 'stack_height', 'saved_exception')
+
+    def __init__(self, start, stack_height, saved_exception):
+        self.start = start
+        self.stack_height = stack_height
+        self.saved_exception = saved_exception
+
+
+class Unwinding:
+    """
+    Reason a finally or with block runs for, kept on the stack under its
+    body: return, break or continue with the return value or continue
+    target, or 'silenced' for an exception suppressed by __exit__
+    """
+    __slots__ = ('why', 'value')
+
+    def __init__(self, why, value=None):
+        self.why = why
+        self.value = value
+
+
+SILENCED = Unwinding('silenced')
+
+
+UNARY_OPERATORS = {
+    'UNARY_POSITIVE': operator.pos,
+    'UNARY_NEGATIVE': operator.neg,
+    'UNARY_NOT': operator.not_,
+    'UNARY_INVERT': operator.inv
+}
+
+BINARY_OPERATORS = {
+    'BINARY_ADD': operator.add,
+    'BINARY_SUBTRACT': operator.sub,
+    'BINARY_MULTIPLY': operator.mul,
+    'BINARY_POWER': operator.pow,
+    'BINARY_FLOOR_DIVIDE': operator.floordiv,
+    'BINARY_TRUE_DIVIDE': operator.truediv,
+    'BINARY_MODULO': operator.mod,
+    'BINARY_SUBSCR': operator.getitem,
+    'BINARY_LSHIFT': operator.lshift,
+    'BINARY_RSHIFT': operator.rshift,
+    'BINARY_AND': operator.and_,
+    'BINARY_XOR': operator.xor,
+    'BINARY_OR': operator.or_,
+    'BINARY_MATRIX_MULTIPLY': operator.matmul,
+}
+
+INPLACE_OPERATORS = {
+    'INPLACE_ADD': operator.iadd,
+    'INPLACE_SUBTRACT': operator.isub,
+    'INPLACE_MULTIPLY': operator.imul,
+    'INPLACE_POWER': operator.ipow,
+    'INPLACE_FLOOR_DIVIDE': operator.ifloordiv,
+    'INPLACE_TRUE_DIVIDE': operator.itruediv,
+    'INPLACE_MODULO': operator.imod,
+    'INPLACE_LSHIFT': operator.ilshift,
+    'INPLACE_RSHIFT': operator.irshift,
+    'INPLACE_AND': operator.iand,
+    'INPLACE_XOR': operator.ixor,
+    'INPLACE_OR': operator.ior,
+    'INPLACE_MATRIX_MULTIPLY': operator.imatmul
+}
+
+COMPARE_OPERATORS = {
+    '<': operator.lt,
+    '<=': operator.le,
+    '>': operator.gt,
+    '>=': operator.ge,
+    '==': operator.eq,
+    '!=': operator.ne,
+    'is': operator.is_,
+    'is not': operator.is_not,
+    'in': lambda x, y: x in y,
+    'not in': lambda x, y: x not in y,
+    'isinstance': lambda x, y: issubclass(x, Exception) and issubclass(x, y),
+    'exception match': lambda x, y: issubclass(x, y),
+}
+
+JUMP_OPCODES = frozenset(dis.hasjrel + dis.hasjabs)
+
+# SETUP_* opcode -> (block type, stack height of the block relative to the
+# setup, items pushed when its handler is entered, items pushed by the setup)
+SETUP_BLOCKS = {
+    dis.opmap['SETUP_LOOP']: ('loop', 0, 0, 0),
+    dis.opmap['SETUP_EXCEPT']: ('setup-except', 0, 3, 0),
+    dis.opmap['SETUP_FINALLY']: ('finally', 0, 1, 0),
+    dis.opmap['SETUP_WITH']: ('finally', 0, 1, 1),
+    dis.opmap['SETUP_ASYNC_WITH']: ('finally', -1, 1, 0),
+}
+POP_BLOCK = dis.opmap['POP_BLOCK']
+JUMP_ABSOLUTE = dis.opmap['JUMP_ABSOLUTE']
+# Instructions doing nothing once blocks are in the exception table
+TABLE_OPCODES = frozenset(SETUP_BLOCKS) - {dis.opmap['SETUP_WITH']} | {POP_BLOCK}
+YIELD_FROM = dis.opmap['YIELD_FROM']
+
+# Other jump opcode -> (stack effect when not jumping, when jumping)
+JUMP_EFFECTS = {
+    dis.opmap['FOR_ITER']: (1, -1),
+    dis.opmap['JUMP_FORWARD']: (0, 0),
+    dis.opmap['JUMP_ABSOLUTE']: (0, 0),
+    dis.opmap['CONTINUE_LOOP']: (0, 0),
+    dis.opmap['POP_JUMP_IF_FALSE']: (-1, -1),
+    dis.opmap['POP_JUMP_IF_TRUE']: (-1, -1),
+    dis.opmap['JUMP_IF_FALSE_OR_POP']: (-1, 0),
+    dis.opmap['JUMP_IF_TRUE_OR_POP']: (-1, 0),
+}
+
+BUILTINS = vars(builtins)
+
+# Source of AttributeCache.types_version
+type_versions = itertools.count(1)
+
+OPNAMES = list(dis.opname)
+
+
+def instruction_group(opname):
+    """
+    :param opname: name of an opcode
+    :return: name of the shared handler for arithmetic opcodes, opname otherwise
+    """
+    if opname in UNARY_OPERATORS:
+        return 'UNARY_OP'
+    if opname in BINARY_OPERATORS:
+        return 'BINARY_OP'
+    if opname in INPLACE_OPERATORS:
+        return 'INPLACE_OP'
+    return opname
+
+
+# Runs of instructions fused into one dispatch, longest first; chosen with
+# python -m benchmarks.sequences. Arithmetic opcodes match by their group
+FUSED_SEQUENCES = [
+    ('LOAD_FAST', 'LOAD_CONST', 'BINARY_OP'),
+    ('LOAD_FAST', 'LOAD_FAST', 'BINARY_OP'),
+    ('LOAD_FAST', 'LOAD_FAST'),
+    ('LOAD_FAST', 'LOAD_CONST'),
+    ('LOAD_FAST', 'LOAD_ATTR'),
+    ('LOAD_FAST', 'LOAD_METHOD'),
+    ('STORE_FAST', 'LOAD_FAST'),
+    ('LOAD_CONST', 'BINARY_OP'),
+    ('FOR_ITER', 'STORE_FAST'),
+    ('COMPARE_OP', 'POP_JUMP_IF_FALSE'),
+    ('COMPARE_OP', 'POP_JUMP_IF_TRUE'),
+    ('LOAD_CONST', 'RETURN_VALUE'),
+]
+
+# Synthetic opcode ids follow the real ones
+SUPERINSTRUCTIONS = collections.OrderedDict(
+    (sequence, len(dis.opname) + number) for number, sequence in enumerate(FUSED_SEQUENCES))
+OPNAMES.extend('__'.join(sequence) for sequence in FUSED_SEQUENCES)
+# Superinstruction opcode -> number of instructions it runs
+FUSED_LENGTHS = {opcode: len(sequence) for sequence, opcode in SUPERINSTRUCTIONS.items()}
+# Superinstructions which run only their first instruction when it jumps
+FUSED_JUMP_STARTS = frozenset(opcode for sequence, opcode in SUPERINSTRUCTIONS.items()
+                              if dis.opmap.get(sequence[0]) in dis.hasjrel + dis.hasjabs)
+
+
+def fuse_superinstructions(entries, blocks):
+    """
+    Replace the first instruction of every run listed in SUPERINSTRUCTIONS
+    with the fused one, leaving the rest of the run in place. An exception
+    raised by a fused instruction is handled by the block of the first one,
+    so runs spanning several blocks or reaching into a handler are not fused
+    :param entries: decoded instructions as [opcode, argument, line]
+    :param blocks: exception table of entries, see build_blocks
+    :return: new list of entries of the same length
+    """
+    groups = [instruction_group(OPNAMES[opcode]) for opcode, _, _ in entries]
+    handlers = {block.end for block in blocks if block is not None and block.type != 'loop'}
+
+    def fusable(start, end):
+        return all(blocks[index] is blocks[start] and index not in handlers for index in range(start + 1, end))
+
+    fused = []
+    for index, entry in enumerate(entries):
+        for sequence, opcode in SUPERINSTRUCTIONS.items():
+            end = index + len(sequence)
+            if tuple(groups[index:end]) == sequence and fusable(index, end):
+                arguments = tuple(argument for _, argument, _ in entries[index:end])
+                fused.append([opcode, arguments, entry[2]])
+                break
+        else:
+            fused.append(entry)
+    return fused
+
+
+# Adaptive specialization: arithmetic and comparisons, alone or ending a
+# fused run, are loaded as ADAPTIVE_* handlers which count down ADAPTIVE_WARMUP executions
+# and then rewrite program.opcodes to a handler specialized for the operand
+# types seen, or to the generic one when there is none. A specialized
+# handler whose type guard fails runs the generic code and goes back to the
+# adaptive handler for ADAPTIVE_BACKOFF more executions
+ADAPTIVE_WARMUP = 8
+ADAPTIVE_BACKOFF = 64
+
+QUICKENED_HANDLERS = [
+    'ADAPTIVE_BINARY_OP',
+    'ADAPTIVE_COMPARE_JUMP',
+    'BINARY_ADD_INT',
+    'BINARY_SUBTRACT_INT',
+    'BINARY_MULTIPLY_INT',
+    'BINARY_ADD_FLOAT',
+    'BINARY_SUBTRACT_FLOAT',
+    'BINARY_MULTIPLY_FLOAT',
+    'BINARY_TRUE_DIVIDE_FLOAT',
+    'BINARY_ADD_STR',
+    'BINARY_SUBSCR_LIST_INT',
+    'BINARY_SUBSCR_DICT',
+    'COMPARE_LT_INT__POP_JUMP_IF_FALSE',
+    'COMPARE_LE_INT__POP_JUMP_IF_FALSE',
+    'COMPARE_GT_INT__POP_JUMP_IF_FALSE',
+    'COMPARE_GE_INT__POP_JUMP_IF_FALSE',
+    'COMPARE_EQ_INT__POP_JUMP_IF_FALSE',
+    'COMPARE_NE_INT__POP_JUMP_IF_FALSE',
+    'ADAPTIVE_COMPARE_OP',
+    'COMPARE_LT_INT',
+    'COMPARE_LE_INT',
+    'COMPARE_GT_INT',
+    'COMPARE_GE_INT',
+    'COMPARE_EQ_INT',
+    'COMPARE_NE_INT',
+]
+
+# Fused runs ending with arithmetic, specialized for the operations below as
+# run__operation, e.g. LOAD_FAST__LOAD_CONST__BINARY_ADD_INT
+FUSED_BINARY_RUNS = ['LOAD_CONST', 'LOAD_FAST__LOAD_CONST', 'LOAD_FAST__LOAD_FAST']
+FUSED_BINARY_OPERATIONS = ['BINARY_ADD_INT', 'BINARY_SUBTRACT_INT', 'BINARY_MULTIPLY_INT',
+                           'BINARY_ADD_FLOAT', 'BINARY_SUBTRACT_FLOAT', 'BINARY_MULTIPLY_FLOAT']
+for run in FUSED_BINARY_RUNS:
+    QUICKENED_HANDLERS.append('ADAPTIVE_{}__BINARY_OP'.format(run))
+    QUICKENED_HANDLERS.extend('{}__{}'.format(run, name) for name in FUSED_BINARY_OPERATIONS)
+
+QUICKENED = collections.OrderedDict(
+    (opname, len(OPNAMES) + number) for number, opname in enumerate(QUICKENED_HANDLERS))
+OPNAMES.extend(QUICKENED_HANDLERS)
+
+# Generic opcode -> adaptive opcode it is loaded as
+ADAPTIVE_OPCODES = {opcode: QUICKENED['ADAPTIVE_BINARY_OP'] for opname, opcode in dis.opmap.items()
+                    if opname in BINARY_OPERATORS or opname in INPLACE_OPERATORS}
+ADAPTIVE_OPCODES[SUPERINSTRUCTIONS['COMPARE_OP', 'POP_JUMP_IF_FALSE']] = QUICKENED['ADAPTIVE_COMPARE_JUMP']
+ADAPTIVE_OPCODES[dis.opmap['COMPARE_OP']] = QUICKENED['ADAPTIVE_COMPARE_OP']
+for run in FUSED_BINARY_RUNS:
+    sequence = tuple(run.split('__')) + ('BINARY_OP',)
+    ADAPTIVE_OPCODES[SUPERINSTRUCTIONS[sequence]] = QUICKENED['ADAPTIVE_{}__BINARY_OP'.format(run)]
+
+# Python 3.6 does not emit LOAD_METHOD / CALL_METHOD: the loader turns a
+# LOAD_ATTR and the CALL_FUNCTION calling its result into these
+LOAD_METHOD = len(OPNAMES)
+CALL_METHOD = LOAD_METHOD + 1
+OPNAMES.extend(['LOAD_METHOD', 'CALL_METHOD'])
+
+# Every loop iteration goes through a JUMP_BACKWARD, which counts down
+# VirtualMachine.countdown: the loader turns backward JUMP_ABSOLUTE into it
+# and sends backward conditional jumps to one appended after the code
+JUMP_BACKWARD = len(OPNAMES)
+OPNAMES.append('JUMP_BACKWARD')
+CONDITIONAL_JUMPS = frozenset(dis.opmap[opname] for opname in (
+    'POP_JUMP_IF_FALSE', 'POP_JUMP_IF_TRUE', 'JUMP_IF_FALSE_OR_POP', 'JUMP_IF_TRUE_OR_POP'))
+
+# Size limit of the per instruction type table of AttributeCache
+ATTRIBUTE_CACHE_SIZE = 8
+
+# (operation, left type, right type) -> specialized handler; None matches any type.
+# In-place operations on immutable types are the same as binary ones
+BINARY_SPECIALIZATIONS = {
+    (operator.add, int, int): 'BINARY_ADD_INT',
+    (operator.iadd, int, int): 'BINARY_ADD_INT',
+    (operator.sub, int, int): 'BINARY_SUBTRACT_INT',
+    (operator.isub, int, int): 'BINARY_SUBTRACT_INT',
+    (operator.mul, int, int): 'BINARY_MULTIPLY_INT',
+    (operator.imul, int, int): 'BINARY_MULTIPLY_INT',
+    (operator.add, float, float): 'BINARY_ADD_FLOAT',
+    (operator.iadd, float, float): 'BINARY_ADD_FLOAT',
+    (operator.sub, float, float): 'BINARY_SUBTRACT_FLOAT',
+    (operator.isub, float, float): 'BINARY_SUBTRACT_FLOAT',
+    (operator.mul, float, float): 'BINARY_MULTIPLY_FLOAT',
+    (operator.imul, float, float): 'BINARY_MULTIPLY_FLOAT',
+    (operator.truediv, float, float): 'BINARY_TRUE_DIVIDE_FLOAT',
+    (operator.itruediv, float, float): 'BINARY_TRUE_DIVIDE_FLOAT',
+    (operator.add, str, str): 'BINARY_ADD_STR',
+    (operator.iadd, str, str): 'BINARY_ADD_STR',
+    (operator.getitem, list, int): 'BINARY_SUBSCR_LIST_INT',
+    (operator.getitem, dict, None): 'BINARY_SUBSCR_DICT',
+}
+
+# Specializations of fused runs ending with arithmetic, keyed by the run
+FUSED_BINARY_SPECIALIZATIONS = {
+    run: {key: '{}__{}'.format(run, name) for key, name in BINARY_SPECIALIZATIONS.items()
+          if name in FUSED_BINARY_OPERATIONS}
+    for run in FUSED_BINARY_RUNS
+}
+
+COMPARE_SPECIALIZATIONS = {
+    (operator.lt, int, int): 'COMPARE_LT_INT',
+    (operator.le, int, int): 'COMPARE_LE_INT',
+    (operator.gt, int, int): 'COMPARE_GT_INT',
+    (operator.ge, int, int): 'COMPARE_GE_INT',
+    (operator.eq, int, int): 'COMPARE_EQ_INT',
+    (operator.ne, int, int): 'COMPARE_NE_INT',
+}
+
+COMPARE_JUMP_SPECIALIZATIONS = {
+    (operator.lt, int, int): 'COMPARE_LT_INT__POP_JUMP_IF_FALSE',
+    (operator.le, int, int): 'COMPARE_LE_INT__POP_JUMP_IF_FALSE',
+    (operator.gt, int, int): 'COMPARE_GT_INT__POP_JUMP_IF_FALSE',
+    (operator.ge, int, int): 'COMPARE_GE_INT__POP_JUMP_IF_FALSE',
+    (operator.eq, int, int): 'COMPARE_EQ_INT__POP_JUMP_IF_FALSE',
+    (operator.ne, int, int): 'COMPARE_NE_INT__POP_JUMP_IF_FALSE',
+}
+
+
+CacheStats = collections.namedtuple('CacheStats', 'hits, misses, evictions, size, maxsize')
+
+
+class Program:
+    """
+    Decoded form of a code object, shared by every frame executing it.
+    Instructions are stored as parallel arrays of opcode ids and indexes
+    into the constants side table holding decoded arguments.
+    With optimize set the peephole pass of vm_optimizer runs before packing,
+    with superinstructions set frequent runs of instructions are fused,
+    with adaptive set arithmetic and comparisons are specialized by operand
+    types at run time
+    """
+    __slots__ = ('code', 'opcodes', 'arguments', 'constants', 'lines', 'free_frames', 'eliminated',
+                 'generic_opcodes', 'warmup', 'blocks')
+
+    def __init__(self, code, optimize=False, superinstructions=False, adaptive=False):
+        self.code = code
+        self.free_frames = []
+        instructions = list(dis.get_instructions(code))
+        positions = {instruction.offset: index for index, instruction in enumerate(instructions)}
+        method_calls = pair_method_calls(instructions)
+        calls = set(method_calls.values())
+        entries = []
+        line = code.co_firstlineno
+        for index, instruction in enumerate(instructions):
+            if instruction.starts_line is not None:
+                line = instruction.starts_line
+            opcode = instruction.opcode
+            argument = decode_argument(instruction)
+            if opcode in JUMP_OPCODES:
+                argument = positions[argument]
+            if index in method_calls:
+                opcode = LOAD_METHOD
+                argument = AttributeCache(instruction.argval, METHOD_TYPES)
+            elif index in calls:
+                opcode = CALL_METHOD
+            entries.append([opcode, argument, line])
+        self.eliminated = 0
+        if optimize:
+            # Count only what the peephole pass removes: it drops EXTENDED_ARG
+            # prefixes as well and block setups are dropped below either way
+            loaded = sum(1 for opcode, _, _ in entries if opcode != vm_optimizer.EXTENDED_ARG)
+            entries = vm_optimizer.optimize(entries)
+            self.eliminated = loaded - len(entries)
+        self.blocks = build_blocks(entries)
+        if optimize:
+            entries, self.blocks = remove_block_setups(entries, self.blocks)
+        mark_backward_jumps(entries, self.blocks)
+        if superinstructions:
+            entries = fuse_superinstructions(entries, self.blocks)
+
+        self.opcodes = array.array('H')
+        self.arguments = array.array('I')
+        self.constants = []
+        self.lines = array.array('I')
+        constant_indexes = {}
+        for opcode, argument, line in entries:
+            key = id(argument)
+            if key not in constant_indexes:
+                constant_indexes[key] = len(self.constants)
+                self.constants.append(argument)
+            self.opcodes.append(opcode)
+            self.arguments.append(constant_indexes[key])
+            self.lines.append(line)
+
+        # opcodes are rewritten while running, generic_opcodes keep what was loaded
+        self.generic_opcodes = self.opcodes
+        self.warmup = None
+        if adaptive:
+            self.generic_opcodes = array.array('H', self.opcodes)
+            self.warmup = array.array('H', [ADAPTIVE_WARMUP]) * len(self.opcodes)
+            for index, opcode in enumerate(self.generic_opcodes):
+                if opcode in ADAPTIVE_OPCODES:
+                    self.opcodes[index] = ADAPTIVE_OPCODES[opcode]
+
+    def __len__(self):
+        return len(self.opcodes)
+
+
+def decode_argument(instruction):
+    """
+    Resolve instruction argument to the value its handler works with
+    :param instruction: disassembled instruction
+    :return: operator function for arithmetic and comparisons, argval otherwise
+    """
+    opname = instruction.opname
+    if opname in UNARY_OPERATORS:
+        return UNARY_OPERATORS[opname]
+    if opname in BINARY_OPERATORS:
+        return BINARY_OPERATORS[opname]
+    if opname in INPLACE_OPERATORS:
+        return INPLACE_OPERATORS[opname]
+    if opname == 'COMPARE_OP':
+        return COMPARE_OPERATORS[instruction.argval]
+    if instruction.opcode in dis.haslocal:
+        return instruction.arg
+    if opname in ('LOAD_GLOBAL', 'LOAD_NAME'):
+        return NameCache(instruction.argval)
+    if opname == 'LOAD_ATTR':
+        return AttributeCache(instruction.argval, (Function,))
+    return instruction.argval
+
+
+def stack_use(instruction):
+    """
+    :param instruction: disassembled instruction
+    :return: (popped, pushed) number of items for instructions which may stand
+             between a LOAD_ATTR and the call of its result, None for others
+    """
+    opname = instruction.opname
+    arg = instruction.arg
+    if opname == 'LOAD_ATTR' or opname in UNARY_OPERATORS:
+        return 1, 1
+    if opname.startswith('LOAD_'):
+        return 0, 1
+    if opname in BINARY_OPERATORS or opname in INPLACE_OPERATORS or opname == 'COMPARE_OP':
+        return 2, 1
+    if opname in ('BUILD_TUPLE', 'BUILD_LIST', 'BUILD_SET', 'BUILD_STRING', 'BUILD_SLICE'):
+        return arg, 1
+    if opname == 'BUILD_MAP':
+        return 2 * arg, 1
+    if opname == 'BUILD_CONST_KEY_MAP':
+        return arg + 1, 1
+    if opname == 'CALL_FUNCTION':
+        return arg + 1, 1
+    if opname == 'CALL_FUNCTION_KW':
+        return arg + 2, 1
+    if opname == 'FORMAT_VALUE':
+        return (2 if arg & 0x04 else 1), 1
+    return None
+
+
+def pair_method_calls(instructions):
+    """
+    Find LOAD_ATTR instructions whose result is called by a CALL_FUNCTION in
+    the same straight-line run of code
+    :param instructions: disassembled instructions of a code object
+    :return: {LOAD_ATTR index: CALL_FUNCTION index}
+    """
+    targets = {instruction.argval for instruction in instructions if instruction.opcode in JUMP_OPCODES}
+    pairs = {}
+    for index, instruction in enumerate(instructions):
+        if instruction.opname != 'LOAD_ATTR':
+            continue
+        # items pushed above the loaded attribute
+        depth = 0
+        for position in range(index + 1, len(instructions)):
+            following = instructions[position]
+            if following.offset in targets:
+                break
+            if following.opname == 'CALL_FUNCTION' and following.arg == depth:
+                pairs[index] = position
+                break
+            use = stack_use(following)
+            if use is None or use[0] > depth:
+                break
+            depth += use[1] - use[0]
+    return pairs
+
+
+def stack_effect(opcode, argument):
+    """
+    :param opcode: opcode of a decoded instruction other than a jump
+    :param argument: its decoded argument
+    :return: change of the stack height made by the instruction
+    """
+    if opcode == LOAD_METHOD:
+        return 1
+    if opcode == CALL_METHOD:
+        return -argument - 1
+    opname = OPNAMES[opcode]
+    if opname in ('NOP', 'EXTENDED_ARG'):
+        return 0
+    # Finally and with blocks keep one item on the stack for how they were entered
+    if opname == 'WITH_CLEANUP_START':
+        return 0
+    if opname == 'FORMAT_VALUE':
+        return -1 if argument[1] else 0
+    if opcode < dis.HAVE_ARGUMENT:
+        return dis.stack_effect(opcode)
+    if type(argument) is not int or opcode in dis.hasconst:
+        argument = 0
+    return dis.stack_effect(opcode, argument)
+
+
+def build_blocks(entries):
+    """
+    Exception table of a program. Instead of pushing a Block when a loop,
+    try or with statement is entered, every instruction is mapped to the
+    innermost one covering it, with the stack height its handler starts at,
+    by following control flow from the entry point
+    :param entries: decoded instructions as [opcode, argument, line]
+    :return: innermost Block or None for every instruction
+    """
+    depths = [None] * len(entries)
+    blocks = [None] * len(entries)
+    # (index, stack height, innermost block) to follow control flow from
+    pending = [(0, 0, None)]
+    while pending:
+        index, depth, block = pending.pop()
+        while index < len(entries):
+            # Heights differ only after an END_FINALLY of except clauses
+            # none of which matched: it reraises and never falls through
+            if depths[index] is not None and depths[index] <= depth:
+                break
+            depths[index] = depth
+            blocks[index] = block
+            opcode, argument, _ = entries[index]
+            if opcode in SETUP_BLOCKS:
+                block_type, height, handler_items, pushed = SETUP_BLOCKS[opcode]
+                pending.append((argument, depth + height + handler_items, block))
+                block = Block(block_type, index, argument, depth + height, block)
+                depth += pushed
+            elif opcode == POP_BLOCK:
+                block = block.parent if block is not None else None
+            elif opcode in JUMP_EFFECTS:
+                effect, jump_effect = JUMP_EFFECTS[opcode]
+                pending.append((argument, depth + jump_effect, block))
+                depth += effect
+            else:
+                depth += stack_effect(opcode, argument)
+            if opcode in vm_optimizer.TERMINATORS:
+                break
+            index += 1
+    return blocks
+
+
+def remove_block_setups(entries, blocks):
+    """
+    Drop instructions entering and leaving blocks, the exception table
+    already has everything they did
+    :param entries: decoded instructions as [opcode, argument, line]
+    :param blocks: exception table built by build_blocks
+    :return: entries and exception table with indexes remapped
+    """
+    entries, positions = vm_optimizer.remove(entries, TABLE_OPCODES)
+    remapped = {None: None}
+
+    def remap(block):
+        if block not in remapped:
+            remapped[block] = Block(block.type, positions[block.start], positions[block.end],
+                                    block.stack_height, remap(block.parent))
+        return remapped[block]
+
+    kept = [block for index, block in enumerate(blocks) if positions[index + 1] != positions[index]]
+    return entries, [remap(block) for block in kept]
+
+
+def mark_backward_jumps(entries, blocks):
+    """
+    Route every backward jump through JUMP_BACKWARD. Conditional jumps go
+    forward to a JUMP_BACKWARD appended for their target, so that the
+    countdown costs nothing when they fall through
+    :param entries: decoded instructions as [opcode, argument, line], changed in place
+    :param blocks: exception table, extended for appended instructions
+    """
+    stubs = {}
+    for index in range(len(entries)):
+        entry = entries[index]
+        opcode, target, line = entry
+        if opcode not in JUMP_OPCODES or target > index:
+            continue
+        if opcode == JUMP_ABSOLUTE:
+            entry[0] = JUMP_BACKWARD
+        elif opcode in CONDITIONAL_JUMPS:
+            if target not in stubs:
+                stubs[target] = len(entries)
+                entries.append([JUMP_BACKWARD, target, line])
+                blocks.append(blocks[target])
+            entry[1] = stubs[target]
+
+
+class NameCache:
+    """
+    Inline cache of LOAD_GLOBAL / LOAD_NAME. Resolved values are kept by the
+    virtual machine in cached_names keyed by the cache, not here: programs
+    outlive runs in the CodeCache and would keep guest objects alive
+    """
+    __slots__ = ('name',)
+
+    def __init__(self, name):
+        self.name = name
+
+
+class AttributeCache:
+    """
+    Inline cache of LOAD_ATTR / LOAD_METHOD keyed by type of the object:
+    type -> (function of one of method_types found on the type, None for
+    any other attribute; whether instances have a __dict__ which may shadow
+    it). Every cache is emptied once a guest changes attributes of a class
+    with an attribute statement, setattr() or delattr(); host code and
+    type.__setattr__ go around that and must call invalidate() themselves.
+    Handlers check an entry inline: types.get(type(obj)) is valid while
+    version is current, fill() takes care of everything else
+    """
+    __slots__ = ('name', 'method_types', 'version', 'types')
+    types_version = 0
+
+    def __init__(self, name, method_types):
+        self.name = name
+        self.method_types = method_types
+        self.version = AttributeCache.types_version
+        self.types = {}
+
+    @staticmethod
+    def invalidate():
+        AttributeCache.types_version = next(type_versions)
+
+    def fill(self, kind):
+        if self.version != AttributeCache.types_version:
+            self.version = AttributeCache.types_version
+            self.types = {}
+        function = None
+        has_dict = kind.__dictoffset__ != 0
+        # Some extension types keep an instance dict without exposing __dict__
+        exposed = not has_dict or any('__dict__' in klass.__dict__ for klass in kind.__mro__)
+        if kind.__getattribute__ is object.__getattribute__ and not issubclass(kind, type) and exposed:
+            for klass in kind.__mro__:
+                if self.name in klass.__dict__:
+                    attribute = klass.__dict__[self.name]
+                    if isinstance(attribute, self.method_types):
+                        function = attribute
+                    break
+        entry = function, has_dict
+        if len(self.types) < ATTRIBUTE_CACHE_SIZE:
+            self.types[kind] = entry
+        return entry
+
+
+class CodeCache:
+    """
+    Process-wide LRU cache of decoded programs keyed by code object identity:
+    equal code objects may differ in file name and line numbers. A program
+    keeps its code object alive, so the id is not reused while cached.
+    Programs are optimized, get superinstructions and adaptive handlers
+    unless those are switched off; clear the cache after switching so that
+    programs decoded before are dropped
+    """
+    def __init__(self, maxsize=1024, optimize=True, superinstructions=True, adaptive=True):
+        self.maxsize = maxsize
+        self.optimize = optimize
+        self.superinstructions = superinstructions
+        self.adaptive = adaptive
+        self._programs = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, code):
+        key = id(code)
+        with self._lock:
+            program = self._programs.get(key)
+            if program is not None:
+                self._programs.move_to_end(key)
+                self.hits += 1
+                return program
+            self.misses += 1
+        program = Program(code, optimize=self.optimize, superinstructions=self.superinstructions,
+                          adaptive=self.adaptive)
+        with self._lock:
+            self._programs[key] = program
+            while len(self._programs) > self.maxsize:
+                self._programs.popitem(last=False)
+                self.evictions += 1
+        return program
+
+    def clear(self):
+        with self._lock:
+            self._programs.clear()
+            self.hits = self.misses = self.evictions = 0
+
+    def programs(self):
+        with self._lock:
+            return list(self._programs.values())
+
+    def stats(self):
+        return CacheStats(self.hits, self.misses, self.evictions, len(self._programs), self.maxsize)
+
+    def __len__(self):
+        return len(self._programs)
+
+
+# VM_OPTIMIZE=0 / VM_SUPERINSTRUCTIONS=0 / VM_ADAPTIVE=0 in the environment
+# turn off the peephole optimizer / fusing of frequent instruction runs /
+# type specialization of arithmetic
+code_cache = CodeCache(optimize=os.environ.get('VM_OPTIMIZE', '1') != '0',
+                       superinstructions=os.environ.get('VM_SUPERINSTRUCTIONS', '1') != '0',
+                       adaptive=os.environ.get('VM_ADAPTIVE', '1') != '0')
+
+
+def load_program(code):
+    return code_cache.get(code)
+
+
+NULL = object()
+# Returned by run_frame when a slice of VirtualMachine.resume ran out
+PREEMPTED = object()
+
+CO_OPTIMIZED = 0x1
+CO_VARARGS = 0x4
+CO_VARKEYWORDS = 0x8
+CO_GENERATOR = 0x20
+CO_COROUTINE = 0x80
+CO_ITERABLE_COROUTINE = 0x100
+
+
+FRAME_FREE_LIST_SIZE = 8
+
+# Globals a program starts with when run as the main module
+MAIN_NAMESPACE = {
+    '__name__': '__main__',
+    '__doc__': None,
+    '__package__': None,
+    '__spec__': None,
+    '__loader__': None
+}
+
+# Guest recursion does not nest host calls, so the limit is the machine's own
+DEFAULT_RECURSION_LIMIT = 10000
+
+# Ticks between clock reads when a run has a time limit
+CLOCK_TICKS = 1000
+
+
+class BudgetExceeded(Exception):
+    """
+    Raised out of a run which used up its instruction budget or time limit.
+    Guest except and finally clauses do not see it
+    """
+    def __init__(self, resource, limit, used):
+        """
+        :param resource: 'instructions' or 'time'
+        :param limit: instruction budget in ticks or time limit in seconds
+        :param used: ticks or seconds used by the run
+        """
+        super().__init__('%s limit of %s exceeded' % (resource, limit))
+        self.resource = resource
+        self.limit = limit
+        self.used = used
 
 
 class Frame:
-    def __init__(self, code, global_names={}, local_names={}, previous_frame=None):
+    __slots__ = ('stack', 'code', 'previous_frame', 'global_names', 'local_names', 'fast_locals',
+                 'last_instruction', 'block_stack', 'program', 'cells', 'generator')
+
+    def __init__(self, code, global_names={}, local_names=None, previous_frame=None, program=None,
+                 fast_locals=None, closure=None):
         self.stack = []
+        self.block_stack = []
         self.code = code
+        if program is None:
+            program = load_program(code)
+        self.program = program
+        self.reset(global_names, local_names, previous_frame, fast_locals, closure)
+
+    @classmethod
+    def acquire(cls, program, global_names, local_names=None, previous_frame=None, fast_locals=None,
+                closure=None):
+        """
+        Take a frame from the free-list of the program or create a new one
+        """
+        try:
+            frame = program.free_frames.pop()
+        except IndexError:
+            return cls(program.code, global_names, local_names, previous_frame, program, fast_locals, closure)
+        frame.reset(global_names, local_names, previous_frame, fast_locals, closure)
+        return frame
+
+    def release(self):
+        """
+        Drop references of a finished frame and keep it for reuse by the next call
+        """
+        free_frames = self.program.free_frames
+        if len(free_frames) < FRAME_FREE_LIST_SIZE:
+            self.stack.clear()
+            self.block_stack.clear()
+            self.previous_frame = self.global_names = self.local_names = None
+            self.fast_locals = self.cells = self.generator = None
+            free_frames.append(self)
+
+    def reset(self, global_names, local_names, previous_frame, fast_locals, closure):
+        code = self.code
         self.previous_frame = previous_frame
         self.global_names = global_names
         self.local_names = local_names
-        self.builtin_names = dir(builtins)
+        if fast_locals is None:
+            fast_locals = [NULL] * code.co_nlocals
+        self.fast_locals = fast_locals
         self.last_instruction = 0
-        self.block_stack = []
-        self.bytecode = dis.Bytecode(self.code)
-        self.instructions = {}
-        for instruction in self.bytecode:
-            self.instructions[instruction.offset] = instruction
-        self.max_offset = max(self.instructions.keys())
+        self.generator = None
 
-        if code.co_cellvars:
+        if code.co_cellvars or code.co_freevars:
             self.cells = {}
-            if not previous_frame.cells:
-                previous_frame.cells = {}
             for var in code.co_cellvars:
-                cell = Cell(self.local_names.get(var))
-                previous_frame.cells[var] = self.cells[var] = cell
+                self.cells[var] = Cell(self.get_local(var))
+            for var, cell in zip(code.co_freevars, closure or ()):
+                self.cells[var] = cell
         else:
             self.cells = None
 
-        if code.co_freevars:
-            if not self.cells:
-                self.cells = {}
-            for var in code.co_freevars:
-                assert self.cells is not None
-                assert previous_frame.cells, "previous_frame.cells: %r" % (previous_frame.cells,)
-                self.cells[var] = previous_frame.cells[var]
+    def get_local(self, name, default=None):
+        if self.local_names is not None:
+            return self.local_names.get(name, default)
+        if name in self.code.co_varnames:
+            value = self.fast_locals[self.code.co_varnames.index(name)]
+            if value is not NULL:
+                return value
+        return default
+
+    def locals(self):
+        """
+        Build locals dict on demand, fast locals are copied into it
+        :return: mapping of local variable names to values
+        """
+        if self.local_names is not None:
+            return self.local_names
+        local_names = {name: value for name, value in zip(self.code.co_varnames, self.fast_locals)
+                       if value is not NULL}
+        if self.cells:
+            for name, cell in self.cells.items():
+                if hasattr(cell, 'contents'):
+                    local_names[name] = cell.contents
+        return local_names
 
     def frame_info(self):
         print(self.stack)
-        print(self.local_names)
+        print(self.locals())
         print(self.block_stack)
         print('<----------------------->')
 
 
+class BindingPlan:
+    """
+    Precomputed recipe for binding call arguments to fast locals slots
+    """
+    __slots__ = ('name', 'nlocals', 'argcount', 'kwonlycount', 'varargs_slot', 'varkwargs_slot',
+                 'defaults', 'defaults_offset', 'kwonly_defaults', 'keyword_slots', 'names', 'padding', 'simple')
+
+    def __init__(self, code, defaults, kwonly_defaults):
+        self.name = code.co_name
+        self.nlocals = code.co_nlocals
+        self.argcount = code.co_argcount
+        self.kwonlycount = code.co_kwonlyargcount
+        slot = self.argcount + self.kwonlycount
+        self.varargs_slot = None
+        self.varkwargs_slot = None
+        if code.co_flags & CO_VARARGS:
+            self.varargs_slot = slot
+            slot += 1
+        if code.co_flags & CO_VARKEYWORDS:
+            self.varkwargs_slot = slot
+        self.defaults = tuple(defaults or ())
+        self.defaults_offset = self.argcount - len(self.defaults)
+        self.kwonly_defaults = dict(kwonly_defaults or {})
+        self.names = code.co_varnames[:self.argcount + self.kwonlycount]
+        self.keyword_slots = {name: index for index, name in enumerate(self.names)}
+        self.padding = [NULL] * (self.nlocals - self.argcount)
+        self.simple = not (self.kwonlycount or self.varargs_slot is not None or self.varkwargs_slot is not None)
+
+    def bind(self, args, kwargs):
+        """
+        General binding for any call shape
+        :param args: positional arguments tuple
+        :param kwargs: keyword arguments dict
+        :return: fast locals list of a new frame
+        """
+        fast_locals = [NULL] * self.nlocals
+        argcount = self.argcount
+        nargs = len(args)
+        if nargs > argcount:
+            if self.varargs_slot is None:
+                raise TypeError("%s() takes %d positional arguments but %d were given"
+                                % (self.name, argcount, nargs))
+            fast_locals[:argcount] = args[:argcount]
+            fast_locals[self.varargs_slot] = tuple(args[argcount:])
+        else:
+            fast_locals[:nargs] = args
+            if self.varargs_slot is not None:
+                fast_locals[self.varargs_slot] = ()
+
+        extra = None
+        if self.varkwargs_slot is not None:
+            extra = fast_locals[self.varkwargs_slot] = {}
+        for name, value in kwargs.items():
+            slot = self.keyword_slots.get(name)
+            if slot is None:
+                if extra is None:
+                    raise TypeError("%s() got an unexpected keyword argument '%s'" % (self.name, name))
+                extra[name] = value
+            elif fast_locals[slot] is not NULL:
+                raise TypeError("%s() got multiple values for argument '%s'" % (self.name, name))
+            else:
+                fast_locals[slot] = value
+
+        missing = [self.names[slot] for slot in range(nargs, self.defaults_offset) if fast_locals[slot] is NULL]
+        if missing:
+            raise self.missing_arguments(missing, 'positional')
+        for slot in range(max(nargs, self.defaults_offset), argcount):
+            if fast_locals[slot] is NULL:
+                fast_locals[slot] = self.defaults[slot - self.defaults_offset]
+        for slot in range(argcount, argcount + self.kwonlycount):
+            if fast_locals[slot] is NULL:
+                name = self.names[slot]
+                if name not in self.kwonly_defaults:
+                    missing.append(name)
+                else:
+                    fast_locals[slot] = self.kwonly_defaults[name]
+        if missing:
+            raise self.missing_arguments(missing, 'keyword-only')
+        return fast_locals
+
+    def missing_arguments(self, names, kind):
+        """
+        :return: TypeError worded as by CPython's missing_arguments
+        """
+        quoted = ["'%s'" % name for name in names]
+        if len(quoted) == 1:
+            listed = quoted[0]
+        elif len(quoted) == 2:
+            listed = '%s and %s' % tuple(quoted)
+        else:
+            listed = '%s, and %s' % (', '.join(quoted[:-1]), quoted[-1])
+        return TypeError("%s() missing %d required %s argument%s: %s"
+                         % (self.name, len(names), kind, '' if len(names) == 1 else 's', listed))
+
+
 class Function:
+    __slots__ = ('code', 'vm', '__name__', 'name', 'defaults', 'kwonly_defaults', 'annotations', 'cells',
+                 'closure', 'global_names', 'program', 'plan', 'generator_class', '__dict__')
+
     def __init__(self, code, name, defaults, kwonly_defaults, annotations, cells, closure, vm):
         self.code = code
         self.vm = vm
-        self.argcount = self.code.co_argcount
-        self.varnames = self.code.co_varnames
+        self.__name__ = code.co_name
+        self.name = name
         self.defaults = defaults  # tuple
         self.kwonly_defaults = kwonly_defaults
         self.annotations = annotations
         self.cells = cells
         self.closure = closure
-        self.has_args = False
-        self.has_kwargs = False
-        if code.co_flags & 0x4:
-            self.has_args = True
-        if code.co_flags & 0x08:
-            self.has_kwargs = True
+        self.global_names = vm.frame.global_names
+        self.program = load_program(code)
+        self.plan = BindingPlan(code, defaults, kwonly_defaults)
+        # Calling a generator or coroutine function only creates its suspended frame
+        if code.co_flags & CO_COROUTINE:
+            self.generator_class = Coroutine
+        elif code.co_flags & CO_GENERATOR:
+            self.generator_class = Generator
+        else:
+            self.generator_class = None
 
-    def __call__(self, *args, **kwargs):
-        args = list(args)
-        if self.defaults:
-            args.extend(list(self.defaults[0]))
-        if args:
-            callargs = {varname: value for varname, value in zip(self.varnames[0:self.argcount], args)}
+    def frame_for(self, args, kwargs=None):
+        """
+        :param args: positional arguments sequence
+        :param kwargs: keyword arguments dict or None
+        :return: frame of a call with bound arguments, called from the current frame
+        """
+        plan = self.plan
+        if plan.simple and not kwargs and len(args) == plan.argcount:
+            fast_locals = list(args)
+            fast_locals.extend(plan.padding)
         else:
-            callargs = {}
-        if self.has_args:
-            callargs[self.varnames[self.argcount]] = args[self.argcount:]
-            if self.has_kwargs:
-                callargs[self.varnames[self.argcount + 1]] = kwargs
+            fast_locals = plan.bind(args, kwargs or {})
+        return Frame.acquire(self.program, self.global_names, None, self.vm.frame, fast_locals, self.closure)
+
+    def __call__(self, *args, **kwargs):
+        if self.generator_class is not None:
+            return self.generator_class(self.frame_for(args, kwargs), self.vm)
+        return self.vm.run_frame(self.frame_for(args, kwargs))
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        return types.MethodType(self, instance)
+
+
+class Generator:
+    """
+    Suspended frame of a guest generator. Every resume runs the frame in a
+    nested run_frame until YIELD_VALUE leaves it without releasing it, so a
+    pipeline of generators holds one frame per stage whatever the data size
+    """
+    __slots__ = ('gi_frame', 'gi_code', 'gi_running', 'vm', 'finished', '__name__', '__weakref__')
+
+    def __init__(self, frame, vm):
+        self.gi_frame = frame
+        self.gi_code = frame.code
+        self.gi_running = False
+        self.vm = vm
+        self.finished = False
+        self.__name__ = frame.code.co_name
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return self.send(None)
+
+    def send(self, value):
+        """
+        Resume the frame with value as the result of the suspended yield
+        :return: next yielded value
+        :raises StopIteration: with the returned value once the frame returns
+        """
+        frame = self.gi_frame
+        if self.finished:
+            raise StopIteration
+        if self.gi_running:
+            raise ValueError("generator already executing")
+        if frame.last_instruction:
+            frame.stack.append(value)
+        elif value is not None:
+            raise TypeError("can't send non-None value to a just-started generator")
+        return self._resume()
+
+    def throw(self, exception_type, value=None, traceback=None):
+        """
+        Raise an exception at the suspended yield, a subiterator of yield
+        from gets it first
+        :return: next yielded value if the generator handles the exception
+        """
+        if isinstance(exception_type, BaseException):
+            exception = exception_type
+        elif isinstance(value, exception_type):
+            exception = value
+        elif value is None:
+            exception = exception_type()
         else:
-            if self.has_kwargs:
-                callargs[self.varnames[self.argcount]] = kwargs
-        callargs.update(self.kwonly_defaults)
-        callargs.update(kwargs)
-        if self.annotations:
-            callargs['__annotations__'] = self.annotations
-        frame = self.vm.make_frame(self.code, callargs)
-        return self.vm.run_frame(frame)
+            exception = exception_type(value)
+        if traceback is not None:
+            exception = exception.with_traceback(traceback)
+        frame = self.gi_frame
+        if self.finished or not frame.last_instruction:
+            self.finished = True
+            self.gi_frame = None
+            raise exception
+        if frame.program.opcodes[frame.last_instruction] == YIELD_FROM:
+            receiver = frame.stack[-1]
+            if isinstance(exception, GeneratorExit):
+                close = getattr(receiver, 'close', None)
+                if close is not None:
+                    close()
+            else:
+                throw = getattr(receiver, 'throw', None)
+                if throw is not None:
+                    self.gi_running = True
+                    try:
+                        return throw(type(exception), exception, exception.__traceback__)
+                    except StopIteration as stop:
+                        frame.stack[-1] = stop.value
+                        frame.last_instruction += 1
+                        return self._resume()
+                    except BaseException as error:
+                        exception = error
+                    finally:
+                        self.gi_running = False
+            frame.stack.pop()
+            frame.last_instruction += 1
+        return self._resume(exception)
+
+    def close(self):
+        if self.finished or not self.gi_frame.last_instruction:
+            self.finished = True
+            self.gi_frame = None
+            return
+        try:
+            self.throw(GeneratorExit)
+        except (GeneratorExit, StopIteration):
+            return
+        raise RuntimeError("generator ignored GeneratorExit")
+
+    def __del__(self):
+        """
+        Close a suspended generator dropped by the guest so that its finally
+        clauses and __exit__ methods run. This may happen in the middle of an
+        instruction of another frame, whose machine state is kept
+        """
+        if self.finished or self.gi_frame is None or not self.gi_frame.last_instruction:
+            return
+        vm = self.vm
+        saved = vm.returned_value, vm.callee, vm.last_exception
+        try:
+            self.close()
+        finally:
+            vm.returned_value, vm.callee, vm.last_exception = saved
+
+    def _resume(self, error=None):
+        """
+        Run the suspended frame up to its next yield
+        :param error: exception to raise at the suspended yield
+        """
+        frame = self.gi_frame
+        frame.previous_frame = self.vm.frame
+        # The frame refers to the generator only while it runs, so that a
+        # suspended generator is not in a cycle with its frame and is
+        # finalized as soon as the guest drops it
+        frame.generator = self
+        self.gi_running = True
+        try:
+            value = self.vm.run_frame(frame, error)
+        except BaseException:
+            self.finished = True
+            self.gi_frame = None
+            raise
+        finally:
+            self.gi_running = False
+            frame.generator = None
+        if self.finished:
+            self.gi_frame = None
+            if value is None:
+                raise StopIteration
+            raise StopIteration(value)
+        return value
+
+    def __repr__(self):
+        return '<guest generator object {} at {:#x}>'.format(self.__name__, id(self))
+
+
+class Coroutine(Generator):
+    """
+    Guest coroutine, awaited through the same send protocol
+    """
+    __slots__ = ()
+
+    def __await__(self):
+        return self
+
+    @property
+    def cr_frame(self):
+        return self.gi_frame
+
+    @property
+    def cr_running(self):
+        return self.gi_running
+
+    def __repr__(self):
+        return '<guest coroutine object {} at {:#x}>'.format(self.__name__, id(self))
+
+
+collections.abc.Generator.register(Generator)
+collections.abc.Coroutine.register(Coroutine)
+
+
+# Attributes found on a type which LOAD_METHOD calls with the object as the
+# first argument instead of binding them
+METHOD_TYPES = (Function, types.FunctionType, type(str.join), type(object.__init__))
 
 
 class Cell:
+    __slots__ = ('contents',)
+
     def __init__(self, value):
         self.contents = value
 
@@ -110,173 +1220,391 @@ class Cell:
         del self.contents
 
 
+class GuestSys:
+    """
+    View of sys module given to guest code, standard streams are bound
+    to the virtual machine and everything else is taken from sys
+    """
+    __slots__ = ('_vm',)
+
+    def __init__(self, vm):
+        object.__setattr__(self, '_vm', vm)
+
+    @property
+    def stdout(self):
+        return self._vm.stdout if self._vm.stdout is not None else sys.stdout
+
+    @stdout.setter
+    def stdout(self, stream):
+        self._vm.stdout = stream
+
+    @property
+    def stderr(self):
+        return self._vm.stderr if self._vm.stderr is not None else sys.stderr
+
+    @stderr.setter
+    def stderr(self, stream):
+        self._vm.stderr = stream
+
+    def exc_info(self):
+        return self._vm.last_exception or (None, None, None)
+
+    def __getattr__(self, name):
+        return getattr(sys, name)
+
+    def __setattr__(self, name, value):
+        if name in ('stdout', 'stderr'):
+            object.__setattr__(self, name, value)
+        else:
+            setattr(sys, name, value)
+
+
 class VirtualMachine:
-    def __init__(self):
+    def __init__(self, profiler=None, stdout=None, stderr=None, recursion_limit=DEFAULT_RECURSION_LIMIT,
+                 instruction_budget=None, time_limit=None):
+        """
+        :param profiler: vm_profiler.Profiler to collect statistics with
+        :param stdout: stream for guest output, current sys.stdout if None
+        :param stderr: stream for guest errors, current sys.stderr if None
+        :param recursion_limit: maximum number of active guest frames
+        :param instruction_budget: ticks a run may take: backward jumps and guest calls
+        :param time_limit: wall-clock seconds a run may take, checked every CLOCK_TICKS ticks
+        """
+        self.profiler = profiler
+        self.recursion_limit = recursion_limit
+        self.instruction_budget = instruction_budget
+        self.time_limit = time_limit
+        self.stdout = stdout
+        self.stderr = stderr
+        self.guest_sys = GuestSys(self)
+        if profiler is not None:
+            self.run_frame = self.run_frame_profiled
         self.frames = []
         self.frame = None
+        self.callee = None
+        # Decremented by backward jumps and guest calls, expire() is called
+        # when it runs out. period is the value it was last set to
+        self.countdown = self.period = sys.maxsize
+        self.budget_left = self.slice_left = sys.maxsize
+        self.deadline = None
         self.returned_value = None
         self.last_exception = None
-        self.unary = {
-            'UNARY_POSITIVE': operator.pos,
-            'UNARY_NEGATIVE': operator.neg,
-            'UNARY_NOT': operator.not_,
-            'UNARY_INVERT': operator.inv
-        }
-        self.binary = {
-            'BINARY_ADD': operator.add,
-            'BINARY_SUBTRACT': operator.sub,
-            'BINARY_MULTIPLY': operator.mul,
-            'BINARY_POWER': operator.pow,
-            'BINARY_FLOOR_DIVIDE': operator.floordiv,
-            'BINARY_TRUE_DIVIDE': operator.truediv,
-            'BINARY_MODULO': operator.mod,
-            'BINARY_SUBSCR': operator.getitem,
-            'BINARY_LSHIFT': operator.lshift,
-            'BINARY_RSHIFT': operator.rshift,
-            'BINARY_AND': operator.and_,
-            'BINARY_XOR': operator.xor,
-            'BINARY_OR': operator.or_,
-            'BINARY_MATRIX_MULTIPLY': operator.matmul,
-        }
-        self.inplace = {
-            'INPLACE_ADD': operator.iadd,
-            'INPLACE_SUBTRACT': operator.isub,
-            'INPLACE_MULTIPLY': operator.imul,
-            'INPLACE_POWER': operator.ipow,
-            'INPLACE_FLOOR_DIVIDE': operator.ifloordiv,
-            'INPLACE_TRUE_DIVIDE': operator.itruediv,
-            'INPLACE_MODULO': operator.imod,
-            'INPLACE_LSHIFT': operator.ilshift,
-            'INPLACE_RSHIFT': operator.irshift,
-            'INPLACE_AND': operator.iand,
-            'INPLACE_XOR': operator.ixor,
-            'INPLACE_OR': operator.ior,
-            'INPLACE_MATRIX_MULTIPLY': operator.imatmul
-        }
-        self.compare = {
-            '<': operator.lt,
-            '<=': operator.le,
-            '>': operator.gt,
-            '>=': operator.ge,
-            '==': operator.eq,
-            '!=': operator.ne,
-            'is': operator.is_,
-            'is not': operator.is_not,
-            'in': lambda x, y: x in y,
-            'not in': lambda x, y: x not in y,
-            'isinstance': lambda x, y: issubclass(x, Exception) and issubclass(x, y),
+        # NameCache -> value it resolved to, emptied whenever a namespace
+        # changes; names_exposed stops filling it, see expose_names()
+        self.cached_names = {}
+        self.names_exposed = False
+        self.builtin_overrides = {
+            'globals': self.guest_globals,
+            'locals': self.guest_locals,
+            'vars': self.guest_vars,
+            'super': self.guest_super,
+            'print': self.guest_print,
+            'setattr': self.guest_setattr,
+            'delattr': self.guest_delattr,
         }
-        self.jump = [
-            'JUMP_FORWARD',
-            'POP_JUMP_IF_TRUE',
-            'POP_JUMP_IF_FALSE',
-            'JUMP_IF_TRUE_OR_POP',
-            'JUMP_IF_FALSE_OR_POP',
-            'JUMP_ABSOLUTE'
-        ]
-
-    def make_frame(self, code, callargs={}):
-        if self.frames:
-            global_names = self.frame.global_names
-            local_names = self.frame.local_names
-        else:
-            global_names = {
-                '__name__': '__main__',
-                '__doc__': None,
-                '__package__': None,
-                '__spec__': None,
-                '__loader__': None
-                }
+
+    def reset(self):
+        """
+        Forget the state of the last run: frames, the exception being handled
+        and cached global names, which are looked up afresh in the globals of
+        the next run. Streams, limits and the guest sys module are kept
+        """
+        del self.frames[:]
+        self.frame = None
+        self.callee = None
+        self.returned_value = None
+        self.last_exception = None
+        self.clear_limits()
+        self.cached_names.clear()
+        self.names_exposed = False
+
+    def make_frame(self, code, callargs={}, program=None, global_names=None, local_names=None, closure=None):
+        if program is None:
+            program = load_program(code)
+        if global_names is None:
+            if self.frames:
+                global_names = self.frame.global_names
+            else:
+                global_names = dict(MAIN_NAMESPACE)
+                local_names = global_names
+        if code.co_flags & CO_OPTIMIZED:
+            fast_locals = [NULL] * code.co_nlocals
+            if callargs:
+                for index, name in enumerate(code.co_varnames):
+                    if name in callargs:
+                        fast_locals[index] = callargs[name]
+            return Frame.acquire(program, global_names, None, self.frame, fast_locals, closure)
+        if local_names is None:
             local_names = {}
         if callargs:
             local_names.update(callargs)
-        return Frame(code, global_names, local_names, self.frame)
+        self.cached_names.clear()
+        return Frame.acquire(program, global_names, local_names, self.frame, None, closure)
 
-    def run_frame(self, frame):
-        self.push_frame(frame)
-        while self.frame.last_instruction <= self.frame.max_offset:
-            instruction = self.frame.instructions[self.frame.last_instruction]
-            opname = instruction.opname
-            args = instruction.argval
-#             self.frame.frame_info()
-#             print(opname, args)
-            if opname in self.unary:
-                self.UNARY_OP(opname)
-            elif opname in self.binary:
-                self.BINARY_OP(opname)
-            elif opname in self.inplace:
-                self.INPLACE_OP(opname)
-            elif hasattr(self, opname):
-                if args is not None:
-                    why = getattr(self, opname)(args)
-                else:
-                    why = getattr(self, opname)()
-            if why == 'exception':
-                pass
-            else:
-                while why and frame.block_stack:
-                    why = self.manage_block(why)
-            if self.frame:
-                self.frame.last_instruction += 2
-            else:
-                break
+    def run_frame(self, frame, error=None, entry_frame=None):
+        """
+        Run frame until it returns. Guest functions called from it are run
+        in the same loop: call handlers leave the callee frame in self.callee
+        and return 'call', the loop switches to it and back to the caller
+        when it returns. An exception raised by a handler goes to the
+        innermost try statement of the frames in this loop, the exception
+        of the entry frame is passed on to the host
+        :param error: exception to raise in frame before running it
+        :param entry_frame: set by resume(): frame is already running above
+                            it and the loop stops once countdown runs out
+        :return: value returned by frame, PREEMPTED when the loop stopped
+        """
+        preemptible = entry_frame is not None
+        if not preemptible:
+            self.push_frame(frame)
+            entry_frame = frame
+        dispatch = DISPATCH
+        while True:
+            if error is not None:
+                frame = self.catch(error, entry_frame)
+                error = None
+            opcodes = frame.program.opcodes
+            arguments = frame.program.arguments
+            constants = frame.program.constants
+            try:
+                while True:
+                    index = frame.last_instruction
+                    frame.last_instruction = index + 1
+                    why = dispatch[opcodes[index]](self, constants[arguments[index]])
+                    if why is None:
+                        continue
+                    if why == 'call':
+                        frame = self.callee
+                        self.callee = None
+                        self.push_frame(frame)
+                        self.countdown -= 1
+                        if self.countdown <= 0 and self.expire() and preemptible:
+                            return PREEMPTED
+                    elif why == 'yield':
+                        # Only generator frames yield and they are always entered here
+                        self.pop_frame()
+                        return self.returned_value
+                    else:
+                        if why != 'preempt' and (frame.block_stack or frame.program.blocks[index] is not None):
+                            why = self.unwind(why)
+                            if why is None:
+                                continue
+                        if why == 'preempt':
+                            # Loops nested in host calls run on, the outermost one stops
+                            if self.expire() and preemptible:
+                                return PREEMPTED
+                            continue
+                        self.pop_frame()
+                        if frame.generator is not None:
+                            frame.generator.finished = True
+                        frame.release()
+                        if frame is entry_frame:
+                            return self.returned_value
+                        frame = self.frame
+                        frame.stack.append(self.returned_value)
+                    opcodes = frame.program.opcodes
+                    arguments = frame.program.arguments
+                    constants = frame.program.constants
+            except BaseException as raised:
+                error = raised
+
+    def catch(self, error, entry_frame):
+        """
+        Unwind to the handler of an exception raised in the current frame,
+        popping frames which have none down to entry_frame
+        :return: frame continuing at the handler
+        :raises: error when no frame up to entry_frame handles it
+        """
+        if type(error) is BudgetExceeded:
+            while True:
+                frame = self.frame
+                self.pop_frame()
+                frame.release()
+                if frame is entry_frame:
+                    raise error
+        self.chain_exception(error)
+        while True:
+            if self.unwind('exception', error) is None:
+                return self.frame
+            frame = self.frame
+            self.pop_frame()
+            frame.release()
+            if frame is entry_frame:
+                raise error
+
+    def chain_exception(self, error):
+        """
+        Set the exception being handled as context of one raised meanwhile
+        """
+        last_exception = self.last_exception
+        if last_exception is not None and last_exception[1] is not error and error.__context__ is None:
+            error.__context__ = last_exception[1]
 
+    def run_frame_profiled(self, frame, error=None):
+        """
+        Instrumented copy of run_frame, installed only when profiler is given.
+        Guest calls are nested here so that every frame is timed on its own.
+        Time of an instruction excludes time spent in guest frames it called,
+        total time of a function counts only its outermost active frame
+        """
+        self.push_frame(frame)
+        profiler = self.profiler
+        timer = profiler.timer
+        stats = profiler.stats_for(frame.program)
+        counts = stats.counts
+        times = stats.times
+        lengths = stats.lengths
+        jump_starts = stats.jump_starts
+        dispatch = DISPATCH
+        opcodes = frame.program.opcodes
+        arguments = frame.program.arguments
+        constants = frame.program.constants
+        outer_child_time = profiler.child_time
+        stats.depth += 1
+        frame_started = timer()
+        try:
+            while True:
+                if error is not None:
+                    self.chain_exception(error)
+                    if type(error) is BudgetExceeded or self.unwind('exception', error) is not None:
+                        frame.release()
+                        raise error
+                    error = None
+                try:
+                    why = None
+                    while why != 'return' and why != 'yield':
+                        index = frame.last_instruction
+                        frame.last_instruction = index + 1
+                        child_time = profiler.child_time
+                        started = timer()
+                        why = dispatch[opcodes[index]](self, constants[arguments[index]])
+                        times[index] += timer() - started - (profiler.child_time - child_time)
+                        counts[index] += 1
+                        if index in jump_starts and frame.last_instruction != index + lengths[index]:
+                            stats.jumps[index] += 1
+                        if why == 'call':
+                            callee, self.callee = self.callee, None
+                            frame.stack.append(self.run_frame_profiled(callee))
+                            why = None
+                        elif why == 'preempt':
+                            self.expire()
+                            why = None
+                        elif why is not None and why != 'yield':
+                            why = self.unwind(why)
+                    break
+                except BaseException as raised:
+                    error = raised
+        finally:
+            elapsed = timer() - frame_started
+            stats.depth -= 1
+            stats.calls += 1
+            if not stats.depth:
+                stats.total_time += elapsed
+            profiler.child_time = outer_child_time + elapsed
+            self.pop_frame()
+        if why == 'return':
+            if frame.generator is not None:
+                frame.generator.finished = True
+            frame.release()
         return self.returned_value
 
     # Blocks
 
-    def push_block(self, type, start, end, height=None):
-        if height is None:
-            height = len(self.frame.stack)
-        block = Block(type, start, end, height)
-        self.frame.block_stack.append(block)
-
-    def pop_block(self):
-        self.frame.block_stack.pop()
-
-    def top_block(self):
-        return self.frame.block_stack[-1]
-
-    def unwind_block(self, block):
-        if block.type == 'except-handler':
-            offset = 3
-        else:
-            offset = 0
-
-        while len(self.frame.stack) > block.stack_height + offset:
-            self.pop()
-
-        if block.type == 'except-handler':
-            tb, value, exctype = self.popn(3)
-            self.last_exception = exctype, value, tb
-
-    def manage_block(self, why):
-        block = self.top_block()
-        if block.type == 'loop' and why == 'continue':
-            self.frame.last_instruction = self.returned_value
-
-        self.pop_block()
-        self.unwind_block(block)
-
-        if block.type == 'loop' and why == 'break':
-            self.frame.last_instruction = block.end - 2
-
-    # elif why == 'exception' and block.type in ['setup-except', 'finally']:
-    #     self.push_block('except-handler', self.frame.last_instruction + 2, )
-    #     exctype, value, tb = self.last_exception
-    #     self.push(tb, value, exctype)
-    #     # PyErr_Normalize_Exception goes here
-    #     self.push(tb, value, exctype)
-    #     self.frame.last_instruction = block.end - 2
-        elif block.type == 'finally':
-            if why in ('return', 'continue'):
-                self.push(self.returned_value)
-            self.push(why)
-            self.frame.last_instruction = block.end - 2
+    def unwind(self, why, error=None):
+        """
+        Leave blocks of the current frame until one of them takes over.
+        Blocks come from the exception table entry of the instruction being
+        run; handlers entered earlier are on frame.block_stack and enclose
+        every block set up after the start of their handler
+        :param why: 'return', 'break', 'continue' or 'exception'
+        :param error: exception raised for 'exception'
+        :return: None when the frame continues at a handler, why otherwise
+        """
+        frame = self.frame
+        stack = frame.stack
+        handlers = frame.block_stack
+        block = frame.program.blocks[frame.last_instruction - 1]
+        while True:
+            if handlers and (block is None or block.start < handlers[-1].start):
+                self.pop_except_handler()
+                continue
+            if block is None:
+                return why
+            if block.type == 'loop' and why == 'continue':
+                frame.last_instruction = self.returned_value
+                self.countdown -= 1
+                return 'preempt' if self.countdown <= 0 else None
+            del stack[block.stack_height:]
+            if block.type == 'loop':
+                if why == 'break':
+                    frame.last_instruction = block.end
+                    return None
+            elif why == 'exception':
+                handlers.append(ExceptHandler(block.end, block.stack_height, self.last_exception))
+                self.last_exception = type(error), error, error.__traceback__
+                if block.type == 'finally':
+                    stack.append(error)
+                else:
+                    stack.extend((error.__traceback__, error, type(error)))
+                frame.last_instruction = block.end
+                return None
+            elif block.type == 'finally':
+                stack.append(Unwinding(why, self.returned_value))
+                frame.last_instruction = block.end
+                return None
+            block = block.parent
+
+    def pop_except_handler(self):
+        handler = self.frame.block_stack.pop()
+        del self.frame.stack[handler.stack_height:]
+        self.last_exception = handler.saved_exception
+
+    # Limits
+
+    def set_limits(self):
+        """
+        Start counting instruction budget and time limit of a run
+        """
+        self.budget_left = sys.maxsize if self.instruction_budget is None else self.instruction_budget
+        self.deadline = None if self.time_limit is None else time.perf_counter() + self.time_limit
+        self.slice_left = sys.maxsize
+        self.set_countdown()
+
+    def clear_limits(self):
+        self.budget_left = self.slice_left = sys.maxsize
+        self.deadline = None
+        self.set_countdown()
+
+    def set_countdown(self):
+        ticks = min(self.budget_left, self.slice_left)
+        if self.deadline is not None:
+            ticks = min(ticks, CLOCK_TICKS)
+        self.countdown = self.period = ticks
+
+    def expire(self):
+        """
+        Charge ticks counted down since the last call to the budget and the
+        slice of resume() and set the countdown again
+        :return: whether the slice is over
+        :raises BudgetExceeded: when the budget or the time ran out
+        """
+        spent = self.period - self.countdown
+        self.budget_left -= spent
+        self.slice_left -= spent
+        if self.budget_left < 0:
+            raise BudgetExceeded('instructions', self.instruction_budget, self.instruction_budget - self.budget_left)
+        if self.deadline is not None:
+            now = time.perf_counter()
+            if now >= self.deadline:
+                raise BudgetExceeded('time', self.time_limit, self.time_limit + now - self.deadline)
+        self.set_countdown()
+        return self.slice_left <= 0
 
     # Frames
 
     def push_frame(self, frame):
+        if len(self.frames) >= self.recursion_limit:
+            raise RecursionError("maximum recursion depth exceeded")
         self.frames.append(frame)
         self.frame = frame
 
@@ -313,15 +1641,20 @@ class VirtualMachine:
 
     # Weird stuff with a
 
-    def GET_AWAITABLE(self):
-        TOS = self.pop()
+    def GET_AWAITABLE(self, arg=None):
+        stack = self.frame.stack
+        awaitable = stack[-1]
+        if isinstance(awaitable, Coroutine):
+            return
+        if isinstance(awaitable, types.GeneratorType) and awaitable.gi_code.co_flags & CO_ITERABLE_COROUTINE:
+            return
         try:
-            TOS = TOS.__await__
-            self.push(TOS)
-        except Exception:
-            pass
+            method = type(awaitable).__await__
+        except AttributeError:
+            raise TypeError("object {} can't be used in 'await' expression".format(type(awaitable).__name__))
+        stack[-1] = method(awaitable)
 
-    def GET_AITER(self):
+    def GET_AITER(self, arg=None):
         TOS = self.pop()
         try:
             TOS = TOS.__aiter__()
@@ -329,7 +1662,7 @@ class VirtualMachine:
         except Exception:
             pass
 
-    def GET_ANEXT(self):
+    def GET_ANEXT(self, arg=None):
         TOS = self.pop()
         try:
             TOS = TOS.__anext__().__await__
@@ -337,164 +1670,216 @@ class VirtualMachine:
         except Exception:
             pass
 
-    def BEFORE_ASYNC_WITH(self):
-        try:
-            TOS = self.pop()
-            self.push(TOS.__aexit__)
-            self.push(TOS.__aenter__())
-        except Exception:
-            pass
+    def BEFORE_ASYNC_WITH(self, arg=None):
+        stack = self.frame.stack
+        manager = stack.pop()
+        manager_type = type(manager)
+        stack.append(manager_type.__aexit__.__get__(manager, manager_type))
+        return self.call(manager_type.__aenter__.__get__(manager, manager_type), ())
 
     # Loading and storing variables
 
     def LOAD_CONST(self, number=None):
         self.push(number)
 
-    def LOAD_NAME(self, name=None):
+    def LOAD_NAME(self, cache=None):
         frame = self.frame
-        value = 0
-        if name in frame.local_names:
-            value = frame.local_names[name]
-        elif name in frame.global_names:
-            value = frame.global_names[name]
-        elif name in frame.builtin_names:
-            value = getattr(builtins, name)
+        cached_names = self.cached_names
+        if cache in cached_names:
+            value = cached_names[cache]
         else:
-            raise NameError("name '%s' is not defined" % name)
-        self.push(value)
+            name = cache.name
+            if name in frame.local_names:
+                value = frame.local_names[name]
+            elif name in frame.global_names:
+                value = frame.global_names[name]
+            elif name in self.builtin_overrides:
+                value = self.builtin_overrides[name]
+            elif name in BUILTINS:
+                value = BUILTINS[name]
+            else:
+                raise NameError("name '%s' is not defined" % name)
+            if not self.names_exposed:
+                cached_names[cache] = value
+        frame.stack.append(value)
 
     def STORE_NAME(self, name=None):
         self.frame.local_names[name] = self.pop()
+        self.cached_names.clear()
 
     def DELETE_NAME(self, name=None):
         del self.frame.local_names[name]
+        self.cached_names.clear()
 
     def STORE_ATTR(self, name=None):
         TOS1, TOS = self.popn(2)
-        setattr(TOS, name, TOS1)
-        self.push(TOS1, TOS)
+        self.guest_setattr(TOS, name, TOS1)
 
     def DELETE_ATTR(self, name=None):
-        delattr(self.top(), name)
+        self.guest_delattr(self.pop(), name)
+
+    def LOAD_ATTR(self, cache):
+        stack = self.frame.stack
+        obj = stack[-1]
+        entry = cache.types.get(type(obj))
+        if entry is None or cache.version != AttributeCache.types_version:
+            entry = cache.fill(type(obj))
+        function, has_dict = entry
+        if function is None or has_dict and cache.name in obj.__dict__:
+            stack[-1] = getattr(obj, cache.name)
+        else:
+            stack[-1] = types.MethodType(function, obj)
 
-    def LOAD_ATTR(self, name):
-        TOS = self.pop()
-        self.push(getattr(TOS, name))
+    def LOAD_METHOD(self, cache):
+        """
+        Push the function and the object when the attribute is a method
+        defined on the type, NULL and the attribute otherwise
+        """
+        stack = self.frame.stack
+        obj = stack[-1]
+        entry = cache.types.get(type(obj))
+        if entry is None or cache.version != AttributeCache.types_version:
+            entry = cache.fill(type(obj))
+        function, has_dict = entry
+        if function is None or has_dict and cache.name in obj.__dict__:
+            stack[-1] = NULL
+            stack.append(getattr(obj, cache.name))
+        else:
+            stack[-1] = function
+            stack.append(obj)
 
     def STORE_GLOBAL(self, name=None):
         self.frame.global_names[name] = self.pop()
+        self.cached_names.clear()
 
     def DELETE_GLOBAL(self, name=None):
         del self.frame.global_names[name]
+        self.cached_names.clear()
+
+    def unbound_local(self, index):
+        return UnboundLocalError("local variable '%s' referenced before assignment"
+                                 % self.frame.code.co_varnames[index])
 
-    def LOAD_FAST(self, name=None):
+    def LOAD_FAST(self, index=None):
         frame = self.frame
-        value = 0
-        if name in frame.local_names:
-            value = frame.local_names[name]
-        else:
-            raise NameError("name '%s' is not defined" % name)
-        self.push(value)
+        value = frame.fast_locals[index]
+        if value is NULL:
+            raise self.unbound_local(index)
+        frame.stack.append(value)
 
-    def STORE_FAST(self, name=None):
-        self.frame.local_names[name] = self.pop()
+    def STORE_FAST(self, index=None):
+        frame = self.frame
+        frame.fast_locals[index] = frame.stack.pop()
 
-    def DELETE_FAST(self, name=None):
-        del self.frame.local_names[name]
+    def DELETE_FAST(self, index=None):
+        frame = self.frame
+        if frame.fast_locals[index] is NULL:
+            raise self.unbound_local(index)
+        frame.fast_locals[index] = NULL
 
-    def STORE_SUBSCR(self):
+    def STORE_SUBSCR(self, arg=None):
         TOS2, TOS1, TOS = self.popn(3)
         TOS1[TOS] = TOS2
-        self.push(TOS2, TOS1, TOS)
 
-    def DELETE_SUBSCR(self):
+    def DELETE_SUBSCR(self, arg=None):
         TOS1, TOS = self.popn(2)
         del TOS1[TOS]
-        self.push(TOS1, TOS)
 
-    def LOAD_GLOBAL(self, name=None):
+    def LOAD_GLOBAL(self, cache=None):
         frame = self.frame
-        value = 0
-        if name in frame.global_names:
-            value = frame.global_names[name]
-        elif name in frame.builtin_names:
-            value = getattr(builtins, name)
+        cached_names = self.cached_names
+        if cache in cached_names:
+            value = cached_names[cache]
         else:
-            raise NameError("name '%s' is not defined" % name)
-        self.push(value)
+            name = cache.name
+            if name in frame.global_names:
+                value = frame.global_names[name]
+            elif name in self.builtin_overrides:
+                value = self.builtin_overrides[name]
+            elif name in BUILTINS:
+                value = BUILTINS[name]
+            else:
+                raise NameError("name '%s' is not defined" % name)
+            if not self.names_exposed:
+                cached_names[cache] = value
+        frame.stack.append(value)
 
     def EXTENDED_ARG(self, count):
         pass
 
     # Stack manipulation
 
-    def POP_TOP(self):
+    def POP_TOP(self, arg=None):
         self.pop()
 
-    def ROT_TWO(self):
+    def ROT_TWO(self, arg=None):
         popped_items = self.popn(2)
         self.push(popped_items[1])
         self.push(popped_items[0])
 
-    def ROT_THREE(self):
+    def ROT_THREE(self, arg=None):
         popped_items = self.popn(3)
         self.push(popped_items[2])
         self.push(popped_items[0])
         self.push(popped_items[1])
 
-    def DUP_TOP(self):
-        self.push(self.top)
+    def DUP_TOP(self, arg=None):
+        self.push(self.top())
 
-    def DUP_TOP_TWO(self):
-        popped_items = self.popn(2)
-        self.push(popped_items)
-        self.push(popped_items)
+    def DUP_TOP_TWO(self, arg=None):
+        self.push(*self.topn(2))
 
     # Arithmetical operations
 
-    def UNARY_OP(self, opname):
+    def UNARY_OP(self, operation):
         top = self.pop()
-        self.push(self.unary[opname](top))
+        self.push(operation(top))
 
-    def BINARY_OP(self, opname):
+    def BINARY_OP(self, operation):
         popped_items = self.popn(2)
-        self.push(self.binary[opname](*popped_items))
+        self.push(operation(*popped_items))
 
-    def INPLACE_OP(self, opname):
+    def INPLACE_OP(self, operation):
         popped_items = self.popn(2)
-        self.push(self.inplace[opname](*popped_items))
+        self.push(operation(*popped_items))
 
-    def COMPARE_OP(self, opname):
+    def COMPARE_OP(self, operation):
         popped_items = self.popn(2)
-        self.push(self.compare[opname](*popped_items))
+        self.push(operation(*popped_items))
 
     # Jumps
 
     def JUMP_ABSOLUTE(self, target):
-        self.frame.last_instruction = target - 2
+        self.frame.last_instruction = target
+
+    def JUMP_BACKWARD(self, target):
+        self.frame.last_instruction = target
+        self.countdown -= 1
+        if self.countdown <= 0:
+            return 'preempt'
 
     def JUMP_FORWARD(self, delta):
-        self.frame.last_instruction = delta - 2  # maybe it is absolute
+        self.frame.last_instruction = delta
 
     def POP_JUMP_IF_TRUE(self, target):
         top = self.pop()
         if top:
-            self.frame.last_instruction = target - 2
+            self.frame.last_instruction = target
 
     def POP_JUMP_IF_FALSE(self, target):
         top = self.pop()
         if not top:
-            self.frame.last_instruction = target - 2
+            self.frame.last_instruction = target
 
     def JUMP_IF_TRUE_OR_POP(self, target):
         if self.top():
-            self.frame.last_instruction = target - 2
+            self.frame.last_instruction = target
         else:
             self.pop()
 
     def JUMP_IF_FALSE_OR_POP(self, target):
         if not self.top():
-            self.frame.last_instruction = target - 2
+            self.frame.last_instruction = target
         else:
             self.pop()
 
@@ -536,17 +1921,16 @@ class VirtualMachine:
         self.push(slice(*popped_items))
 
     def LIST_APPEND(self, i):
-        list.append(self.top()[-i], self.top())
+        TOS = self.pop()
+        list.append(self.frame.stack[-i], TOS)
 
     def SET_ADD(self, i):
-        TOS1, TOS = self.popn(2)
-        set.add(TOS1[-i], TOS)
-        self.push(TOS1, TOS)
+        TOS = self.pop()
+        set.add(self.frame.stack[-i], TOS)
 
     def MAP_ADD(self, i):
         TOS1, TOS = self.popn(2)
-        dict.setitem(TOS1[-i], TOS, TOS1)
-        self.push(TOS1, TOS)
+        dict.__setitem__(self.frame.stack[-i], TOS, TOS1)
 
     def UNPACK_SEQUENCE(self, count):
         sequence = self.pop()
@@ -596,7 +1980,7 @@ class VirtualMachine:
 
     # Iterators
 
-    def GET_ITER(self):
+    def GET_ITER(self, arg=None):
         self.push(iter(self.pop()))
 
     def FOR_ITER(self, target):
@@ -604,33 +1988,59 @@ class VirtualMachine:
             self.push(next(self.top()))
         except StopIteration:
             self.pop()
-            self.frame.last_instruction = target - 2
+            self.frame.last_instruction = target
 
     # Loops
 
     def SETUP_LOOP(self, target):
-        self.push_block('loop', self.frame.last_instruction + 2, target)
+        """
+        Blocks are found in Program.blocks when they are left,
+        entering and leaving them does nothing
+        """
 
-    def BREAK_LOOP(self):
-        # self.manage_block('break')
+    SETUP_EXCEPT = SETUP_FINALLY = SETUP_ASYNC_WITH = POP_BLOCK = SETUP_LOOP
+
+    def BREAK_LOOP(self, arg=None):
         return 'break'
 
     def CONTINUE_LOOP(self, target):
-        # self.manage_block('continue')
         self.returned_value = target
         return 'continue'
 
-    def POP_BLOCK(self):
-        self.pop_block()
-
     # Functions
 
+    def call(self, function, args, kwargs=None):
+        """
+        Call made by the current frame. Guest functions of this machine are
+        not called here, their frame is left in self.callee for run_frame
+        :return: 'call' for a guest function, None once the result is pushed
+        """
+        if type(function) is types.MethodType and type(function.__func__) is Function:
+            args = (function.__self__,) + tuple(args)
+            function = function.__func__
+        if type(function) is Function and function.vm is self and function.generator_class is None:
+            self.callee = function.frame_for(args, kwargs)
+            return 'call'
+        if kwargs:
+            self.frame.stack.append(function(*args, **kwargs))
+        else:
+            self.frame.stack.append(function(*args))
+
     def CALL_FUNCTION(self, argc):
-        posargs = self.popn(argc)
-        function = self.pop()
-        returned_value = function(*posargs)
-        if self.frame:
-            self.push(returned_value)
+        stack = self.frame.stack
+        args = stack[-argc:] if argc else []
+        function = stack[-argc - 1]
+        del stack[-argc - 1:]
+        return self.call(function, args)
+
+    def CALL_METHOD(self, argc):
+        stack = self.frame.stack
+        args = stack[-argc - 1:]
+        function = stack[-argc - 2]
+        del stack[-argc - 2:]
+        if function is NULL:
+            return self.call(args[0], args[1:])
+        return self.call(function, args)
 
     def CALL_FUNCTION_KW(self, argc):
         kwargs_keys = self.pop()
@@ -639,9 +2049,7 @@ class VirtualMachine:
         kwargs = {key: value for key, value in zip(kwargs_keys, kwargs_values)}
         posargs = self.popn(argc - kwargs_count)
         function = self.pop()
-        returned_value = function(*posargs, **kwargs)
-        if self.frame:
-            self.push(returned_value)
+        return self.call(function, posargs, kwargs)
 
     def CALL_FUNCTION_EX(self, argval):
         kwargs = self.pop()
@@ -649,51 +2057,74 @@ class VirtualMachine:
             function = self.pop()
             args = kwargs
             kwargs = {}
-            returned_value = function(*args, **kwargs)
         else:
             args = self.pop()
             function = self.pop()
-            returned_value = function(*args, **kwargs)
-        if self.frame:
-            self.push(returned_value)
+        return self.call(function, args, kwargs)
 
     def MAKE_FUNCTION(self, argc):
         name = self.pop()
         code = self.pop()
 
-        cells = ()
+        closure = None
         annotations = {}
         kwonly_defaults = {}
         defaults = ()
-        if argc >= 8:
-            cells = self.pop()
-            argc -= 8
-        if argc >= 4:
+        if argc & 0x08:
+            closure = self.pop()
+        if argc & 0x04:
             annotations = self.pop()
-            argc -= 4
-        if argc >= 2:
+        if argc & 0x02:
             kwonly_defaults = self.pop()
-            argc += 1
-        if argc == 1:
+        if argc & 0x01:
             defaults = self.pop()
-            argc = 0
 
-        func = Function(code, name, defaults, kwonly_defaults, annotations, cells, None, self)
+        func = Function(code, name, defaults, kwonly_defaults, annotations, (), closure, self)
         self.push(func)
 
     def LOAD_CLOSURE(self, name):
         self.push(self.frame.cells[name])
 
-    def RETURN_VALUE(self):
-        self.returned_value = self.top()
-        self.pop_frame()
-        if self.frame:
-            self.push(self.returned_value)
+    def RETURN_VALUE(self, arg=None):
+        self.returned_value = self.pop()
         return 'return'
 
+    # Generators
+
+    def YIELD_VALUE(self, arg=None):
+        self.returned_value = self.frame.stack.pop()
+        return 'yield'
+
+    def YIELD_FROM(self, arg=None):
+        """
+        Send TOS to the subiterator below it. Its yielded values are passed
+        through by suspending at this same instruction, so that the next
+        resume sends into the subiterator again
+        """
+        frame = self.frame
+        stack = frame.stack
+        value = stack.pop()
+        receiver = stack[-1]
+        try:
+            if value is None:
+                result = next(receiver)
+            else:
+                result = receiver.send(value)
+        except StopIteration as stop:
+            stack[-1] = stop.value
+            return None
+        self.returned_value = result
+        frame.last_instruction -= 1
+        return 'yield'
+
+    def GET_YIELD_FROM_ITER(self, arg=None):
+        stack = self.frame.stack
+        if not isinstance(stack[-1], Generator):
+            stack[-1] = iter(stack[-1])
+
     # Annotations
 
-    def SETUP_ANNOTATIONS(self):
+    def SETUP_ANNOTATIONS(self, arg=None):
         if '__annotations__' not in self.frame.local_names:
             self.frame.local_names['__annotations__'] = {}
 
@@ -704,18 +2135,22 @@ class VirtualMachine:
 
     def IMPORT_NAME(self, name):
         level, fromlist = self.popn(2)
-        module = builtins.__import__(name, level=level, fromlist=fromlist)
+        if name == 'sys' and not level:
+            module = self.guest_sys
+        else:
+            module = builtins.__import__(name, level=level, fromlist=fromlist)
         self.push(module)
 
     def IMPORT_FROM(self, name):
         module = self.top()
         self.push(getattr(module, name))
 
-    def IMPORT_STAR(self):
+    def IMPORT_STAR(self, arg=None):
         module = self.pop()
         for attribute in dir(module):
             if attribute[0] != '_':
                 self.frame.local_names[attribute] = getattr(module, attribute)
+        self.cached_names.clear()
 
     # Classes
 
@@ -728,8 +2163,73 @@ class VirtualMachine:
     def DELETE_DEREF(self, name):
         self.frame.cells[name].empty()
 
-    def LOAD_BUILD_CLASS(self):
-        self.push(builtins.__build_class__)
+    def LOAD_BUILD_CLASS(self, arg=None):
+        self.push(self.build_class)
+
+    def guest_print(self, *args, sep=' ', end='\n', file=None, flush=False):
+        if file is None:
+            file = self.stdout
+        print(*args, sep=sep, end=end, file=file, flush=flush)
+
+    def guest_setattr(self, obj, name, value):
+        setattr(obj, name, value)
+        if isinstance(obj, type):
+            AttributeCache.invalidate()
+
+    def guest_delattr(self, obj, name):
+        delattr(obj, name)
+        if isinstance(obj, type):
+            AttributeCache.invalidate()
+
+    def expose_names(self):
+        """
+        The guest got hold of a live namespace and may change it behind the
+        back of the name caches: stop caching names for the rest of the run
+        """
+        self.names_exposed = True
+        self.cached_names.clear()
+
+    def guest_globals(self):
+        self.expose_names()
+        return self.frame.global_names
+
+    def guest_locals(self):
+        frame = self.frame
+        if frame.local_names is not None:
+            self.expose_names()
+        return frame.locals()
+
+    def guest_vars(self, *args):
+        if args:
+            return vars(*args)
+        return self.guest_locals()
+
+    def guest_super(self, *args):
+        if args:
+            return super(*args)
+        frame = self.frame
+        first = frame.code.co_varnames[0]
+        if first in frame.code.co_cellvars:
+            instance = frame.cells[first].get()
+        else:
+            instance = frame.fast_locals[0]
+        return super(frame.cells['__class__'].get(), instance)
+
+    def build_class(self, function, name, *bases, **kwds):
+        """
+        Guest replacement of builtins.__build_class__, class body is executed
+        by the virtual machine with the prepared namespace as its locals
+        """
+        metaclass, namespace, kwds = types.prepare_class(name, bases, kwds)
+        frame = self.make_frame(function.code, program=function.program, global_names=function.global_names,
+                                local_names=namespace, closure=function.closure)
+        cell = self.run_frame(frame)
+        class_cell = namespace.pop('__classcell__', None)
+        cls = metaclass(name, bases, namespace, **kwds)
+        for candidate in (cell, class_cell):
+            if isinstance(candidate, Cell):
+                candidate.set(cls)
+        return cls
 
     # Format
 
@@ -749,59 +2249,818 @@ class VirtualMachine:
     # Exceptions
 
     def RAISE_VARARGS(self, argc):
-        if argc == 3:
-            traceback, param, exc = self.popn(3)
-            self.push(exc(param, traceback))
-        elif argc == 2:
-            exc, param = self.popn(2)
-            self.push(exc(param))
-        elif argc == 1:
-            exc = self.pop()
-            self.push(exc())
-
-    def POP_EXCEPT(self):
-        block = self.pop_block()
-        if block.type != 'except-handler':
-            raise Exception("popped block is not an except handler")
-        self.unwind_block(block)
-
-    def SETUP_EXCEPT(self, target):
-        self.push_block('setup-except', self.frame.last_instruction + 2, target)
-
-    def SETUP_FINALLY(self, target):
-        self.push_block('finally', self.frame.last_instruction + 2, target)
-
-    def END_FINALLY(self):
-        v = self.pop()
-        if isinstance(v, str):
-            why = v
-            if why in ('return', 'continue'):
-                self.returned_value = self.pop()
-        elif v is None:
-            why = None
-        return why
-
-    def SETUP_WITH(self, delta):
-        cntxt = self.pop()
-        self.push(cntxt.__exit__)
-        cntxt_enter = cntxt.__enter__()
-        self.push_block('finally', self.frame.last_instruction + 2, delta)
-        self.push(cntxt_enter)
+        stack = self.frame.stack
+        if argc == 0:
+            if self.last_exception is None:
+                raise RuntimeError("No active exception to reraise")
+            raise self.last_exception[1].with_traceback(self.last_exception[2])
+        if argc == 2:
+            cause = stack.pop()
+            if isinstance(cause, type) and issubclass(cause, BaseException):
+                cause = cause()
+            elif cause is not None and not isinstance(cause, BaseException):
+                raise TypeError("exception causes must derive from BaseException")
+        exception = stack.pop()
+        if isinstance(exception, type) and issubclass(exception, BaseException):
+            exception = exception()
+        elif not isinstance(exception, BaseException):
+            raise TypeError("exceptions must derive from BaseException")
+        if argc == 2:
+            exception.__cause__ = cause
+        raise exception
+
+    def POP_EXCEPT(self, arg=None):
+        self.pop_except_handler()
+
+    def END_FINALLY(self, arg=None):
+        """
+        End of a finally or with block, or of except clauses none of which
+        matched. The item on top tells how the block was entered: None when
+        the protected code completed, Unwinding for return, break, continue
+        and exceptions silenced by __exit__, an exception instance when one
+        was raised, and exception type over value and traceback after except
+        clauses
+        """
+        stack = self.frame.stack
+        marker = stack.pop()
+        if marker is None:
+            return None
+        if type(marker) is Unwinding:
+            if marker is SILENCED:
+                self.pop_except_handler()
+                return None
+            self.returned_value = marker.value
+            return marker.why
+        if isinstance(marker, BaseException):
+            raise marker
+        value = stack.pop()
+        traceback = stack.pop()
+        raise value.with_traceback(traceback)
+
+    def SETUP_WITH(self, target):
+        stack = self.frame.stack
+        manager = stack.pop()
+        manager_type = type(manager)
+        enter = manager_type.__enter__
+        stack.append(manager_type.__exit__.__get__(manager, manager_type))
+        return self.call(enter.__get__(manager, manager_type), ())
+
+    def WITH_CLEANUP_START(self, arg=None):
+        stack = self.frame.stack
+        marker = stack.pop()
+        exit = stack.pop()
+        stack.append(marker)
+        if isinstance(marker, BaseException):
+            return self.call(exit, (type(marker), marker, marker.__traceback__))
+        return self.call(exit, (None, None, None))
+
+    def WITH_CLEANUP_FINISH(self, arg=None):
+        stack = self.frame.stack
+        result = stack.pop()
+        if isinstance(stack[-1], BaseException) and result:
+            stack[-1] = SILENCED
+
+    # Superinstructions: one dispatch runs several instructions, arguments
+    # come as a tuple. Instructions after the first one stay in the program
+    # for jumps landing on them and are skipped here
+
+    def LOAD_FAST__LOAD_FAST(self, arguments):
+        frame = self.frame
+        first, second = arguments
+        value = frame.fast_locals[first]
+        if value is NULL:
+            raise self.unbound_local(first)
+        other = frame.fast_locals[second]
+        if other is NULL:
+            raise self.unbound_local(second)
+        frame.stack.append(value)
+        frame.stack.append(other)
+        frame.last_instruction += 1
+
+    def LOAD_FAST__LOAD_CONST(self, arguments):
+        frame = self.frame
+        index, constant = arguments
+        value = frame.fast_locals[index]
+        if value is NULL:
+            raise self.unbound_local(index)
+        frame.stack.append(value)
+        frame.stack.append(constant)
+        frame.last_instruction += 1
+
+    def LOAD_FAST__LOAD_ATTR(self, arguments):
+        frame = self.frame
+        index, cache = arguments
+        value = frame.fast_locals[index]
+        if value is NULL:
+            raise self.unbound_local(index)
+        entry = cache.types.get(type(value))
+        if entry is None or cache.version != AttributeCache.types_version:
+            entry = cache.fill(type(value))
+        function, has_dict = entry
+        if function is None or has_dict and cache.name in value.__dict__:
+            frame.stack.append(getattr(value, cache.name))
+        else:
+            frame.stack.append(types.MethodType(function, value))
+        frame.last_instruction += 1
+
+    def LOAD_FAST__LOAD_METHOD(self, arguments):
+        frame = self.frame
+        index, cache = arguments
+        value = frame.fast_locals[index]
+        if value is NULL:
+            raise self.unbound_local(index)
+        entry = cache.types.get(type(value))
+        if entry is None or cache.version != AttributeCache.types_version:
+            entry = cache.fill(type(value))
+        function, has_dict = entry
+        if function is None or has_dict and cache.name in value.__dict__:
+            frame.stack.append(NULL)
+            frame.stack.append(getattr(value, cache.name))
+        else:
+            frame.stack.append(function)
+            frame.stack.append(value)
+        frame.last_instruction += 1
+
+    def STORE_FAST__LOAD_FAST(self, arguments):
+        frame = self.frame
+        store, load = arguments
+        frame.fast_locals[store] = frame.stack.pop()
+        value = frame.fast_locals[load]
+        if value is NULL:
+            raise self.unbound_local(load)
+        frame.stack.append(value)
+        frame.last_instruction += 1
+
+    def LOAD_CONST__BINARY_OP(self, arguments):
+        frame = self.frame
+        constant, operation = arguments
+        frame.stack[-1] = operation(frame.stack[-1], constant)
+        frame.last_instruction += 1
+
+    def LOAD_FAST__LOAD_CONST__BINARY_OP(self, arguments):
+        frame = self.frame
+        index, constant, operation = arguments
+        value = frame.fast_locals[index]
+        if value is NULL:
+            raise self.unbound_local(index)
+        frame.stack.append(operation(value, constant))
+        frame.last_instruction += 2
+
+    def LOAD_FAST__LOAD_FAST__BINARY_OP(self, arguments):
+        frame = self.frame
+        first, second, operation = arguments
+        value = frame.fast_locals[first]
+        if value is NULL:
+            raise self.unbound_local(first)
+        other = frame.fast_locals[second]
+        if other is NULL:
+            raise self.unbound_local(second)
+        frame.stack.append(operation(value, other))
+        frame.last_instruction += 2
+
+    def FOR_ITER__STORE_FAST(self, arguments):
+        frame = self.frame
+        target, index = arguments
+        try:
+            value = next(frame.stack[-1])
+        except StopIteration:
+            frame.stack.pop()
+            frame.last_instruction = target
+            return
+        frame.fast_locals[index] = value
+        frame.last_instruction += 1
+
+    def COMPARE_OP__POP_JUMP_IF_FALSE(self, arguments):
+        frame = self.frame
+        operation, target = arguments
+        right = frame.stack.pop()
+        if operation(frame.stack.pop(), right):
+            frame.last_instruction += 1
+        else:
+            frame.last_instruction = target
+
+    def COMPARE_OP__POP_JUMP_IF_TRUE(self, arguments):
+        frame = self.frame
+        operation, target = arguments
+        right = frame.stack.pop()
+        if operation(frame.stack.pop(), right):
+            frame.last_instruction = target
+        else:
+            frame.last_instruction += 1
+
+    def LOAD_CONST__RETURN_VALUE(self, arguments):
+        self.returned_value = arguments[0]
+        return 'return'
+
+    # Adaptive specialization
+
+    def adapt(self, specializations, operation, left, right):
+        """
+        Count down warm-up of the running adaptive instruction and, once it
+        is over, rewrite it for the types of the operands
+        """
+        frame = self.frame
+        program = frame.program
+        index = frame.last_instruction - 1
+        counter = program.warmup[index]
+        if counter:
+            program.warmup[index] = counter - 1
+            return
+        name = specializations.get((operation, type(left), type(right)))
+        if name is None:
+            name = specializations.get((operation, type(left), None))
+        program.opcodes[index] = QUICKENED[name] if name else program.generic_opcodes[index]
+
+    def deoptimize(self):
+        """
+        Turn the running specialized instruction back into the adaptive one
+        """
+        frame = self.frame
+        program = frame.program
+        index = frame.last_instruction - 1
+        program.opcodes[index] = ADAPTIVE_OPCODES[program.generic_opcodes[index]]
+        program.warmup[index] = ADAPTIVE_BACKOFF
+
+    def ADAPTIVE_BINARY_OP(self, operation):
+        stack = self.frame.stack
+        self.adapt(BINARY_SPECIALIZATIONS, operation, stack[-2], stack[-1])
+        right = stack.pop()
+        stack[-1] = operation(stack[-1], right)
+
+    def ADAPTIVE_COMPARE_JUMP(self, arguments):
+        operation, target = arguments
+        stack = self.frame.stack
+        self.adapt(COMPARE_JUMP_SPECIALIZATIONS, operation, stack[-2], stack[-1])
+        self.COMPARE_OP__POP_JUMP_IF_FALSE(arguments)
+
+    def ADAPTIVE_COMPARE_OP(self, operation):
+        stack = self.frame.stack
+        self.adapt(COMPARE_SPECIALIZATIONS, operation, stack[-2], stack[-1])
+        right = stack.pop()
+        stack[-1] = operation(stack[-1], right)
+
+    def ADAPTIVE_LOAD_CONST__BINARY_OP(self, arguments):
+        constant, operation = arguments
+        self.adapt(FUSED_BINARY_SPECIALIZATIONS['LOAD_CONST'], operation, self.frame.stack[-1], constant)
+        self.LOAD_CONST__BINARY_OP(arguments)
+
+    def ADAPTIVE_LOAD_FAST__LOAD_CONST__BINARY_OP(self, arguments):
+        index, constant, operation = arguments
+        self.adapt(FUSED_BINARY_SPECIALIZATIONS['LOAD_FAST__LOAD_CONST'], operation,
+                   self.frame.fast_locals[index], constant)
+        self.LOAD_FAST__LOAD_CONST__BINARY_OP(arguments)
+
+    def ADAPTIVE_LOAD_FAST__LOAD_FAST__BINARY_OP(self, arguments):
+        first, second, operation = arguments
+        fast_locals = self.frame.fast_locals
+        self.adapt(FUSED_BINARY_SPECIALIZATIONS['LOAD_FAST__LOAD_FAST'], operation,
+                   fast_locals[first], fast_locals[second])
+        self.LOAD_FAST__LOAD_FAST__BINARY_OP(arguments)
+
+    def BINARY_ADD_INT(self, operation):
+        stack = self.frame.stack
+        right = stack.pop()
+        left = stack[-1]
+        if type(left) is int and type(right) is int:
+            stack[-1] = left + right
+        else:
+            self.deoptimize()
+            stack[-1] = operation(left, right)
+
+    def BINARY_SUBTRACT_INT(self, operation):
+        stack = self.frame.stack
+        right = stack.pop()
+        left = stack[-1]
+        if type(left) is int and type(right) is int:
+            stack[-1] = left - right
+        else:
+            self.deoptimize()
+            stack[-1] = operation(left, right)
+
+    def BINARY_MULTIPLY_INT(self, operation):
+        stack = self.frame.stack
+        right = stack.pop()
+        left = stack[-1]
+        if type(left) is int and type(right) is int:
+            stack[-1] = left * right
+        else:
+            self.deoptimize()
+            stack[-1] = operation(left, right)
+
+    def BINARY_ADD_FLOAT(self, operation):
+        stack = self.frame.stack
+        right = stack.pop()
+        left = stack[-1]
+        if type(left) is float and type(right) is float:
+            stack[-1] = left + right
+        else:
+            self.deoptimize()
+            stack[-1] = operation(left, right)
+
+    def BINARY_SUBTRACT_FLOAT(self, operation):
+        stack = self.frame.stack
+        right = stack.pop()
+        left = stack[-1]
+        if type(left) is float and type(right) is float:
+            stack[-1] = left - right
+        else:
+            self.deoptimize()
+            stack[-1] = operation(left, right)
+
+    def BINARY_MULTIPLY_FLOAT(self, operation):
+        stack = self.frame.stack
+        right = stack.pop()
+        left = stack[-1]
+        if type(left) is float and type(right) is float:
+            stack[-1] = left * right
+        else:
+            self.deoptimize()
+            stack[-1] = operation(left, right)
+
+    def BINARY_TRUE_DIVIDE_FLOAT(self, operation):
+        stack = self.frame.stack
+        right = stack.pop()
+        left = stack[-1]
+        if type(left) is float and type(right) is float and right:
+            stack[-1] = left / right
+        else:
+            self.deoptimize()
+            stack[-1] = operation(left, right)
+
+    def BINARY_ADD_STR(self, operation):
+        stack = self.frame.stack
+        right = stack.pop()
+        left = stack[-1]
+        if type(left) is str and type(right) is str:
+            stack[-1] = left + right
+        else:
+            self.deoptimize()
+            stack[-1] = operation(left, right)
+
+    def BINARY_SUBSCR_LIST_INT(self, operation):
+        stack = self.frame.stack
+        right = stack.pop()
+        left = stack[-1]
+        if type(left) is list and type(right) is int:
+            stack[-1] = left[right]
+        else:
+            self.deoptimize()
+            stack[-1] = operation(left, right)
+
+    def BINARY_SUBSCR_DICT(self, operation):
+        stack = self.frame.stack
+        right = stack.pop()
+        left = stack[-1]
+        if type(left) is dict:
+            stack[-1] = left[right]
+        else:
+            self.deoptimize()
+            stack[-1] = operation(left, right)
+
+    def COMPARE_LT_INT__POP_JUMP_IF_FALSE(self, arguments):
+        frame = self.frame
+        right = frame.stack.pop()
+        left = frame.stack.pop()
+        if type(left) is int and type(right) is int:
+            result = left < right
+        else:
+            self.deoptimize()
+            result = arguments[0](left, right)
+        if result:
+            frame.last_instruction += 1
+        else:
+            frame.last_instruction = arguments[1]
+
+    def COMPARE_LE_INT__POP_JUMP_IF_FALSE(self, arguments):
+        frame = self.frame
+        right = frame.stack.pop()
+        left = frame.stack.pop()
+        if type(left) is int and type(right) is int:
+            result = left <= right
+        else:
+            self.deoptimize()
+            result = arguments[0](left, right)
+        if result:
+            frame.last_instruction += 1
+        else:
+            frame.last_instruction = arguments[1]
+
+    def COMPARE_GT_INT__POP_JUMP_IF_FALSE(self, arguments):
+        frame = self.frame
+        right = frame.stack.pop()
+        left = frame.stack.pop()
+        if type(left) is int and type(right) is int:
+            result = left > right
+        else:
+            self.deoptimize()
+            result = arguments[0](left, right)
+        if result:
+            frame.last_instruction += 1
+        else:
+            frame.last_instruction = arguments[1]
+
+    def COMPARE_GE_INT__POP_JUMP_IF_FALSE(self, arguments):
+        frame = self.frame
+        right = frame.stack.pop()
+        left = frame.stack.pop()
+        if type(left) is int and type(right) is int:
+            result = left >= right
+        else:
+            self.deoptimize()
+            result = arguments[0](left, right)
+        if result:
+            frame.last_instruction += 1
+        else:
+            frame.last_instruction = arguments[1]
+
+    def COMPARE_EQ_INT__POP_JUMP_IF_FALSE(self, arguments):
+        frame = self.frame
+        right = frame.stack.pop()
+        left = frame.stack.pop()
+        if type(left) is int and type(right) is int:
+            result = left == right
+        else:
+            self.deoptimize()
+            result = arguments[0](left, right)
+        if result:
+            frame.last_instruction += 1
+        else:
+            frame.last_instruction = arguments[1]
+
+    def COMPARE_NE_INT__POP_JUMP_IF_FALSE(self, arguments):
+        frame = self.frame
+        right = frame.stack.pop()
+        left = frame.stack.pop()
+        if type(left) is int and type(right) is int:
+            result = left != right
+        else:
+            self.deoptimize()
+            result = arguments[0](left, right)
+        if result:
+            frame.last_instruction += 1
+        else:
+            frame.last_instruction = arguments[1]
+
+    def COMPARE_LT_INT(self, operation):
+        stack = self.frame.stack
+        right = stack.pop()
+        left = stack[-1]
+        if type(left) is int and type(right) is int:
+            stack[-1] = left < right
+        else:
+            self.deoptimize()
+            stack[-1] = operation(left, right)
+
+    def COMPARE_LE_INT(self, operation):
+        stack = self.frame.stack
+        right = stack.pop()
+        left = stack[-1]
+        if type(left) is int and type(right) is int:
+            stack[-1] = left <= right
+        else:
+            self.deoptimize()
+            stack[-1] = operation(left, right)
+
+    def COMPARE_GT_INT(self, operation):
+        stack = self.frame.stack
+        right = stack.pop()
+        left = stack[-1]
+        if type(left) is int and type(right) is int:
+            stack[-1] = left > right
+        else:
+            self.deoptimize()
+            stack[-1] = operation(left, right)
+
+    def COMPARE_GE_INT(self, operation):
+        stack = self.frame.stack
+        right = stack.pop()
+        left = stack[-1]
+        if type(left) is int and type(right) is int:
+            stack[-1] = left >= right
+        else:
+            self.deoptimize()
+            stack[-1] = operation(left, right)
+
+    def COMPARE_EQ_INT(self, operation):
+        stack = self.frame.stack
+        right = stack.pop()
+        left = stack[-1]
+        if type(left) is int and type(right) is int:
+            stack[-1] = left == right
+        else:
+            self.deoptimize()
+            stack[-1] = operation(left, right)
+
+    def COMPARE_NE_INT(self, operation):
+        stack = self.frame.stack
+        right = stack.pop()
+        left = stack[-1]
+        if type(left) is int and type(right) is int:
+            stack[-1] = left != right
+        else:
+            self.deoptimize()
+            stack[-1] = operation(left, right)
+
+    def LOAD_CONST__BINARY_ADD_INT(self, arguments):
+        frame = self.frame
+        stack = frame.stack
+        left = stack[-1]
+        if type(left) is int:
+            stack[-1] = left + arguments[0]
+            frame.last_instruction += 1
+        else:
+            self.deoptimize()
+            self.LOAD_CONST__BINARY_OP(arguments)
+
+    def LOAD_CONST__BINARY_SUBTRACT_INT(self, arguments):
+        frame = self.frame
+        stack = frame.stack
+        left = stack[-1]
+        if type(left) is int:
+            stack[-1] = left - arguments[0]
+            frame.last_instruction += 1
+        else:
+            self.deoptimize()
+            self.LOAD_CONST__BINARY_OP(arguments)
+
+    def LOAD_CONST__BINARY_MULTIPLY_INT(self, arguments):
+        frame = self.frame
+        stack = frame.stack
+        left = stack[-1]
+        if type(left) is int:
+            stack[-1] = left * arguments[0]
+            frame.last_instruction += 1
+        else:
+            self.deoptimize()
+            self.LOAD_CONST__BINARY_OP(arguments)
+
+    def LOAD_CONST__BINARY_ADD_FLOAT(self, arguments):
+        frame = self.frame
+        stack = frame.stack
+        left = stack[-1]
+        if type(left) is float:
+            stack[-1] = left + arguments[0]
+            frame.last_instruction += 1
+        else:
+            self.deoptimize()
+            self.LOAD_CONST__BINARY_OP(arguments)
+
+    def LOAD_CONST__BINARY_SUBTRACT_FLOAT(self, arguments):
+        frame = self.frame
+        stack = frame.stack
+        left = stack[-1]
+        if type(left) is float:
+            stack[-1] = left - arguments[0]
+            frame.last_instruction += 1
+        else:
+            self.deoptimize()
+            self.LOAD_CONST__BINARY_OP(arguments)
+
+    def LOAD_CONST__BINARY_MULTIPLY_FLOAT(self, arguments):
+        frame = self.frame
+        stack = frame.stack
+        left = stack[-1]
+        if type(left) is float:
+            stack[-1] = left * arguments[0]
+            frame.last_instruction += 1
+        else:
+            self.deoptimize()
+            self.LOAD_CONST__BINARY_OP(arguments)
+
+    def LOAD_FAST__LOAD_CONST__BINARY_ADD_INT(self, arguments):
+        frame = self.frame
+        index, constant, _ = arguments
+        value = frame.fast_locals[index]
+        if type(value) is int:
+            frame.stack.append(value + constant)
+            frame.last_instruction += 2
+        else:
+            self.deoptimize()
+            self.LOAD_FAST__LOAD_CONST__BINARY_OP(arguments)
+
+    def LOAD_FAST__LOAD_CONST__BINARY_SUBTRACT_INT(self, arguments):
+        frame = self.frame
+        index, constant, _ = arguments
+        value = frame.fast_locals[index]
+        if type(value) is int:
+            frame.stack.append(value - constant)
+            frame.last_instruction += 2
+        else:
+            self.deoptimize()
+            self.LOAD_FAST__LOAD_CONST__BINARY_OP(arguments)
+
+    def LOAD_FAST__LOAD_CONST__BINARY_MULTIPLY_INT(self, arguments):
+        frame = self.frame
+        index, constant, _ = arguments
+        value = frame.fast_locals[index]
+        if type(value) is int:
+            frame.stack.append(value * constant)
+            frame.last_instruction += 2
+        else:
+            self.deoptimize()
+            self.LOAD_FAST__LOAD_CONST__BINARY_OP(arguments)
+
+    def LOAD_FAST__LOAD_CONST__BINARY_ADD_FLOAT(self, arguments):
+        frame = self.frame
+        index, constant, _ = arguments
+        value = frame.fast_locals[index]
+        if type(value) is float:
+            frame.stack.append(value + constant)
+            frame.last_instruction += 2
+        else:
+            self.deoptimize()
+            self.LOAD_FAST__LOAD_CONST__BINARY_OP(arguments)
+
+    def LOAD_FAST__LOAD_CONST__BINARY_SUBTRACT_FLOAT(self, arguments):
+        frame = self.frame
+        index, constant, _ = arguments
+        value = frame.fast_locals[index]
+        if type(value) is float:
+            frame.stack.append(value - constant)
+            frame.last_instruction += 2
+        else:
+            self.deoptimize()
+            self.LOAD_FAST__LOAD_CONST__BINARY_OP(arguments)
+
+    def LOAD_FAST__LOAD_CONST__BINARY_MULTIPLY_FLOAT(self, arguments):
+        frame = self.frame
+        index, constant, _ = arguments
+        value = frame.fast_locals[index]
+        if type(value) is float:
+            frame.stack.append(value * constant)
+            frame.last_instruction += 2
+        else:
+            self.deoptimize()
+            self.LOAD_FAST__LOAD_CONST__BINARY_OP(arguments)
+
+    def LOAD_FAST__LOAD_FAST__BINARY_ADD_INT(self, arguments):
+        frame = self.frame
+        first, second, _ = arguments
+        value = frame.fast_locals[first]
+        other = frame.fast_locals[second]
+        if type(value) is int and type(other) is int:
+            frame.stack.append(value + other)
+            frame.last_instruction += 2
+        else:
+            self.deoptimize()
+            self.LOAD_FAST__LOAD_FAST__BINARY_OP(arguments)
+
+    def LOAD_FAST__LOAD_FAST__BINARY_SUBTRACT_INT(self, arguments):
+        frame = self.frame
+        first, second, _ = arguments
+        value = frame.fast_locals[first]
+        other = frame.fast_locals[second]
+        if type(value) is int and type(other) is int:
+            frame.stack.append(value - other)
+            frame.last_instruction += 2
+        else:
+            self.deoptimize()
+            self.LOAD_FAST__LOAD_FAST__BINARY_OP(arguments)
+
+    def LOAD_FAST__LOAD_FAST__BINARY_MULTIPLY_INT(self, arguments):
+        frame = self.frame
+        first, second, _ = arguments
+        value = frame.fast_locals[first]
+        other = frame.fast_locals[second]
+        if type(value) is int and type(other) is int:
+            frame.stack.append(value * other)
+            frame.last_instruction += 2
+        else:
+            self.deoptimize()
+            self.LOAD_FAST__LOAD_FAST__BINARY_OP(arguments)
+
+    def LOAD_FAST__LOAD_FAST__BINARY_ADD_FLOAT(self, arguments):
+        frame = self.frame
+        first, second, _ = arguments
+        value = frame.fast_locals[first]
+        other = frame.fast_locals[second]
+        if type(value) is float and type(other) is float:
+            frame.stack.append(value + other)
+            frame.last_instruction += 2
+        else:
+            self.deoptimize()
+            self.LOAD_FAST__LOAD_FAST__BINARY_OP(arguments)
+
+    def LOAD_FAST__LOAD_FAST__BINARY_SUBTRACT_FLOAT(self, arguments):
+        frame = self.frame
+        first, second, _ = arguments
+        value = frame.fast_locals[first]
+        other = frame.fast_locals[second]
+        if type(value) is float and type(other) is float:
+            frame.stack.append(value - other)
+            frame.last_instruction += 2
+        else:
+            self.deoptimize()
+            self.LOAD_FAST__LOAD_FAST__BINARY_OP(arguments)
+
+    def LOAD_FAST__LOAD_FAST__BINARY_MULTIPLY_FLOAT(self, arguments):
+        frame = self.frame
+        first, second, _ = arguments
+        value = frame.fast_locals[first]
+        other = frame.fast_locals[second]
+        if type(value) is float and type(other) is float:
+            frame.stack.append(value * other)
+            frame.last_instruction += 2
+        else:
+            self.deoptimize()
+            self.LOAD_FAST__LOAD_FAST__BINARY_OP(arguments)
 
     # Zero level ops
 
-    def NOP(self):
+    def NOP(self, arg=None):
         pass
 
-    def PRINT_EXPR(self):
+    def PRINT_EXPR(self, arg=None):
         answer = self.pop()
 
     def run(self, code: types.CodeType) -> None:
         """
         :param code: code for interpreting
         """
-        global_frame = self.make_frame(code)
-        self.run_frame(global_frame)
+        self.run_program(load_program(code))
+
+    def run_program(self, program: Program, global_names: dict = None) -> None:
+        """
+        Run a program loaded beforehand, e.g. once for many runs
+        :param program: loaded module code
+        :param global_names: globals to run in, copy of MAIN_NAMESPACE by default
+        """
+        global_frame = self.make_frame(program.code, program=program, global_names=global_names,
+                                       local_names=global_names)
+        self.set_limits()
+        try:
+            self.run_frame(global_frame)
+        finally:
+            self.clear_limits()
+            self.cached_names.clear()
+
+    def start(self, code: types.CodeType) -> dict:
+        """
+        Prepare code to be run in slices by resume()
+        :param code: code for interpreting
+        :return: global namespace of the code
+        """
+        if self.profiler is not None:
+            raise ValueError("code run in slices can not be profiled")
+        global_frame = self.make_frame(code, program=load_program(code))
+        self.push_frame(global_frame)
+        self.set_limits()
+        return global_frame.global_names
+
+    def resume(self, ticks: int, error: BaseException = None) -> bool:
+        """
+        Continue started code for a slice of given number of ticks: backward
+        jumps and guest calls. The slice ends at the first one after the
+        countdown runs out, guest frames stay on the machine until the next.
+        Instruction budget and time limit count from start()
+        :param ticks: length of the slice
+        :param error: exception to raise where the code was preempted
+        :return: whether the code has finished
+        :raises: exception of the guest code, BudgetExceeded
+        """
+        self.slice_left = ticks
+        self.set_countdown()
+        if error is not None:
+            # Raised as if by the instruction due next
+            self.frame.last_instruction += 1
+        try:
+            finished = self.run_frame(self.frame, error, self.frames[0]) is not PREEMPTED
+        except BaseException:
+            self.clear_limits()
+            self.cached_names.clear()
+            raise
+        if finished:
+            self.clear_limits()
+            self.cached_names.clear()
+        else:
+            # Guest code called by the host between slices is not preempted
+            self.slice_left = sys.maxsize
+            self.set_countdown()
+        return finished
+
+
+def build_dispatch_table(vm_class):
+    """
+    Map every opcode id to the handler implementing it
+    :param vm_class: virtual machine class to take handlers from
+    :return: list of function(vm, argument) indexed by opcode
+    """
+    table = [vm_class.NOP] * len(dis.opname)
+    for opname, opcode in dis.opmap.items():
+        if opname in UNARY_OPERATORS:
+            table[opcode] = vm_class.UNARY_OP
+        elif opname in BINARY_OPERATORS:
+            table[opcode] = vm_class.BINARY_OP
+        elif opname in INPLACE_OPERATORS:
+            table[opcode] = vm_class.INPLACE_OP
+        else:
+            table[opcode] = getattr(vm_class, opname, vm_class.NOP)
+    for opname in OPNAMES[len(table):]:
+        table.append(getattr(vm_class, opname))
+    return table
+
+
+DISPATCH = build_dispatch_table(VirtualMachine)
 
 
 if __name__ == '__main__':
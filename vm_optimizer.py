@@ -0,0 +1,292 @@
+"""
+Peephole optimizer over decoded guest bytecode
+
+Works on the list of [opcode, argument, line] entries built by vm.Program
+before it is packed into arrays. Jump arguments are instruction indexes.
+Eliminated instructions are first turned into NOPs and then compacted away,
+remapping jump targets to the next surviving instruction.
+
+Usage: python -m vm_optimizer file.py
+"""
+import dis
+import sys
+import types
+import typing
+import operator
+
+NOP = dis.opmap['NOP']
+EXTENDED_ARG = dis.opmap['EXTENDED_ARG']
+LOAD_CONST = dis.opmap['LOAD_CONST']
+POP_TOP = dis.opmap['POP_TOP']
+
+JUMP_OPCODES = frozenset(dis.hasjrel + dis.hasjabs)
+UNCONDITIONAL_JUMPS = frozenset([dis.opmap['JUMP_ABSOLUTE'], dis.opmap['JUMP_FORWARD']])
+# Block setups keep their own targets: those mark where a block ends
+THREADED_JUMPS = frozenset(opcode for opcode in JUMP_OPCODES if not dis.opname[opcode].startswith('SETUP_'))
+# Instructions never followed by the next one
+TERMINATORS = UNCONDITIONAL_JUMPS | {dis.opmap['RETURN_VALUE'], dis.opmap['BREAK_LOOP'],
+                                     dis.opmap['CONTINUE_LOOP'], dis.opmap['RAISE_VARARGS']}
+FOLDABLE = frozenset(opcode for opcode, opname in enumerate(dis.opname)
+                     if opname.startswith(('BINARY_', 'UNARY_')))
+UNARY = frozenset(opcode for opcode, opname in enumerate(dis.opname) if opname.startswith('UNARY_'))
+
+CONSTANT_TYPES = (int, float, complex, str, bytes, bool, type(None))
+MAX_STRING_SIZE = 4096
+MAX_TUPLE_SIZE = 256
+MAX_INT_BITS = 128
+
+
+def optimize(entries: typing.List[list]) -> typing.List[list]:
+    """
+    Run all passes until nothing changes
+    :param entries: decoded instructions as [opcode, argument, line]
+    :return: new list of entries with jump targets remapped
+    """
+    while True:
+        changed = thread_jumps(entries)
+        changed |= fold_constants(entries)
+        changed |= remove_unreachable(entries)
+        if not changed:
+            return compact(entries)
+        entries = compact(entries)
+
+
+def jump_targets(entries: typing.List[list]) -> typing.Set[int]:
+    return {argument for opcode, argument, _ in entries if opcode in JUMP_OPCODES}
+
+
+def thread_jumps(entries: typing.List[list]) -> bool:
+    """
+    Retarget jumps landing on an unconditional jump to its final destination
+    and drop unconditional jumps to the next instruction
+    :return: whether any jump was changed
+    """
+    changed = False
+    for index, entry in enumerate(entries):
+        if entry[0] in UNCONDITIONAL_JUMPS and entry[1] == index + 1:
+            entry[0] = NOP
+            changed = True
+        if entry[0] not in THREADED_JUMPS:
+            continue
+        target = entry[1]
+        seen = set()
+        while target < len(entries) and entries[target][0] in UNCONDITIONAL_JUMPS and target not in seen:
+            seen.add(target)
+            target = entries[target][1]
+        if target != entry[1]:
+            entry[1] = target
+            changed = True
+    return changed
+
+
+def is_constant(value: typing.Any) -> bool:
+    if isinstance(value, tuple):
+        return all(is_constant(item) for item in value)
+    if isinstance(value, frozenset):
+        return all(is_constant(item) for item in value)
+    return isinstance(value, CONSTANT_TYPES)
+
+
+def is_small(value: typing.Any) -> bool:
+    if isinstance(value, (str, bytes)):
+        return len(value) <= MAX_STRING_SIZE
+    if isinstance(value, (tuple, frozenset)):
+        return len(value) <= MAX_TUPLE_SIZE
+    if isinstance(value, int):
+        return value.bit_length() <= MAX_INT_BITS
+    return True
+
+
+def size_limit(value: typing.Any) -> typing.Optional[int]:
+    if isinstance(value, (str, bytes)):
+        return MAX_STRING_SIZE
+    if isinstance(value, tuple):
+        return MAX_TUPLE_SIZE
+    return None
+
+
+def is_cheap(function: typing.Callable, operands: typing.List[typing.Any]) -> bool:
+    """
+    Whether the result of an operation stays small, judged from the sizes
+    of its operands before computing it, like safe_multiply, safe_power
+    and safe_lshift of CPython's peephole optimizer
+    """
+    if len(operands) != 2:
+        return True
+    left, right = operands
+    if function is operator.mul:
+        if isinstance(left, int) and isinstance(right, int):
+            return left.bit_length() + right.bit_length() <= MAX_INT_BITS
+        if isinstance(left, int):
+            left, right = right, left
+        limit = size_limit(left)
+        if limit is not None and isinstance(right, int):
+            return right <= 0 or len(left) * right <= limit
+    elif function is operator.pow:
+        if isinstance(left, int) and isinstance(right, int) and left and right > 0:
+            return left.bit_length() * right <= MAX_INT_BITS
+    elif function is operator.lshift:
+        if isinstance(left, int) and isinstance(right, int) and left and right > 0:
+            return right <= MAX_INT_BITS and left.bit_length() + right <= MAX_INT_BITS
+    elif function is operator.add:
+        limit = size_limit(left)
+        if limit is not None and type(left) is type(right):
+            return len(left) + len(right) <= limit
+    elif function is operator.mod:
+        # A format can ask for any width
+        return not isinstance(left, (str, bytes))
+    return True
+
+
+def evaluate(function: typing.Callable, operands: typing.List[typing.Any]) -> typing.Tuple[bool, typing.Any]:
+    """
+    :return: (folded, value); operations raising at run time or giving
+             large results are left alone
+    """
+    if not all(is_constant(operand) for operand in operands):
+        return False, None
+    if not is_cheap(function, operands):
+        return False, None
+    try:
+        value = function(*operands)
+    except Exception:
+        return False, None
+    if not is_constant(value) or not is_small(value):
+        return False, None
+    return True, value
+
+
+def fold_constants(entries: typing.List[list]) -> bool:
+    """
+    Replace LOAD_CONST operands of a pure unary or binary operation with the
+    result, and drop LOAD_CONST immediately discarded by POP_TOP
+    :return: whether anything was folded
+    """
+    targets = jump_targets(entries)
+    changed = False
+    # Indexes of the LOAD_CONST entries directly preceding the current one
+    loads = []
+    for index, entry in enumerate(entries):
+        opcode = entry[0]
+        if index in targets:
+            loads = []
+        if opcode == NOP:
+            continue
+        arity = 1 if opcode in UNARY else 2
+        if opcode in FOLDABLE and len(loads) >= arity:
+            operands = loads[-arity:]
+            folded, value = evaluate(entry[1], [entries[i][1] for i in operands])
+            if folded:
+                for i in operands:
+                    entries[i][0] = NOP
+                entry[0], entry[1] = LOAD_CONST, value
+                loads = loads[:-arity]
+                loads.append(index)
+                changed = True
+                continue
+        if opcode == POP_TOP and loads:
+            entries[loads.pop()][0] = NOP
+            entry[0] = NOP
+            changed = True
+            continue
+        if opcode == LOAD_CONST:
+            loads.append(index)
+        else:
+            loads = []
+    return changed
+
+
+def remove_unreachable(entries: typing.List[list]) -> bool:
+    """
+    Turn instructions not reachable from the entry point into NOPs
+    :return: whether any instruction was removed
+    """
+    reachable = [False] * len(entries)
+    pending = [0]
+    while pending:
+        index = pending.pop()
+        while index < len(entries) and not reachable[index]:
+            reachable[index] = True
+            opcode, argument, _ = entries[index]
+            if opcode in JUMP_OPCODES:
+                pending.append(argument)
+            if opcode in TERMINATORS:
+                break
+            index += 1
+    changed = False
+    for index, entry in enumerate(entries):
+        if not reachable[index] and entry[0] != NOP:
+            entry[0] = NOP
+            changed = True
+    return changed
+
+
+def compact(entries: typing.List[list]) -> typing.List[list]:
+    """
+    Drop NOP and EXTENDED_ARG entries
+    """
+    return remove(entries, (NOP, EXTENDED_ARG))[0]
+
+
+def remove(entries: typing.List[list], opcodes: typing.Container[int]) -> typing.Tuple[typing.List[list],
+                                                                                       typing.List[int]]:
+    """
+    Drop entries with given opcodes; a jump to a dropped instruction lands
+    on the next kept one
+    :return: kept entries and the new index of every old one
+    """
+    positions = []
+    result = []
+    for entry in entries:
+        positions.append(len(result))
+        if entry[0] not in opcodes:
+            result.append(entry)
+    positions.append(len(result))
+    for entry in result:
+        if entry[0] in JUMP_OPCODES:
+            entry[1] = positions[entry[1]]
+    return result, positions
+
+
+def report(programs: typing.Iterable[typing.Any]) -> typing.List[typing.Dict[str, typing.Any]]:
+    """
+    :param programs: vm.Program instances, e.g. vm.code_cache.programs()
+    :return: instruction counts before and after the peephole pass per code object
+    """
+    result = [{
+        'function': "{} ({}:{})".format(program.code.co_name, program.code.co_filename,
+                                        program.code.co_firstlineno),
+        'original': instruction_count(program.code),
+        'optimized': instruction_count(program.code) - program.eliminated,
+        'eliminated': program.eliminated,
+    } for program in programs]
+    return sorted(result, key=lambda item: item['eliminated'], reverse=True)
+
+
+def instruction_count(code: types.CodeType) -> int:
+    """
+    :return: number of instructions of code, EXTENDED_ARG prefixes are not counted
+    """
+    return sum(1 for opcode in code.co_code[::2] if opcode != EXTENDED_ARG)
+
+
+def nested_code(code: types.CodeType) -> typing.Iterator[types.CodeType]:
+    yield code
+    for constant in code.co_consts:
+        if isinstance(constant, types.CodeType):
+            yield from nested_code(constant)
+
+
+def main() -> None:
+    import vm
+
+    with open(sys.argv[1]) as f:
+        code = compile(f.read(), sys.argv[1], 'exec')
+    programs = [vm.Program(nested, optimize=True) for nested in nested_code(code)]
+    print("{:<60}{:>10}{:>11}{:>12}".format('function', 'original', 'optimized', 'eliminated'))
+    for item in report(programs):
+        print("{function:<60}{original:>10}{optimized:>11}{eliminated:>12}".format(**item))
+
+
+if __name__ == '__main__':
+    main()
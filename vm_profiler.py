@@ -0,0 +1,136 @@
+import io
+import sys
+import json
+import time
+import typing
+from collections import defaultdict
+
+import vm
+
+
+class ProgramStats:
+    """
+    Execution counters of one code object, indexed by instruction. Counts are
+    of dispatches: a superinstruction runs lengths[index] guest instructions,
+    or one for each of jumps[index] when it starts with a jump taken
+    """
+    __slots__ = ('program', 'counts', 'times', 'calls', 'total_time', 'depth', 'lengths', 'jump_starts',
+                 'jumps')
+
+    def __init__(self, program: vm.Program):
+        self.program = program
+        self.lengths = [vm.FUSED_LENGTHS.get(opcode, 1) for opcode in program.generic_opcodes]
+        self.jump_starts = frozenset(index for index, opcode in enumerate(program.generic_opcodes)
+                                     if opcode in vm.FUSED_JUMP_STARTS)
+        self.jumps = [0] * len(program)
+        self.counts = [0] * len(program)
+        self.times = [0.0] * len(program)
+        self.calls = 0
+        self.total_time = 0.0
+        self.depth = 0
+
+    def instructions(self, index: int) -> int:
+        """
+        :return: number of guest instructions run by the instruction at index
+        """
+        return self.counts[index] * self.lengths[index] - self.jumps[index] * (self.lengths[index] - 1)
+
+    @property
+    def name(self) -> str:
+        code = self.program.code
+        return "{} ({}:{})".format(code.co_name, code.co_filename, code.co_firstlineno)
+
+
+class Profiler:
+    """
+    Collects per opcode, per guest function and per source line statistics.
+    Pass an instance to VirtualMachine(profiler=...) to enable profiling
+    """
+    def __init__(self, timer: typing.Callable[[], float] = time.perf_counter):
+        self.timer = timer
+        self.programs = {}
+        self.child_time = 0.0
+
+    def stats_for(self, program: vm.Program) -> ProgramStats:
+        stats = self.programs.get(program)
+        if stats is None:
+            stats = self.programs[program] = ProgramStats(program)
+        return stats
+
+    def clear(self) -> None:
+        self.programs.clear()
+        self.child_time = 0.0
+
+    def opcode_stats(self) -> typing.List[typing.Dict[str, typing.Any]]:
+        """
+        Statistics by opcode as loaded, before adaptive specialization;
+        counts are of guest instructions, so a superinstruction counts every
+        instruction it fused
+        """
+        counts = defaultdict(int)
+        times = defaultdict(float)
+        for stats in self.programs.values():
+            opcodes = stats.program.generic_opcodes
+            for index, count in enumerate(stats.counts):
+                if count:
+                    opname = vm.OPNAMES[opcodes[index]]
+                    counts[opname] += stats.instructions(index)
+                    times[opname] += stats.times[index]
+        result = [{'opname': opname, 'count': count, 'time': times[opname]} for opname, count in counts.items()]
+        return sorted(result, key=lambda item: item['time'], reverse=True)
+
+    def function_stats(self) -> typing.List[typing.Dict[str, typing.Any]]:
+        result = [{
+            'function': stats.name,
+            'calls': stats.calls,
+            'instructions': sum(stats.instructions(index) for index in range(len(stats.counts))),
+            'total_time': stats.total_time,
+            'self_time': sum(stats.times),
+        } for stats in self.programs.values()]
+        return sorted(result, key=lambda item: item['self_time'], reverse=True)
+
+    def line_stats(self) -> typing.List[typing.Dict[str, typing.Any]]:
+        counts = defaultdict(int)
+        times = defaultdict(float)
+        for stats in self.programs.values():
+            filename = stats.program.code.co_filename
+            lines = stats.program.lines
+            for index, count in enumerate(stats.counts):
+                if count:
+                    key = filename, lines[index]
+                    counts[key] += stats.instructions(index)
+                    times[key] += stats.times[index]
+        result = [{'filename': filename, 'line': line, 'count': count, 'time': times[filename, line]}
+                  for (filename, line), count in counts.items()]
+        return sorted(result, key=lambda item: item['time'], reverse=True)
+
+    def to_json(self) -> typing.Dict[str, typing.Any]:
+        return {
+            'opcodes': self.opcode_stats(),
+            'functions': self.function_stats(),
+            'lines': self.line_stats(),
+        }
+
+    def dump_json(self, path: str) -> None:
+        with open(path, 'w') as f:
+            json.dump(self.to_json(), f, indent=4)
+
+    def report(self, stream: io._io._TextIOBase = sys.stdout, limit: int = 20) -> None:
+        """
+        Write tables sorted by time spent, limited to top entries
+        :param stream: stream to write results
+        :param limit: number of rows in each table
+        """
+        data = ["\nOpcodes:", "\t{:<28}{:>12}{:>12}".format('opname', 'count', 'time, s')]
+        data.extend("\t{opname:<28}{count:>12}{time:>12.6f}".format(**item)
+                    for item in self.opcode_stats()[:limit])
+        data.extend(["Functions:", "\t{:<40}{:>8}{:>14}{:>12}{:>12}".format(
+            'function', 'calls', 'instructions', 'total, s', 'self, s')])
+        data.extend("\t{function:<40}{calls:>8}{instructions:>14}{total_time:>12.6f}{self_time:>12.6f}".format(**item)
+                    for item in self.function_stats()[:limit])
+        data.extend(["Lines:", "\t{:<40}{:>12}{:>12}".format('line', 'count', 'time, s')])
+        data.extend("\t{:<40}{:>12}{:>12.6f}".format(
+            "{}:{}".format(item['filename'], item['line']), item['count'], item['time'])
+            for item in self.line_stats()[:limit])
+        data.append("\n")
+        stream.write("\n".join(data))
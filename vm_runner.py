@@ -1,29 +1,180 @@
 import io
+import os
 import dis
 import sys
+import mmap
 import types
 import typing
+import hashlib
+import marshal
+import tempfile
+import threading
 import traceback
+import collections
+import importlib.util
+import multiprocessing
 
 from contextlib import contextmanager
 
+import vm
 
-def compile_code(text_code: typing.Union[types.CodeType, str]) -> types.CodeType:
+BatchResult = collections.namedtuple('BatchResult', 'name, out, err, exception')
+
+
+def default_cache_directory() -> typing.Optional[str]:
+    """
+    VM_COMPILE_CACHE environment variable if set (empty value disables disk cache),
+    otherwise vm-compile directory in the user cache directory
+    """
+    if 'VM_COMPILE_CACHE' in os.environ:
+        return os.environ['VM_COMPILE_CACHE'] or None
+    cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(cache_home, 'vm-compile')
+
+
+class CompileCache:
+    """
+    Content-addressed cache of compiled sources. Keys are hashes of source text
+    and interpreter magic number, values live in an in-memory LRU and as marshal
+    files on disk which are pruned by modification time above the size cap
+    """
+    def __init__(self, directory: typing.Optional[str] = None, max_bytes: int = 64 * 1024 * 1024,
+                 memory_size: int = 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.memory_size = memory_size
+        self._memory = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._disk_bytes = None
+
+    @staticmethod
+    def key(text_code: str) -> str:
+        digest = hashlib.sha256(importlib.util.MAGIC_NUMBER)
+        digest.update(text_code.encode('utf-8', 'surrogatepass'))
+        return digest.hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key + '.marshal')
+
+    def get(self, text_code: str) -> typing.Optional[types.CodeType]:
+        key = self.key(text_code)
+        with self._lock:
+            code = self._memory.get(key)
+            if code is not None:
+                self._memory.move_to_end(key)
+                return code
+        if self.directory is None:
+            return None
+        try:
+            with open(self._path(key), 'rb') as f:
+                code = marshal.load(f)
+            os.utime(self._path(key))
+        except (OSError, EOFError, ValueError, TypeError):
+            return None
+        self._remember(key, code)
+        return code
+
+    def put(self, text_code: str, code: types.CodeType) -> None:
+        key = self.key(text_code)
+        self._remember(key, code)
+        if self.directory is None:
+            return
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            data = marshal.dumps(code)
+            descriptor, temporary = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+            try:
+                with os.fdopen(descriptor, 'wb') as f:
+                    f.write(data)
+                try:
+                    replaced = os.stat(self._path(key)).st_size
+                except FileNotFoundError:
+                    replaced = 0
+                os.replace(temporary, self._path(key))
+            except BaseException:
+                try:
+                    os.remove(temporary)
+                except OSError:
+                    pass
+                raise
+        except OSError:
+            return
+        with self._lock:
+            if self._disk_bytes is None:
+                self._disk_bytes = self._scan()[1]
+            else:
+                self._disk_bytes += len(data) - replaced
+            if self._disk_bytes > self.max_bytes:
+                self._prune()
+
+    def _remember(self, key: str, code: types.CodeType) -> None:
+        with self._lock:
+            self._memory[key] = code
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.memory_size:
+                self._memory.popitem(last=False)
+
+    def _scan(self) -> typing.Tuple[typing.List[typing.Tuple[float, int, str]], int]:
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.marshal'):
+                path = os.path.join(self.directory, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+        return entries, sum(size for _, size, _ in entries)
+
+    def _prune(self) -> None:
+        """
+        Remove least recently used files until the cache fits into half of the size cap
+        """
+        entries, total = self._scan()
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes // 2:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+        self._disk_bytes = total
+
+    def clear(self) -> None:
+        with self._lock:
+            self._memory.clear()
+            if self.directory is not None and os.path.isdir(self.directory):
+                for _, _, path in self._scan()[0]:
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        pass
+            self._disk_bytes = None
+
+
+compile_cache = CompileCache(default_cache_directory())
+
+
+def compile_code(text_code: typing.Union[types.CodeType, str],
+                 cache: typing.Optional[CompileCache] = compile_cache) -> types.CodeType:
     """
     This is utility function with primary purpose to convert string code to code type.
-    Secondary purpose - print byte code for text_code and all nested text_code
+    Compiled code is looked up in and stored to compile cache
     :param text_code: text code for compiling
+    :param cache: compile cache to use, None disables caching
     :return: compiled code
     """
-    if isinstance(text_code, str):
-        # print("Text code:\n{}\n".format(text_code))
-        code = compile(text_code, '<stdin>', 'exec')
-    else:
-        code = text_code
+    if not isinstance(text_code, str):
+        return text_code
 
-    for const in code.co_consts:
-        if isinstance(const, types.CodeType):
-            compile_code(const)
+    if cache is not None:
+        code = cache.get(text_code)
+        if code is not None:
+            return code
+    code = compile(text_code, '<stdin>', 'exec')
+    if cache is not None:
+        cache.put(text_code, code)
 
     # print("Disassembled code:\n")
     # dis.dis(code)
@@ -49,16 +200,106 @@ def redirected(out: io._io._TextIOBase = sys.stdout, err: io._io._TextIOBase = s
         sys.stderr = saved_stderr
 
 
-def execute(code: types.CodeType, func: typing.Callable[..., None], *args: [...]) -> typing.Tuple[str, str, Exception]:
+class OutputCapture(io.TextIOBase):
+    """
+    Text stream for captured output with bounded memory. Written text is
+    passed to on_chunk if it is given and kept otherwise: in memory up to
+    spill_bytes of UTF-8, then in a temporary file. Text from the character
+    which does not fit into max_bytes on is dropped and truncated is set
+    """
+    encoding = 'utf-8'
+
+    def __init__(self, on_chunk: typing.Optional[typing.Callable[[str], None]] = None,
+                 max_bytes: typing.Optional[int] = None, spill_bytes: typing.Optional[int] = None):
+        """
+        :param on_chunk: called with every piece of text written instead of keeping it
+        :param max_bytes: limit of UTF-8 bytes taken, unlimited if None
+        :param spill_bytes: size of UTF-8 text kept in memory before moving to a file, no limit if None
+        """
+        super().__init__()
+        self.on_chunk = on_chunk
+        self.max_bytes = max_bytes
+        self.spill_bytes = spill_bytes
+        self.size = 0
+        self.truncated = False
+        self._parts = []
+        self._file = None
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, text: str) -> int:
+        if self.truncated:
+            return len(text)
+        data = text.encode(self.encoding, 'surrogatepass')
+        if self.max_bytes is not None and self.size + len(data) > self.max_bytes:
+            self.truncated = True
+            # Cut before the character the limit falls into, so that only
+            # whole characters are kept and counted
+            end = self.max_bytes - self.size
+            while end and data[end] & 0xC0 == 0x80:
+                end -= 1
+            data = data[:end]
+            if not data:
+                return len(text)
+            text = data.decode(self.encoding, 'surrogatepass')
+        self.size += len(data)
+        if self.on_chunk is not None:
+            self.on_chunk(text)
+        elif self._file is not None:
+            self._file.write(data)
+        else:
+            self._parts.append(text)
+            if self.spill_bytes is not None and self.size > self.spill_bytes:
+                self._file = tempfile.TemporaryFile()
+                self._file.write(''.join(self._parts).encode(self.encoding, 'surrogatepass'))
+                self._parts = []
+        return len(text)
+
+    def getvalue(self) -> typing.Union[str, mmap.mmap]:
+        """
+        :return: text kept in memory, or read-only memory map of the UTF-8
+                 file it was spilled to, which stays valid after close()
+        """
+        if self._file is None:
+            return ''.join(self._parts)
+        self._file.flush()
+        return mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def close(self) -> None:
+        if self._file is not None:
+            self._file.close()
+        super().close()
+
+
+def captured_text(stream: io.TextIOBase) -> str:
+    """
+    :param stream: io.StringIO or OutputCapture written to
+    :return: text written, output spilled by OutputCapture is read back from its file
+    """
+    value = stream.getvalue()
+    if isinstance(value, str):
+        return value
+    try:
+        return value[:].decode(OutputCapture.encoding, 'surrogatepass')
+    finally:
+        value.close()
+
+
+def execute(code: types.CodeType, func: typing.Callable[..., None], *args: [...],
+            out: typing.Optional[io.TextIOBase] = None,
+            err: typing.Optional[io.TextIOBase] = None) -> typing.Tuple[str, str, Exception]:
     """
     Capture all output from function execution
     :param code: code object to calculate
     :param func: functions which
     :param args: any number of arguments appropriate for function call
-    :return: tuple of function execution output
+    :param out: stream to capture standard output with, e.g. OutputCapture, new io.StringIO by default
+    :param err: stream to capture standard error with, new io.StringIO by default
+    :return: tuple of function execution output, text of the streams as captured_text() gives it
     """
-    stdout = io.StringIO()
-    stderr = io.StringIO()
+    stdout = io.StringIO() if out is None else out
+    stderr = io.StringIO() if err is None else err
 
     exc = None
     with redirected(out=stdout, err=stderr):
@@ -69,6 +310,196 @@ def execute(code: types.CodeType, func: typing.Callable[..., None], *args: [...]
             traceback.print_exception(exc_type, exc_value, exc_traceback, file=sys.stderr)
             exc = e
 
-    out = stdout.getvalue()
-    err = stderr.getvalue()
-    return out, err, exc
+    return captured_text(stdout), captured_text(stderr), exc
+
+
+def execute_vm(code: typing.Union[types.CodeType, vm.Program],
+               machine: typing.Optional[vm.VirtualMachine] = None,
+               global_names: typing.Optional[typing.Dict[str, typing.Any]] = None, *,
+               out: typing.Optional[io.TextIOBase] = None,
+               err: typing.Optional[io.TextIOBase] = None) -> typing.Tuple[str, str, Exception]:
+    """
+    Capture all output of code running in a virtual machine through its own
+    output channels, process-wide sys.stdout and sys.stderr stay untouched
+    :param code: code object to calculate or program loaded from it
+    :param machine: virtual machine, new one by default; its output channels are restored afterwards
+    :param global_names: globals to run in, a new main module namespace by default
+    :param out: stream to capture standard output with, e.g. OutputCapture, new io.StringIO by default
+    :param err: stream to capture standard error with, new io.StringIO by default
+    :return: tuple of execution output, text of the streams as captured_text() gives it;
+             call getvalue() of a spilling OutputCapture to map its file instead
+    """
+    stdout = io.StringIO() if out is None else out
+    stderr = io.StringIO() if err is None else err
+    if machine is None:
+        machine = vm.VirtualMachine()
+    saved_streams = machine.stdout, machine.stderr
+    machine.stdout = stdout
+    machine.stderr = stderr
+
+    exc = None
+    try:
+        machine.run_program(code if isinstance(code, vm.Program) else vm.load_program(code), global_names)
+    except Exception as e:
+        traceback.print_exc(file=stderr)
+        exc = e
+    finally:
+        machine.stdout, machine.stderr = saved_streams
+
+    return captured_text(stdout), captured_text(stderr), exc
+
+
+class MachinePool:
+    """
+    Virtual machines kept between runs, reset when given back. Output
+    streams a guest rebound through sys are set back to those of the pool
+    """
+    def __init__(self, size: int = 8, **options: typing.Any):
+        """
+        :param size: maximum number of idle machines kept
+        :param options: keyword arguments of new machines
+        """
+        self.size = size
+        self.options = options
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def acquire(self) -> vm.VirtualMachine:
+        with self._lock:
+            if self._idle:
+                return self._idle.pop()
+        return vm.VirtualMachine(**self.options)
+
+    def release(self, machine: vm.VirtualMachine) -> None:
+        machine.reset()
+        machine.stdout = self.options.get('stdout')
+        machine.stderr = self.options.get('stderr')
+        with self._lock:
+            if len(self._idle) < self.size:
+                self._idle.append(machine)
+
+    @contextmanager
+    def machine(self) -> typing.Iterator[vm.VirtualMachine]:
+        machine = self.acquire()
+        try:
+            yield machine
+        finally:
+            self.release(machine)
+
+
+machine_pool = MachinePool()
+
+
+def _run_job(job: typing.Tuple[str, typing.Union[str, bytes]]) -> BatchResult:
+    """
+    Worker side of execute_batch, runs one program in a fresh virtual machine
+    :param job: name and either source text or marshalled code
+    :return: captured outputs and exception summary
+    """
+    name, payload = job
+    try:
+        code = compile_code(payload if isinstance(payload, str) else marshal.loads(payload))
+        with machine_pool.machine() as machine:
+            out, err, exc = execute_vm(code, machine)
+    except BaseException as e:
+        out, err, exc = '', traceback.format_exc(), e
+    return BatchResult(name, out, err, _summary(exc))
+
+
+def _summary(exc: typing.Optional[BaseException]) -> typing.Optional[str]:
+    if exc is None:
+        return None
+    return traceback.format_exception_only(type(exc), exc)[-1].strip()
+
+
+def execute_batch(jobs: typing.Iterable[typing.Tuple[typing.Union[types.CodeType, str], str]],
+                  workers: typing.Optional[int] = None,
+                  chunksize: int = 1) -> typing.Iterator[BatchResult]:
+    """
+    Run many programs in a pool of processes, each worker captures its own output
+    :param jobs: iterable of (code or source text, name) pairs
+    :param workers: number of worker processes, cpu count by default
+    :param chunksize: number of jobs sent to a worker at once
+    :return: iterator of results in completion order
+    """
+    payloads = ((name, code if isinstance(code, str) else marshal.dumps(code)) for code, name in jobs)
+    with multiprocessing.Pool(workers) as pool:
+        for result in pool.imap_unordered(_run_job, payloads, chunksize):
+            yield result
+
+
+class PreparedProgram:
+    """
+    Guest program compiled, decoded and optimized once to be run against
+    many sets of input globals
+    """
+    def __init__(self, code: typing.Union[types.CodeType, str]):
+        """
+        :param code: code object or source text of the program
+        """
+        self.code = compile_code(code)
+        self.program = vm.load_program(self.code)
+
+    def run(self, inputs: typing.Optional[typing.Dict[str, typing.Any]] = None,
+            machine: typing.Optional[vm.VirtualMachine] = None) -> typing.Tuple[str, str, Exception]:
+        """
+        :param inputs: globals set before the program starts
+        :param machine: virtual machine to run in, new one by default
+        :return: tuple of execution output
+        """
+        global_names = dict(vm.MAIN_NAMESPACE)
+        if inputs:
+            global_names.update(inputs)
+        return execute_vm(self.program, machine, global_names)
+
+
+# Program of a worker process of execute_many
+_prepared = None
+
+
+def _prepare_worker(payload: typing.Union[str, bytes]) -> None:
+    global _prepared
+    _prepared = PreparedProgram(payload if isinstance(payload, str) else marshal.loads(payload))
+
+
+def _run_input(job: typing.Tuple[int, typing.Dict[str, typing.Any]]) -> BatchResult:
+    """
+    Worker side of execute_many, runs the prepared program with one set of inputs
+    :param job: index and input globals
+    :return: captured outputs and exception summary
+    """
+    index, inputs = job
+    try:
+        with machine_pool.machine() as machine:
+            out, err, exc = _prepared.run(inputs, machine)
+    except BaseException as e:
+        out, err, exc = '', traceback.format_exc(), e
+    return BatchResult(index, out, err, _summary(exc))
+
+
+def execute_many(code: typing.Union[types.CodeType, str],
+                 inputs: typing.Iterable[typing.Dict[str, typing.Any]],
+                 workers: typing.Optional[int] = 0,
+                 chunksize: int = 16) -> typing.Iterator[BatchResult]:
+    """
+    Run one program against every set of input globals. The program is
+    compiled and decoded once per process and runs in one reused machine,
+    whose top-level frames come back from the frame free list
+    :param code: code object or source text of the program
+    :param inputs: iterable of input globals, consumed as results are taken
+    :param workers: number of worker processes, 0 runs in this process, None uses cpu count
+    :param chunksize: number of inputs sent to a worker at once
+    :return: iterator of results named by input index, in input order
+    """
+    if workers == 0:
+        prepared = PreparedProgram(code)
+        with machine_pool.machine() as machine:
+            for index, names in enumerate(inputs):
+                out, err, exc = prepared.run(names, machine)
+                machine.reset()
+                yield BatchResult(index, out, err, _summary(exc))
+        return
+    payload = code if isinstance(code, str) else marshal.dumps(code)
+    with multiprocessing.Pool(workers, _prepare_worker, (payload,)) as pool:
+        for result in pool.imap(_run_input, enumerate(inputs), chunksize):
+            yield result
@@ -0,0 +1,181 @@
+"""
+Cooperative scheduler running many virtual machines on one asyncio event loop
+
+Every guest program runs in its own VirtualMachine, resumed for a slice of
+a fixed number of ticks (backward jumps and guest calls, see
+VirtualMachine.resume) at a time. The scheduler yields to the event loop
+after every slice, so thousands of programs share one thread with other
+coroutines. Slices are given out by stride scheduling: priority is a weight
+and a program of priority 2 gets twice the slices of one of priority 1.
+
+Usage: python -m vm_scheduler file.py [--copies N] [--quantum N] [--priorities N ...]
+"""
+import io
+import sys
+import time
+import heapq
+import types
+import typing
+import asyncio
+import argparse
+import itertools
+from collections import defaultdict
+
+import vm
+import vm_runner
+
+DEFAULT_QUANTUM = 1000
+# Pass advance of a priority 1 program per slice
+STRIDE = 1 << 20
+
+
+class GuestTask:
+    """
+    Program submitted to a Scheduler. Awaiting it gives the global namespace
+    of the program or raises the exception it ended with
+    """
+    __slots__ = ('machine', 'priority', 'future', 'name', 'namespace', 'pass_value', 'slices')
+
+    def __init__(self, machine: vm.VirtualMachine, priority: int, future: asyncio.Future, name: str):
+        self.machine = machine
+        self.priority = priority
+        self.future = future
+        self.name = name
+        self.namespace = None
+        self.pass_value = 0
+        self.slices = 0
+
+    def __await__(self):
+        return self.future.__await__()
+
+    def cancel(self) -> bool:
+        """
+        Stop the program: if it has started, CancelledError is raised in it
+        at the next slice so that its finally clauses run, then it is dropped
+        :return: False if the program has already finished
+        """
+        return self.future.cancel()
+
+    def done(self) -> bool:
+        return self.future.done()
+
+    def result(self) -> dict:
+        return self.future.result()
+
+    def __repr__(self):
+        return '<GuestTask {} priority={} slices={}>'.format(self.name, self.priority, self.slices)
+
+
+class Scheduler:
+    def __init__(self, quantum: int = DEFAULT_QUANTUM, loop: typing.Optional[asyncio.AbstractEventLoop] = None):
+        """
+        :param quantum: ticks per slice
+        :param loop: event loop to run on, the current one by default
+        """
+        if quantum <= 0:
+            raise ValueError("quantum must be positive")
+        self.quantum = quantum
+        self.loop = loop or asyncio.get_event_loop()
+        # Heap of (pass, submission number, task)
+        self._ready = []
+        self._submitted = itertools.count()
+        self._pass = 0
+        self._driver = None
+
+    def __len__(self) -> int:
+        return len(self._ready)
+
+    def submit(self, code: typing.Union[types.CodeType, str], priority: int = 1,
+               machine: typing.Optional[vm.VirtualMachine] = None, name: typing.Optional[str] = None) -> GuestTask:
+        """
+        :param code: code object or source text of the program
+        :param priority: positive share of slices
+        :param machine: virtual machine without running code, new one by default
+        :param name: name shown in repr, file name of code by default
+        :return: awaitable handle of the program
+        """
+        if priority <= 0:
+            raise ValueError("priority must be positive")
+        code = vm_runner.compile_code(code)
+        if machine is None:
+            machine = vm.VirtualMachine()
+        task = GuestTask(machine, priority, self.loop.create_future(), name or code.co_filename)
+        task.namespace = machine.start(code)
+        # Start at the current pass so that a new program does not take over
+        task.pass_value = self._pass
+        heapq.heappush(self._ready, (task.pass_value, next(self._submitted), task))
+        if self._driver is None or self._driver.done():
+            self._driver = self.loop.create_task(self._drive())
+        return task
+
+    async def _drive(self) -> None:
+        while self._ready:
+            self._pass, _, task = heapq.heappop(self._ready)
+            if self._step(task):
+                task.pass_value = self._pass + STRIDE // task.priority
+                heapq.heappush(self._ready, (task.pass_value, next(self._submitted), task))
+            await asyncio.sleep(0)
+
+    def _step(self, task: GuestTask) -> bool:
+        """
+        Run one slice of task and settle its future if it ended
+        :return: whether task is to be run further
+        """
+        error = None
+        if task.future.cancelled():
+            if not task.slices:
+                return False
+            error = asyncio.CancelledError()
+        task.slices += 1
+        try:
+            finished = task.machine.resume(self.quantum, error)
+        except BaseException as e:
+            if not task.future.done():
+                task.future.set_exception(e)
+            return False
+        if finished:
+            if not task.future.done():
+                task.future.set_result(task.namespace)
+            return False
+        # A program which went on after cancellation is dropped as is
+        return error is None
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('file', help='guest program')
+    parser.add_argument('--copies', type=int, default=1000, help='number of programs run at once')
+    parser.add_argument('--quantum', type=int, default=DEFAULT_QUANTUM, help='ticks per slice')
+    parser.add_argument('--priorities', type=int, nargs='*', default=[1, 2, 4],
+                        help='priorities given to copies in turn')
+    args = parser.parse_args()
+
+    with open(args.file) as f:
+        code = compile(f.read(), args.file, 'exec')
+    loop = asyncio.get_event_loop()
+    scheduler = Scheduler(args.quantum, loop)
+    started = time.perf_counter()
+    finish_times = {}
+    tasks = []
+    for number in range(args.copies):
+        machine = vm.VirtualMachine(stdout=io.StringIO(), stderr=io.StringIO())
+        task = scheduler.submit(code, args.priorities[number % len(args.priorities)], machine,
+                                '{}#{}'.format(args.file, number))
+        task.future.add_done_callback(lambda _, task=task: finish_times.update({task: time.perf_counter()}))
+        tasks.append(task)
+    loop.run_until_complete(asyncio.wait([task.future for task in tasks]))
+
+    by_priority = defaultdict(list)
+    for task in tasks:
+        by_priority[task.priority].append(task)
+    print("{:>10}{:>10}{:>10}{:>14}{:>12}".format('priority', 'programs', 'failed', 'mean slices', 'mean end, s'))
+    for priority, group in sorted(by_priority.items()):
+        failed = sum(1 for task in group if task.future.exception() is not None)
+        print("{:>10}{:>10}{:>10}{:>14.1f}{:>12.3f}".format(
+            priority, len(group), failed, sum(task.slices for task in group) / len(group),
+            sum(finish_times[task] - started for task in group) / len(group)))
+    print("total {:.3f} s".format(time.perf_counter() - started), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
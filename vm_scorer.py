@@ -148,23 +148,63 @@ def generate_stub_operations() -> None:
 
 
 class StatData:
-    def __init__(self, code: str, operations: typing.Dict[str, int]):
+    def __init__(self, code: str, operations: typing.Dict[str, int], level: int):
         self.code = code
         self.operations = operations
+        self.level = level
 
 
 class Scorer:
+    """
+    Keeps running totals of operations, levels and coverage which are
+    updated as tests are added or removed, so that lookups are O(1)
+    """
     def __init__(self,
                  tests: typing.List[str],
                  level_scores: typing.Dict[int, int] = LEVEL_SCORES,
                  operations_levels: typing.Dict[str, int] = OPERATION_LEVELS):
         self._level_scores = level_scores
         self._operations_levels = operations_levels
-        self._stat = [self._collect(test) for test in tests]
+        self._stat = {}
+        self._tests_count = Counter()
+        self._total_stat = {key: 0 for key in self._operations_levels}
+        self._level_stats = {level: 0 for level in self._level_scores}
+        self._levels_coverage = {level: 0 for level in self._level_scores}
+        self._operations_coverage = 0
+        for test in tests:
+            self.add_test(test)
 
     def _collect(self, text_code: str) -> StatData:
         operations = self.get_operations(text_code)
-        return StatData(text_code, operations)
+        return StatData(text_code, operations, self.get_test_level(operations))
+
+    def _update_operations(self, operations: typing.Dict[str, int], sign: int) -> None:
+        for key, value in operations.items():
+            before = self._total_stat[key]
+            after = self._total_stat[key] = before + sign * value
+            if (before > 0) != (after > 0):
+                change = 1 if after > 0 else -1
+                self._operations_coverage += change
+                self._levels_coverage[self._operations_levels[key]] += change
+
+    def add_test(self, text_code: str) -> None:
+        stat = self._stat.get(text_code)
+        if stat is None:
+            stat = self._stat[text_code] = self._collect(text_code)
+        self._tests_count[text_code] += 1
+        self._level_stats[stat.level] += 1
+        self._update_operations(stat.operations, 1)
+
+    def remove_test(self, text_code: str) -> None:
+        if not self._tests_count[text_code]:
+            raise KeyError("test is not in the corpus")
+        stat = self._stat[text_code]
+        self._tests_count[text_code] -= 1
+        if not self._tests_count[text_code]:
+            del self._tests_count[text_code]
+            del self._stat[text_code]
+        self._level_stats[stat.level] -= 1
+        self._update_operations(stat.operations, -1)
 
     def get_level_operations_count(self) -> Counter:
         return Counter(self._operations_levels.values())
@@ -173,34 +213,16 @@ class Scorer:
         return len(self._operations_levels)
 
     def get_total_stats(self) -> typing.Dict[str, int]:
-        total_stat = {key: 0 for key in self._operations_levels}
-
-        for stat in self._stat:
-            for key, value in stat.operations.items():
-                total_stat[key] += value
-
-        return total_stat
+        return dict(self._total_stat)
 
     def get_levels_stats(self) -> typing.Dict[int, int]:
-        level_stats = {level: 0 for level in self._level_scores}
-
-        for stat in self._stat:
-            level = self.get_test_level(stat.operations)
-            level_stats[level] += 1
-
-        return level_stats
+        return dict(self._level_stats)
 
     def get_levels_coverage(self) -> typing.Dict[int, int]:
-        total_stats = self.get_total_stats()
-        level_stats = {level: 0 for level in self._level_scores}
-
-        for operation, level in self._operations_levels.items():
-            if total_stats[operation] > 0:
-                level_stats[level] += 1
-        return level_stats
+        return dict(self._levels_coverage)
 
     def get_operations_coverage(self) -> int:
-        return sum(int(operations_count > 0) for operations_count in self.get_total_stats().values())
+        return self._operations_coverage
 
     def get_test_level(self, operations: typing.Dict[str, int]) -> int:
         level = 1
@@ -227,20 +249,46 @@ class Scorer:
         code = compile(text_code, '<stdin>', 'exec')
         return self._extract_operations(code)
 
+    def _extract_sequences(self, code_obj: types.CodeType, length: int) -> typing.Dict[typing.Tuple[str, ...], int]:
+        sequences = defaultdict(int)
+
+        opnames = [i.opname for i in dis.get_instructions(code_obj) if i.opname != 'EXTENDED_ARG']
+        for start in range(len(opnames) - length + 1):
+            sequences[tuple(opnames[start:start + length])] += 1
+
+        for const in code_obj.co_consts:
+            if isinstance(const, types.CodeType):
+                for sequence, value in self._extract_sequences(const, length).items():
+                    sequences[sequence] += value
+
+        return sequences
+
+    def get_sequences(self, text_code: str, length: int = 2) -> typing.Dict[typing.Tuple[str, ...], int]:
+        """
+        Count runs of consecutive operations, as _extract_operations does for single ones
+        :param text_code: text code to analyze
+        :param length: number of operations in a run
+        :return: number of occurrences of every run
+        """
+        code = compile(text_code, '<stdin>', 'exec')
+        return self._extract_sequences(code, length)
+
     def score(self, text_code: str) -> float:
         """
         Normalize test score by number of tests on the same level
         :param text_code: text code to identify personal score
         :return: score for text code
         """
-        operations = self.get_operations(text_code)
-        total_stats = self.get_levels_stats()
-
-        level = self.get_test_level(operations)
-        return self._level_scores[level] / total_stats[level]
+        stat = self._stat.get(text_code)
+        if stat is not None:
+            level = stat.level
+        else:
+            level = self.get_test_level(self.get_operations(text_code))
+        return self._level_scores[level] / self._level_stats[level]
 
     def total_score(self) -> float:
-        return sum(self.score(stat.code) for stat in self._stat)
+        return sum(self._level_scores[level]
+                   for level, count in self._level_stats.items() if count)
 
 
 def dump_tests_stat(stream: io._io._TextIOBase, scorer: Scorer) -> None: